@@ -0,0 +1,46 @@
+"""Helpers shared by the benchmarks.
+
+The benchmarks also run against older revisions of the package (see README.md), so objects are constructed
+in a way that works with both the current and the previous signatures.
+"""
+
+import inspect
+import os
+import sys
+from typing import List
+
+import torrent_client.algorithms  # noqa: F401 (resolves the import order of the package)
+from torrent_client.file_structure import FileStructure
+from torrent_client.models import DownloadInfo, FileInfo
+
+
+def make_download_info(piece_length: int, piece_hashes: List[bytes], suggested_name: str,
+                       files: List[FileInfo]) -> DownloadInfo:
+    parameter = inspect.signature(DownloadInfo.__init__).parameters['piece_hashes']
+    if parameter.annotation is bytes:
+        download_info = DownloadInfo(b'x' * 20, piece_length, b''.join(piece_hashes), suggested_name, files)
+    else:
+        download_info = DownloadInfo(b'x' * 20, piece_length, piece_hashes, suggested_name, files)
+    download_info.reset_run_state()
+    return download_info
+
+
+def make_file_structure(download_dir: str, download_info: DownloadInfo, **kwargs) -> FileStructure:
+    parameters = inspect.signature(FileStructure.__init__).parameters
+    args = []
+    if 'hashing_pool' in parameters:
+        from torrent_client.hashing import HashingPool
+
+        args.append(HashingPool())
+    if 'io_scheduler' in parameters:
+        from torrent_client.io_scheduler import IOScheduler
+
+        args.append(IOScheduler())
+    return FileStructure(download_dir, download_info, *args, **kwargs)
+
+
+def print_revision():
+    import torrent_client
+
+    print('Package: {}'.format(os.path.dirname(os.path.dirname(os.path.abspath(torrent_client.__file__)))),
+          file=sys.stderr)
@@ -0,0 +1,71 @@
+"""Throughput of synchronous reads and writes of FileStructure over a torrent with many files.
+
+The range methods are called directly (bypassing the executor), so the numbers show the cost of the storage code
+and system calls only. Files are created in a temporary directory that is removed afterwards.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from common import make_download_info, make_file_structure, print_revision
+from torrent_client.file_structure import FileStructure
+from torrent_client.models import FileInfo
+
+
+PIECE_LENGTH = 2 ** 18
+
+
+def get_sync_method(name: str, fallback: str):
+    # Older revisions have only the public coroutines
+    method = getattr(FileStructure, name, None) or getattr(FileStructure, fallback)
+    return method.__wrapped__
+
+
+def measure(func, offsets) -> float:
+    start_time = time.perf_counter()
+    for offset in offsets:
+        func(offset)
+    return len(offsets) / (time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure synchronous FileStructure read/write throughput')
+    parser.add_argument('--files', type=int, default=10000, help='Number of files')
+    parser.add_argument('--file-size', type=int, default=40000,
+                        help='Size of each file (not a multiple of the block size, so many blocks span two files)')
+    parser.add_argument('--block', type=int, default=2 ** 14, help='Size of each read or write')
+    args = parser.parse_args()
+    print_revision()
+
+    total_size = args.files * args.file_size
+    files = [FileInfo(args.file_size, ['d{}'.format(i // 1000), 'f{}'.format(i)]) for i in range(args.files)]
+    piece_count = -(-total_size // PIECE_LENGTH)
+    download_info = make_download_info(PIECE_LENGTH, [b'h' * 20] * piece_count, 'bench', files)
+
+    download_dir = tempfile.mkdtemp()
+    try:
+        file_structure = make_file_structure(download_dir, download_info)
+        read_range = get_sync_method('_read_range', 'read')
+        write_range = get_sync_method('_write_range', 'write')
+
+        data = memoryview(os.urandom(args.block))
+        sequential = list(range(0, total_size - args.block, args.block))
+        shuffled = sequential[:]
+        random.Random(0).shuffle(shuffled)
+
+        print('write seq   {:9.0f} ops/s'.format(
+            measure(lambda offset: write_range(file_structure, offset, data), sequential)))
+        print('read seq    {:9.0f} ops/s'.format(
+            measure(lambda offset: read_range(file_structure, offset, args.block), sequential)))
+        print('read random {:9.0f} ops/s'.format(
+            measure(lambda offset: read_range(file_structure, offset, args.block), shuffled)))
+    finally:
+        shutil.rmtree(download_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Cost of tracking which peers own which pieces.
+
+Peers (every fifth one is a seed, the others have pieces with a random density) send their bitfields through
+PeerTCPClient._handle_haves, then all of them disconnect. Memory is the size of allocations traced
+while the bitfields are handled.
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from bitarray import bitarray
+
+from common import make_download_info, print_revision
+from torrent_client.models import FileInfo, Peer
+from torrent_client.network.peer_tcp_client import MessageType, PeerTCPClient
+
+
+BLOCK_LENGTH = 2 ** 14
+
+
+def make_bitfields(piece_count: int, peer_count: int):
+    rnd = random.Random(1)
+    bitfields = []
+    for i in range(peer_count):
+        density = 1.0 if i % 5 == 0 else rnd.random()
+        arr = bitarray([rnd.random() < density for _ in range(piece_count)], endian='big')
+        arr.fill()
+        bitfields.append(arr.tobytes())
+    return bitfields
+
+
+def remove_owner(client: PeerTCPClient):
+    download_info = client._download_info
+    if hasattr(download_info, 'piece_availability'):
+        download_info.piece_availability.subtract(client.piece_owned)
+    else:
+        # Before the availability counters, each piece kept a set of its owners
+        for info in download_info.pieces:
+            info.owners.discard(client._peer)
+
+
+def run(piece_count: int, peer_count: int):
+    download_info = make_download_info(BLOCK_LENGTH, [b'h' * 20] * piece_count, 'name',
+                                       [FileInfo(piece_count * BLOCK_LENGTH, ['name'])])
+    bitfields = make_bitfields(piece_count, peer_count)
+
+    clients = []
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    for i, payload in enumerate(bitfields):
+        client = PeerTCPClient(b'p' * 20, Peer('10.0.0.{}'.format(i), 6881))
+        client._download_info = download_info
+        client._piece_owned = bitarray(piece_count)
+        client._piece_owned.setall(False)
+        client._handle_haves(MessageType.bitfield, memoryview(payload))
+        clients.append(client)
+    bitfield_time = time.perf_counter() - start_time
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start_time = time.perf_counter()
+    for client in clients:
+        remove_owner(client)
+    disconnect_time = time.perf_counter() - start_time
+
+    print('{:>8} pieces: bitfields {:9.1f} ms, disconnects {:9.1f} ms, memory {:8.1f} MiB'.format(
+        piece_count, bitfield_time * 1000, disconnect_time * 1000, memory / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost of piece availability tracking')
+    parser.add_argument('piece_counts', nargs='+', type=int, metavar='piece_count')
+    parser.add_argument('--peers', type=int, default=55, help='Number of connected peers')
+    args = parser.parse_args()
+    print_revision()
+
+    for piece_count in args.piece_counts:
+        run(piece_count, args.peers)
+
+
+if __name__ == '__main__':
+    main()
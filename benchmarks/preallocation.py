@@ -0,0 +1,108 @@
+"""Fragmentation and cold sequential read speed of a file downloaded in random piece order
+with different preallocation modes.
+
+Pieces are written block by block by interleaved "peers", and the page cache is synced periodically
+to imitate writeback during a long download. The extents are counted with `filefrag`. Dropping the page cache
+before the sequential read requires root, otherwise the read is warm.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from common import make_download_info, make_file_structure, print_revision
+from torrent_client.file_structure import PREALLOCATION_MODES
+from torrent_client.models import FileInfo
+
+
+BLOCK_LENGTH = 2 ** 14
+PIECE_LENGTH = 2 ** 22
+PEER_COUNT = 60
+SYNC_INTERVAL = 256  # blocks
+
+
+def drop_caches() -> bool:
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3')
+    except OSError:
+        return False
+    return True
+
+
+async def download(mode: str, size: int, download_dir: str):
+    piece_count = size // PIECE_LENGTH
+    download_info = make_download_info(PIECE_LENGTH, [b'h' * 20] * piece_count, 'f', [FileInfo(size, ['f'])])
+    file_structure = make_file_structure(download_dir, download_info, preallocation=mode)
+
+    start_time = time.perf_counter()
+    await file_structure.create_empty_files()
+    await file_structure.preallocate()
+    preallocation_time = time.perf_counter() - start_time
+
+    rnd = random.Random(0)
+    piece_indexes = list(range(piece_count))
+    rnd.shuffle(piece_indexes)
+    data = memoryview(os.urandom(BLOCK_LENGTH))
+    written_blocks = 0
+
+    async def execute_peer(peer_pieces):
+        nonlocal written_blocks
+
+        for piece_index in peer_pieces:
+            for block_begin in range(0, PIECE_LENGTH, BLOCK_LENGTH):
+                await file_structure.write(piece_index * PIECE_LENGTH + block_begin, data)
+                written_blocks += 1
+                if written_blocks % SYNC_INTERVAL == 0:
+                    os.sync()
+                if rnd.random() < 0.3:
+                    await asyncio.sleep(0)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(execute_peer(piece_indexes[i::PEER_COUNT]) for i in range(PEER_COUNT)))
+    write_time = time.perf_counter() - start_time
+    await file_structure.close()
+    return preallocation_time, write_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure fragmentation caused by different preallocation modes')
+    parser.add_argument('modes', nargs='*', metavar='mode',
+                        help='Preallocation modes to test ({}, all by default)'.format(', '.join(PREALLOCATION_MODES)))
+    parser.add_argument('--size', type=int, default=2 ** 30, help='File size (a multiple of 4 MiB)')
+    parser.add_argument('--dir', help='Directory on the file system to test (a temporary directory by default)')
+    args = parser.parse_args()
+    for mode in args.modes:
+        if mode not in PREALLOCATION_MODES:
+            parser.error('Unknown preallocation mode "{}"'.format(mode))
+    print_revision()
+
+    for mode in args.modes or PREALLOCATION_MODES:
+        download_dir = tempfile.mkdtemp(dir=args.dir)
+        try:
+            preallocation_time, write_time = asyncio.run(download(mode, args.size, download_dir))
+
+            path = os.path.join(download_dir, 'f', 'f')
+            os.sync()
+            extents = subprocess.run(['filefrag', path], stdout=subprocess.PIPE,
+                                     universal_newlines=True).stdout.strip().split(': ')[-1]
+            cold = drop_caches()
+            start_time = time.perf_counter()
+            with open(path, 'rb', buffering=0) as f:
+                while f.read(2 ** 20):
+                    pass
+            read_speed = args.size / 2 ** 20 / (time.perf_counter() - start_time)
+
+            print('{:9} preallocation {:5.1f} s, write {:5.1f} s, {}, {} sequential read {:6.0f} MiB/s'.format(
+                mode, preallocation_time, write_time, extents, 'cold' if cold else 'warm', read_speed))
+        finally:
+            shutil.rmtree(download_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+import hashlib
+from collections import OrderedDict
+
+import torrent_client.algorithms  # noqa: F401 (resolves the import order of the package)
+from torrent_client.models import DownloadInfo
+
+
+def make_download_info(data: bytes, piece_length: int, name: str='data') -> DownloadInfo:
+    """Returns the state of a single-file torrent with the given contents, ready to be downloaded."""
+
+    pieces = b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+    download_info = DownloadInfo.from_dict(OrderedDict([
+        (b'length', len(data)), (b'name', name.encode()), (b'piece length', piece_length), (b'pieces', pieces)]))
+    download_info.reset_run_state()
+    return download_info
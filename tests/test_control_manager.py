@@ -0,0 +1,74 @@
+import asyncio
+import os
+import pickle
+
+from bitarray import bitarray
+
+from conftest import make_download_info
+from torrent_client.control import manager as manager_module
+from torrent_client.control.manager import ControlManager
+from torrent_client.file_structure import FileStructure
+from torrent_client.hashing import HashingPool
+from torrent_client.io_scheduler import IOScheduler
+from torrent_client.models import BlockRequest, DownloadInfo, Peer, TorrentInfo
+
+
+PIECE_LENGTH = 2 ** 15
+DATA = os.urandom(PIECE_LENGTH * 2)
+BLOCK_LENGTH = DownloadInfo.MARKED_BLOCK_SIZE
+
+
+class FakeTorrentManager:
+    def __init__(self, storage: FileStructure):
+        self._storage = storage
+
+    @property
+    def unflushed_pieces(self):
+        return self._storage.unflushed_pieces
+
+
+def make_torrent_info(download_dir: str) -> TorrentInfo:
+    return TorrentInfo(make_download_info(DATA, PIECE_LENGTH), [['http://tracker/announce']], download_dir=download_dir)
+
+
+def test_state_dump_keeps_only_stored_blocks(tmp_path, monkeypatch):
+    state_filename = str(tmp_path / 'state')
+    monkeypatch.setattr(manager_module, 'state_filename', state_filename)
+    torrent_info = make_torrent_info(str(tmp_path))
+    download_info = torrent_info.download_info
+    peer = Peer('127.0.0.1', 6881)
+
+    async def run():
+        storage = FileStructure(str(tmp_path), download_info, HashingPool(), IOScheduler())
+        try:
+            # The first block of the piece 1 is on disk already (e.g. since the previous run),
+            # so the next one is written there too
+            blocks = bitarray(PIECE_LENGTH // BLOCK_LENGTH)
+            blocks.setall(False)
+            blocks[0] = True
+            download_info.pieces[1].restore_downloaded_blocks(blocks)
+
+            for piece_index in range(2):
+                data = DATA[piece_index * PIECE_LENGTH + BLOCK_LENGTH:piece_index * PIECE_LENGTH + BLOCK_LENGTH * 2]
+                await storage.write_block(piece_index, BLOCK_LENGTH, memoryview(data))
+                download_info.pieces[piece_index].mark_downloaded_blocks(
+                    peer, BlockRequest(piece_index, BLOCK_LENGTH, BLOCK_LENGTH))
+            assert list(storage.unflushed_pieces) == [0]
+
+            control_manager = ControlManager()
+            control_manager._torrents[download_info.info_hash] = torrent_info
+            control_manager._torrent_managers[download_info.info_hash] = FakeTorrentManager(storage)
+            control_manager._dump_state()
+        finally:
+            await storage.close()
+
+    asyncio.run(run())
+
+    with open(state_filename, 'rb') as f:
+        _, _, (saved_info,) = pickle.load(f)
+    saved_pieces = saved_info.download_info.pieces
+    assert not saved_pieces[0].has_downloaded_blocks()  # Its block was only in memory
+    assert saved_pieces[1].downloaded_blocks.tolist()[:2] == [True, True]
+
+    # The running torrent keeps its state
+    assert download_info.pieces[0].has_downloaded_blocks()
@@ -0,0 +1,64 @@
+import asyncio
+import hashlib
+import os
+
+import bencodepy
+
+from torrent_client.creation import create_torrent, save_torrent
+from torrent_client.hashing import HashingPool
+from torrent_client.models import TorrentInfo
+
+
+def canonical_encode(value) -> bytes:
+    if isinstance(value, dict):
+        return b'd' + b''.join(canonical_encode(key) + canonical_encode(value[key])
+                               for key in sorted(value)) + b'e'
+    if isinstance(value, list):
+        return b'l' + b''.join(map(canonical_encode, value)) + b'e'
+    if isinstance(value, int):
+        return b'i%de' % value
+    return b'%d:%s' % (len(value), value)
+
+
+def make_tree(root):
+    os.makedirs(os.path.join(root, 'b', 'nested'))
+    with open(os.path.join(root, 'b', 'nested', 'z.bin'), 'wb') as f:
+        f.write(os.urandom(300000))
+    with open(os.path.join(root, 'a.txt'), 'wb') as f:
+        f.write(b'data' * 1000)
+
+
+def create(path, announce_list, **kwargs):
+    hashing_pool = HashingPool(2)
+    try:
+        return asyncio.run(create_torrent(path, announce_list, hashing_pool, **kwargs))
+    finally:
+        hashing_pool.shutdown()
+
+
+def test_output_is_canonical(tmp_path):
+    make_tree(str(tmp_path / 'src'))
+    dictionary = create(str(tmp_path / 'src'), [['http://tracker/announce']], private=True, comment='test')
+    filename = str(tmp_path / 'out.torrent')
+    save_torrent(dictionary, filename)
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    assert canonical_encode(bencodepy.decode(data)) == data
+
+    info_hash = hashlib.sha1(canonical_encode(bencodepy.decode(data)[b'info'])).digest()
+    assert TorrentInfo.from_file(filename, download_dir=str(tmp_path)).download_info.info_hash == info_hash
+
+
+def test_pieces_match_data(tmp_path):
+    make_tree(str(tmp_path / 'src'))
+    dictionary = create(str(tmp_path / 'src'), [['http://tracker/announce']], piece_length=2 ** 16)
+    info = dictionary[b'info']
+    assert [file[b'path'] for file in info[b'files']] == [[b'a.txt'], [b'b', b'nested', b'z.bin']]
+
+    with open(str(tmp_path / 'src' / 'a.txt'), 'rb') as f:
+        data = f.read()
+    with open(str(tmp_path / 'src' / 'b' / 'nested' / 'z.bin'), 'rb') as f:
+        data += f.read()
+    expected = b''.join(hashlib.sha1(data[i:i + 2 ** 16]).digest() for i in range(0, len(data), 2 ** 16))
+    assert info[b'pieces'] == expected
@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import logging
+
+from bitarray import bitarray
+
+from conftest import make_download_info
+from torrent_client.algorithms.downloader import Downloader
+from torrent_client.models import BlockRequest, DownloadInfo, Peer, TorrentInfo
+from torrent_client.storage import BaseStorage
+
+
+PIECE_LENGTH = 2 ** 15
+DATA = bytes(range(256)) * (PIECE_LENGTH * 2 // 256)
+
+
+class FailingStorage(BaseStorage):
+    def __init__(self, failure_count: int):
+        self.failure_count = failure_count
+        self.hash_calls = 0
+        self.discarded = []
+
+    async def hash_piece(self, piece_index: int) -> bytes:
+        self.hash_calls += 1
+        if self.hash_calls <= self.failure_count:
+            raise OSError(5, 'Input/output error')
+        return hashlib.sha1(DATA[piece_index * PIECE_LENGTH:(piece_index + 1) * PIECE_LENGTH]).digest()
+
+    def discard_piece(self, piece_index: int):
+        self.discarded.append(piece_index)
+
+
+class CorruptStorage(FailingStorage):
+    def __init__(self):
+        super().__init__(0)
+
+    async def hash_piece(self, piece_index: int) -> bytes:
+        self.hash_calls += 1
+        return bytes(20)
+
+
+class FakePeerManager:
+    def __init__(self):
+        self.peer_data = {}
+
+
+def make_downloader(storage: BaseStorage) -> Downloader:
+    download_info = make_download_info(DATA, PIECE_LENGTH)
+    torrent_info = TorrentInfo(download_info, [['http://tracker/announce']], download_dir='/nonexistent')
+
+    downloader = Downloader(torrent_info, b'\0' * 20, logging.getLogger('test'), storage, FakePeerManager(), None)
+    piece_info = download_info.pieces[0]
+    download_info.interesting_pieces.add(0)
+    blocks = bitarray(PIECE_LENGTH // DownloadInfo.MARKED_BLOCK_SIZE)
+    blocks.setall(True)
+    piece_info.restore_downloaded_blocks(blocks)
+    return downloader
+
+
+async def validate_first_piece(downloader: Downloader):
+    worker = asyncio.ensure_future(downloader._execute_validations())
+    try:
+        downloader._enqueue_validation(0)
+        for _ in range(100):
+            await asyncio.sleep(0)
+        assert not worker.done()
+    finally:
+        worker.cancel()
+
+
+def test_validation_is_retried_after_error():
+    storage = FailingStorage(Downloader.MAX_VALIDATION_ERRORS - 1)
+    downloader = make_downloader(storage)
+    asyncio.run(validate_first_piece(downloader))
+
+    download_info = downloader._download_info
+    assert download_info.pieces[0].downloaded
+    assert download_info.downloaded_piece_count == 1
+    assert storage.hash_calls == Downloader.MAX_VALIDATION_ERRORS
+    assert not storage.discarded
+
+
+def test_piece_is_redownloaded_after_repeated_errors():
+    storage = FailingStorage(Downloader.MAX_VALIDATION_ERRORS)
+    downloader = make_downloader(storage)
+    asyncio.run(validate_first_piece(downloader))
+
+    piece_info = downloader._download_info.pieces[0]
+    assert not piece_info.downloaded
+    assert not piece_info.validating
+    assert not piece_info.has_downloaded_blocks()
+    assert storage.discarded == [0]
+    assert 0 in downloader._piece_block_queue
+    assert downloader._validating_piece_count == 0
+
+
+def test_disconnected_source_is_banned(caplog):
+    storage = CorruptStorage()
+    downloader = make_downloader(storage)
+    download_info = downloader._download_info
+    peer = Peer('10.0.0.1', 6881)  # Has sent a corrupt block and disconnected, so it's not in peer_data
+    download_info.pieces[0].mark_downloaded_blocks(peer, BlockRequest(0, 0, DownloadInfo.MARKED_BLOCK_SIZE))
+    for _ in range(DownloadInfo.DISTRUST_RATE_TO_BAN - 1):
+        download_info.increase_distrust(peer)
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(validate_first_piece(downloader))
+
+    assert download_info.is_banned(peer)
+    assert storage.hash_calls == 1  # The piece is downloaded again instead of retrying validation
+    assert storage.discarded == [0]
+    assert not caplog.records
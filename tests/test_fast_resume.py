@@ -0,0 +1,108 @@
+import os
+
+import pytest
+from bitarray import bitarray
+
+from conftest import make_download_info
+from torrent_client.fast_resume import FastResumeError, FastResumeRecord, get_file_fingerprints
+from torrent_client.models import DownloadInfo
+
+
+PIECE_LENGTH = 2 ** 15
+DATA = os.urandom(PIECE_LENGTH * 3 + 1000)
+BLOCKS_PER_PIECE = PIECE_LENGTH // DownloadInfo.MARKED_BLOCK_SIZE
+
+
+def make_partial_blocks(piece_index: int) -> bitarray:
+    blocks = bitarray(BLOCKS_PER_PIECE)
+    blocks.setall(False)
+    blocks[piece_index] = True
+    return blocks
+
+
+def make_started_download_info() -> DownloadInfo:
+    download_info = make_download_info(DATA, PIECE_LENGTH)
+    download_info.pieces[0].mark_as_downloaded()
+    download_info.pieces[2].mark_as_downloaded()
+    download_info.pieces[1].restore_downloaded_blocks(make_partial_blocks(1))
+    download_info.downloaded_piece_count = 2
+    return download_info
+
+
+def write_data(download_dir: str):
+    with open(os.path.join(download_dir, 'data'), 'wb') as f:
+        f.write(DATA)
+
+
+def test_record_round_trip(tmp_path):
+    write_data(str(tmp_path))
+    download_info = make_started_download_info()
+    fingerprints = get_file_fingerprints(str(tmp_path), download_info)
+    record = FastResumeRecord.from_download_info(download_info, fingerprints)
+
+    loaded = FastResumeRecord.from_bytes(record.to_bytes())
+    assert loaded.info_hash == download_info.info_hash
+    assert loaded.downloaded_pieces == bitarray('1010')
+    assert loaded.partial_pieces == {1: make_partial_blocks(1)}
+    assert loaded.fingerprints == fingerprints
+    assert loaded.matches(download_info, fingerprints)
+
+    filename = str(tmp_path / 'resume' / 'record')
+    record.save(filename)
+    assert FastResumeRecord.load(filename).to_bytes() == record.to_bytes()
+    assert FastResumeRecord.load(str(tmp_path / 'missing')) is None
+
+
+def test_corrupted_record_is_rejected():
+    record = FastResumeRecord.from_download_info(make_started_download_info(), [(len(DATA), 1)])
+    data = bytearray(record.to_bytes())
+    for pos in (0, len(FastResumeRecord.MAGIC) + 1, len(data) // 2, len(data) - 1):
+        corrupted = bytearray(data)
+        corrupted[pos] ^= 0x01
+        with pytest.raises(FastResumeError):
+            FastResumeRecord.from_bytes(bytes(corrupted))
+    with pytest.raises(FastResumeError):
+        FastResumeRecord.from_bytes(bytes(data[:-1]))
+
+
+def test_record_does_not_match_modified_files(tmp_path):
+    write_data(str(tmp_path))
+    download_info = make_started_download_info()
+    size, mtime_ns = get_file_fingerprints(str(tmp_path), download_info)[0]
+    record = FastResumeRecord.from_download_info(download_info, [(size, mtime_ns)])
+
+    assert record.matches(download_info, [(size, mtime_ns)])
+    assert not record.matches(download_info, [(size + 1, mtime_ns)])
+    assert not record.matches(download_info, [(size, mtime_ns + 1)])
+    assert not record.matches(download_info, [(-1, 0)])  # The file is missing
+
+    # Touching the file is enough
+    os.utime(str(tmp_path / 'data'), ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+    assert not record.matches(download_info, get_file_fingerprints(str(tmp_path), download_info))
+
+    other_info = make_download_info(DATA[:-1], PIECE_LENGTH)
+    assert not record.matches(other_info, [(size, mtime_ns)])
+
+
+def test_record_is_applied():
+    record = FastResumeRecord.from_download_info(make_started_download_info(), [])
+
+    download_info = make_download_info(DATA, PIECE_LENGTH)
+    download_info.pieces[3].mark_as_downloaded()  # The state in memory is replaced
+    download_info.pieces[2].restore_downloaded_blocks(make_partial_blocks(2))
+    record.apply(download_info)
+
+    pieces = download_info.pieces
+    assert pieces.downloaded == bitarray('1010')
+    assert list(pieces.partial_piece_indexes) == [1]
+    assert pieces[1].downloaded_blocks == make_partial_blocks(1)
+    assert pieces[3].downloaded_blocks is None
+    assert download_info.downloaded_piece_count == 2
+    assert not download_info.complete
+
+    complete = make_download_info(DATA, PIECE_LENGTH)
+    for info in complete.pieces:
+        info.mark_as_downloaded()
+    FastResumeRecord.from_download_info(complete, []).apply(download_info)
+    assert download_info.downloaded_piece_count == 4
+    assert download_info.complete
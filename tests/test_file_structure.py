@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import make_download_info
+from torrent_client import file_structure
+from torrent_client.file_structure import FileHandleCache, FileStructure, MappedFileStructure
+from torrent_client.hashing import HashingPool
+from torrent_client.io_scheduler import IOClass, IOScheduler
+from torrent_client.models import DownloadInfo
+
+
+PIECE_LENGTH = 2 ** 16
+DATA = os.urandom(PIECE_LENGTH * 4)
+
+
+def make_data_info() -> DownloadInfo:
+    return make_download_info(DATA, PIECE_LENGTH, 'data.bin')
+
+
+def make_dirs(tmp_path):
+    old_dir = str(tmp_path / 'old')
+    new_dir = str(tmp_path / 'new')
+    os.makedirs(old_dir)
+    os.makedirs(new_dir)
+    with open(os.path.join(old_dir, 'data.bin'), 'wb') as f:
+        f.write(DATA)
+    shutil.copy(os.path.join(old_dir, 'data.bin'), new_dir)
+    return old_dir, new_dir
+
+
+async def is_released(storage: FileStructure) -> bool:
+    try:
+        await asyncio.wait_for(storage.wait_old_files_released(), FileStructure.OLD_FILES_POLL_INTERVAL * 3)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def test_relocation_waits_for_mapped_views(tmp_path):
+    old_dir, new_dir = make_dirs(tmp_path)
+
+    async def run():
+        storage = MappedFileStructure(old_dir, make_data_info(), HashingPool(), IOScheduler())
+        try:
+            view = await storage.read(0, PIECE_LENGTH)
+            assert isinstance(view, memoryview) and view == DATA[:PIECE_LENGTH]
+
+            storage.relocate(new_dir)
+            assert not await is_released(storage)  # The old file must not be truncated under the view
+
+            view.release()
+            assert await is_released(storage)
+            assert await storage.read(PIECE_LENGTH, PIECE_LENGTH) == DATA[PIECE_LENGTH:PIECE_LENGTH * 2]
+        finally:
+            await storage.close()
+
+    asyncio.run(run())
+
+
+def test_relocation_waits_for_pinned_files(tmp_path):
+    old_dir, new_dir = make_dirs(tmp_path)
+
+    async def run():
+        storage = FileStructure(old_dir, make_data_info(), HashingPool(), IOScheduler())
+        try:
+            await storage.read(0, PIECE_LENGTH)  # Opens the file
+            handle, file_pos = storage.pin_file_range(0, PIECE_LENGTH)
+
+            storage.relocate(new_dir)
+            assert not await is_released(storage)
+            assert os.pread(handle.fd, PIECE_LENGTH, file_pos) == DATA[:PIECE_LENGTH]
+
+            storage.unpin_file(handle)
+            assert await is_released(storage)
+        finally:
+            await storage.close()
+
+    asyncio.run(run())
+
+
+def recheck(storage: FileStructure):
+    results = {}
+    return storage.recheck(range(len(DATA) // PIECE_LENGTH), results.__setitem__), results
+
+
+def test_mapped_hashing_uses_no_buffers(tmp_path, monkeypatch):
+    old_dir, _ = make_dirs(tmp_path)
+
+    async def unavailable_buffer():
+        raise AssertionError('Mapped data must be hashed without copying into buffers')
+
+    monkeypatch.setattr(file_structure.hash_buffers, 'acquire', unavailable_buffer)
+    monkeypatch.setattr(file_structure.recheck_buffers, 'acquire', unavailable_buffer)
+
+    async def run():
+        storage = MappedFileStructure(old_dir, make_data_info(), HashingPool(), IOScheduler())
+        try:
+            checks, results = recheck(storage)
+            await checks
+            assert results == {index: True for index in range(len(DATA) // PIECE_LENGTH)}
+        finally:
+            await storage.close()
+
+    asyncio.run(run())
+
+
+def test_recheck_does_not_starve_validation(tmp_path):
+    old_dir, _ = make_dirs(tmp_path)
+
+    async def run():
+        storage = FileStructure(old_dir, make_data_info(), HashingPool(), IOScheduler())
+        held_buffers = [await file_structure.recheck_buffers.acquire()
+                        for _ in range(FileStructure.RECHECK_CONCURRENCY)]
+        try:
+            checks, results = recheck(storage)
+            checks = asyncio.ensure_future(checks)
+            await asyncio.sleep(0)
+
+            hasher = hashlib.sha1()
+            await asyncio.wait_for(storage._hash_from_disk(lambda _, data: hasher.update(data), 0, 0, PIECE_LENGTH,
+                                                           io_class=IOClass.validation_read), 5)
+            assert hasher.digest() == hashlib.sha1(DATA[:PIECE_LENGTH]).digest()
+            assert not checks.done()  # The recheck still waits for its buffers
+        finally:
+            for buffer in held_buffers:
+                file_structure.recheck_buffers.release(buffer)
+        try:
+            await checks
+            assert all(results.values()) and len(results) == len(DATA) // PIECE_LENGTH
+        finally:
+            await storage.close()
+
+    asyncio.run(run())
+
+
+def test_pinning_does_not_open_files(tmp_path):
+    _, download_dir = make_dirs(tmp_path)
+    os.remove(os.path.join(download_dir, 'data.bin'))
+
+    async def run():
+        storage = FileStructure(download_dir, make_data_info(), HashingPool(), IOScheduler())
+        try:
+            # The file isn't open yet, and opening it (or creating, as here) must not block the event loop
+            assert storage.pin_file_range(0, PIECE_LENGTH) is None
+            assert not os.path.exists(os.path.join(download_dir, 'data.bin'))
+
+            await storage.read(0, PIECE_LENGTH)
+            handle, file_pos = storage.pin_file_range(PIECE_LENGTH, PIECE_LENGTH)
+            assert file_pos == PIECE_LENGTH
+            storage.unpin_file(handle)
+        finally:
+            await storage.close()
+
+    asyncio.run(run())
+
+
+def test_out_of_order_blocks_are_hashed_in_pool(tmp_path):
+    async def run():
+        download_info = make_data_info()
+        download_info.reset_run_state()
+        storage = FileStructure(str(tmp_path), download_info, HashingPool(), IOScheduler())
+        piece_info = download_info.pieces[0]
+        block_length = PIECE_LENGTH // 4
+        try:
+            for block_begin in reversed(range(0, PIECE_LENGTH, block_length)):
+                await storage.write_block(0, block_begin, memoryview(DATA[block_begin:block_begin + block_length]))
+            # The rest of the piece is left to the hashing pool instead of being hashed on the event loop
+            assert piece_info.hashed_length == block_length
+
+            assert await storage.hash_piece(0) == piece_info.piece_hash
+        finally:
+            await storage.close()
+
+    asyncio.run(run())
+
+
+def test_file_is_opened_outside_cache_lock(tmp_path):
+    path = str(tmp_path / 'file')
+    cache = FileHandleCache()
+    owner = object()
+    opening = threading.Event()
+    can_open = threading.Event()
+    opened_fds = []
+
+    def slow_open(key: int) -> int:
+        opening.set()
+        assert can_open.wait(5)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        opened_fds.append(fd)
+        return fd
+
+    cached = cache.acquire(owner, 0, lambda key: os.open(path, os.O_RDWR | os.O_CREAT))
+    with ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(cache.acquire, owner, 1, slow_open) for _ in range(2)]
+        assert opening.wait(5)
+
+        # Doesn't wait for the file being opened in another thread
+        assert cache.acquire_cached(owner, 0) is cached
+        cache.release(cached)
+        assert cache.acquire_cached(owner, 1) is None
+
+        can_open.set()
+        first, second = [future.result(5) for future in futures]
+
+    # Both threads use the same descriptor, the duplicate is closed
+    assert first is second and first.users == 2
+    assert len(opened_fds) == 2
+    duplicate_fd = next(fd for fd in opened_fds if fd != first.fd)
+    with pytest.raises(OSError):
+        os.fstat(duplicate_fd)
+
+    for handle in (cached, first, second):
+        cache.release(handle)
+    cache.close_owner(owner)
+
+
+def test_closed_structure_does_not_open_files(tmp_path):
+    async def run():
+        storage = FileStructure(str(tmp_path), make_data_info(), HashingPool(), IOScheduler())
+        await storage.close()
+
+        # E.g. preallocation that was still running in an executor thread when the torrent was stopped
+        with pytest.raises(ValueError):
+            storage._acquire_file(0)
+        assert file_structure.file_handles.acquire_cached(storage, 0) is None
+
+    asyncio.run(run())
+
+
+def get_window_count(storage: FileStructure) -> int:
+    return sum(1 for key in file_structure.mapped_windows._windows if key[0] is storage)
+
+
+def test_mapped_windows_are_bounded_for_all_torrents(tmp_path, monkeypatch):
+    monkeypatch.setattr(MappedFileStructure, 'WINDOW_SIZE', PIECE_LENGTH)
+    monkeypatch.setattr(file_structure.MappedWindowCache, 'MAX_MAPPED_LENGTH', PIECE_LENGTH * 3)
+
+    async def run():
+        storages = []
+        for name in ('first', 'second'):
+            download_dir, _ = make_dirs(tmp_path / name)
+            storages.append(MappedFileStructure(download_dir, make_data_info(), HashingPool(), IOScheduler()))
+        try:
+            for piece_index in range(len(DATA) // PIECE_LENGTH):
+                for storage in storages:
+                    view = await storage.read(piece_index * PIECE_LENGTH, PIECE_LENGTH)
+                    assert view == DATA[piece_index * PIECE_LENGTH:(piece_index + 1) * PIECE_LENGTH]
+                    view.release()
+
+                    assert file_structure.mapped_windows.mapped_length <= PIECE_LENGTH * 3
+        finally:
+            for storage in storages:
+                await storage.close()
+        assert file_structure.mapped_windows.mapped_length == 0
+
+    asyncio.run(run())
+
+
+def test_mapped_writes_to_sparse_files_use_pwrite(tmp_path):
+    async def run():
+        storage = MappedFileStructure(str(tmp_path), make_data_info(), HashingPool(), IOScheduler())
+        try:
+            data = memoryview(DATA[:PIECE_LENGTH])
+            await storage.write(0, data)
+            # A full disk would lead to SIGBUS if the hole were written through a mapping
+            assert not get_window_count(storage)
+
+            await storage.preallocate()
+            await storage.write(PIECE_LENGTH, data)
+            assert get_window_count(storage)
+
+            assert await storage.read(0, PIECE_LENGTH) == data
+            assert await storage.read(PIECE_LENGTH, PIECE_LENGTH) == data
+        finally:
+            await storage.close()
+
+    asyncio.run(run())
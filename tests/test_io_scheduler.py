@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+from torrent_client.io_scheduler import IOClass, IOScheduler
+
+
+JOB_DURATION = 0.005
+
+
+def test_low_priority_work_completes_under_saturated_load():
+    async def run():
+        scheduler = IOScheduler()
+        stopped = False
+
+        async def load(owner: int, io_class: IOClass):
+            while not stopped:
+                await scheduler.run(owner, io_class, lambda: time.sleep(JOB_DURATION))
+
+        # Enough high-priority work to keep every worker busy
+        tasks = [asyncio.ensure_future(load(owner, io_class))
+                 for io_class in (IOClass.download_write, IOClass.upload_read)
+                 for owner in range(IOScheduler.WORKER_COUNT)]
+        try:
+            await asyncio.sleep(JOB_DURATION * 4)
+            assert scheduler.get_class_state(IOClass.download_write).queued_count
+
+            for io_class in (IOClass.recheck, IOClass.background):
+                result = scheduler.run('low', io_class, lambda: io_class)
+                assert await asyncio.wait_for(result, JOB_DURATION * 200) == io_class
+        finally:
+            stopped = True
+            await asyncio.wait(tasks)
+            scheduler.shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,173 @@
+import os
+import pickle
+import random
+
+import pytest
+from bitarray import bitarray
+
+from conftest import make_download_info
+from torrent_client.models import DownloadInfo, Peer, PieceAvailability, PieceInfo, PieceTable
+
+
+PIECE_COUNT = 100
+
+
+def make_bitfield(rnd: random.Random, density: float) -> bitarray:
+    return bitarray([rnd.random() < density for _ in range(PIECE_COUNT)])
+
+
+def get_counts(availability: PieceAvailability):
+    return [availability[index] for index in range(PIECE_COUNT)]
+
+
+def test_availability_matches_naive_counts():
+    rnd = random.Random(0)
+    availability = PieceAvailability(PIECE_COUNT)
+    expected = [0] * PIECE_COUNT
+    bitfields = []
+
+    for step in range(300):
+        action = rnd.random()
+        if action < 0.4 or not bitfields:
+            bitfield = make_bitfield(rnd, rnd.choice([0.05, 0.5, 1.0]))
+            availability.add(bitfield)
+            bitfields.append(bitfield)
+            for index in range(PIECE_COUNT):
+                expected[index] += bitfield[index]
+        elif action < 0.7:
+            bitfield = bitfields.pop(rnd.randrange(len(bitfields)))
+            availability.subtract(bitfield)
+            for index in range(PIECE_COUNT):
+                expected[index] -= bitfield[index]
+        else:
+            # A HAVE message
+            index = rnd.randrange(PIECE_COUNT)
+            availability.add_piece(index)
+            bitfield = bitarray(PIECE_COUNT)
+            bitfield.setall(False)
+            bitfield[index] = True
+            bitfields.append(bitfield)
+            expected[index] += 1
+
+        assert get_counts(availability) == expected, 'step {}'.format(step)
+
+
+def test_availability_carries_and_borrows_across_planes():
+    all_pieces = bitarray(PIECE_COUNT)
+    all_pieces.setall(True)
+    even_pieces = bitarray([index % 2 == 0 for index in range(PIECE_COUNT)])
+    availability = PieceAvailability(PIECE_COUNT)
+
+    # 7 = 0b111, the next addition carries through all planes into a new one
+    for _ in range(7):
+        availability.add(all_pieces)
+    assert len(availability._planes) == 3
+    availability.add(even_pieces)
+    assert get_counts(availability) == [8 if index % 2 == 0 else 7 for index in range(PIECE_COUNT)]
+    assert len(availability._planes) == 4
+
+    availability.add_piece(1)  # 7 -> 8 for a single piece
+    assert availability[1] == 8 and availability[3] == 7
+
+    # 8 - 1 = 0b0111 borrows from the most significant plane
+    availability.subtract(all_pieces)
+    assert get_counts(availability) == [7 if index % 2 == 0 or index == 1 else 6 for index in range(PIECE_COUNT)]
+
+    for _ in range(6):
+        availability.subtract(all_pieces)
+    availability.subtract(even_pieces)
+    assert get_counts(availability) == [1 if index == 1 else 0 for index in range(PIECE_COUNT)]
+    assert len(availability._planes) == 1  # Empty planes are dropped
+
+    with pytest.raises(ValueError):
+        availability.subtract(even_pieces)
+
+
+def test_select_rarest_takes_lowest_bucket_within_mask():
+    rnd = random.Random(1)
+    availability = PieceAvailability(PIECE_COUNT)
+    bitfields = [make_bitfield(rnd, rnd.random()) for _ in range(20)]
+    for bitfield in bitfields:
+        availability.add(bitfield)
+
+    for peer_pieces in bitfields:
+        # As in the downloader, the candidates are the pieces the peer has, so their availability isn't zero
+        candidates = peer_pieces & make_bitfield(rnd, 0.7)
+        if not candidates.any():
+            continue
+        candidate_indexes = [index for index in range(PIECE_COUNT) if candidates[index]]
+        lowest = min(availability[index] for index in candidate_indexes)
+        lowest_bucket = {index for index in candidate_indexes if availability[index] == lowest}
+
+        for _ in range(10):
+            (piece_index,) = availability.select_rarest(candidates, 1)
+            assert piece_index in lowest_bucket
+
+        # Pieces are taken bucket by bucket and never from outside of the mask
+        selected = availability.select_rarest(candidates, len(lowest_bucket) + 3)
+        assert set(selected[:len(lowest_bucket)]) == lowest_bucket
+        assert all(candidates[index] for index in selected)
+        counts = [availability[index] for index in selected]
+        assert counts == sorted(counts)
+        assert len(selected) == min(len(lowest_bucket) + 3, len(candidate_indexes))
+
+
+class LegacyObject:
+    """Pickles as an instance of `cls` with the given state, as it was saved by an older version."""
+
+    def __init__(self, cls: type, state):
+        self._cls = cls
+        self._state = state
+
+    def __reduce__(self):
+        return object.__new__, (self._cls,), self._state
+
+
+def make_legacy_piece(info: PieceInfo, *, selected: bool=True, downloaded: bool=False,
+                      block_downloaded: bitarray=None, sources: set=frozenset()) -> LegacyObject:
+    # Before the piece table, PieceInfo had `__slots__`, so its state is a tuple
+    return LegacyObject(PieceInfo, (None, {
+        '_piece_hash': info.piece_hash, '_length': info.length, 'selected': selected, 'validating': False,
+        '_downloaded': downloaded, '_sources': set(sources), '_block_downloaded': block_downloaded,
+        '_blocks_expected': set(), '_hasher': None, '_hashed_length': 0,
+    }))
+
+
+def test_legacy_state_is_migrated():
+    piece_length = 2 ** 15
+    data = os.urandom(piece_length * 3 + 1000)
+    download_info = make_download_info(data, piece_length)
+    block_count = piece_length // DownloadInfo.MARKED_BLOCK_SIZE
+    blocks = bitarray(block_count)
+    blocks.setall(False)
+    blocks[:5] = True
+    peer = Peer('127.0.0.1', 6881)
+
+    pieces = download_info.pieces
+    legacy_pieces = [make_legacy_piece(pieces[0], downloaded=True),
+                     make_legacy_piece(pieces[1], block_downloaded=blocks, sources={peer}),
+                     make_legacy_piece(pieces[2], selected=False),
+                     make_legacy_piece(pieces[3], downloaded=True)]
+    state = dict(download_info.__dict__, _pieces=legacy_pieces, downloaded_piece_count=2, _complete=False)
+    del state['recheck_progress']  # Older versions didn't have these fields
+    del state['_piece_availability']
+
+    loaded = pickle.loads(pickle.dumps(LegacyObject(DownloadInfo, state)))
+    assert isinstance(loaded, DownloadInfo)
+    pieces = loaded.pieces
+    assert isinstance(pieces, PieceTable)
+    assert len(pieces) == 4
+    assert [info.piece_hash for info in pieces] == [info.piece_hash for info in download_info.pieces]
+    assert [info.length for info in pieces] == [piece_length] * 3 + [1000]
+    assert pieces.downloaded == bitarray('1001')
+    assert pieces.selected == bitarray('1101')
+    assert list(pieces.partial_piece_indexes) == [1]
+    assert pieces[1].downloaded_blocks == blocks
+    assert pieces[1].sources == {peer}
+    assert loaded.downloaded_piece_count == 2
+    assert loaded.recheck_progress is None
+
+    # The migrated state can be used and saved again
+    loaded.reset_run_state()
+    assert loaded.piece_availability[0] == 0
+    assert pickle.loads(pickle.dumps(loaded)).pieces.downloaded == bitarray('1001')
@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from torrent_client.models import BlockRequest, Peer
+from torrent_client.network.peer_tcp_client import MessageType, PeerTCPClient
+from torrent_client.storage import BaseStorage
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data: bytes):
+        assert not self.closed
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+
+class FailingStorage(BaseStorage):
+    def __init__(self):
+        self.read_started = None  # type: asyncio.Event
+
+    async def read_block(self, piece_index: int, block_begin: int, length: int) -> bytes:
+        self.read_started.set()
+        await asyncio.sleep(0)
+        raise OSError(5, 'Input/output error')
+
+
+def test_failed_block_send_drops_deferred_messages(monkeypatch):
+    bytes_sent_from_file = 10
+    monkeypatch.setattr(PeerTCPClient, 'USE_SENDFILE', True)
+    monkeypatch.setattr(PeerTCPClient, '_send_block_from_file',
+                        lambda self, request, offset, header: bytes_sent_from_file)
+
+    async def run():
+        client = PeerTCPClient(b'\0' * 20, Peer('10.0.0.1', 6881))
+        client._writer = writer = FakeWriter()
+        client._file_structure = storage = FailingStorage()
+        storage.read_started = asyncio.Event()
+        client._download_info = SimpleNamespace(piece_length=2 ** 15)
+
+        task = asyncio.ensure_future(client._send_block(BlockRequest(0, 0, 2 ** 14)))
+        await storage.read_started.wait()
+        client._send_message(MessageType.have, b'\0\0\0\1')  # Deferred until the rest of the block is sent
+
+        with pytest.raises(OSError):
+            await task
+        return writer
+
+    writer = asyncio.run(run())
+    assert writer.closed
+    assert not writer.data  # The part of the block was written by sendfile(), nothing may follow it
@@ -7,12 +7,20 @@ import os
 import re
 import signal
 import sys
+import time
 from contextlib import closing, suppress
 from functools import partial
-from typing import List
+from typing import List, Tuple
 
+from torrent_client.algorithms import Relocator
 from torrent_client.control import ControlManager, ControlClient, ControlServer, DaemonExit, formatters
+from torrent_client.creation import create_torrent, save_torrent
+from torrent_client.file_structure import PREALLOCATION_MODES, STORAGE_MODES
+from torrent_client.hashing import HashingPool, HashingState
+from torrent_client.io_scheduler import IOScheduler, IOSchedulerState
 from torrent_client.models import TorrentInfo, TorrentState
+from torrent_client.network import PeerTCPClient
+from torrent_client.utils import humanize_size, humanize_speed
 
 
 logging.basicConfig(format='%(levelname)s %(asctime)s %(name)-23s %(message)s', datefmt='%H:%M:%S')
@@ -28,7 +36,12 @@ async def check_daemon_absence():
         raise RuntimeError('The daemon is already running')
 
 
-def run_daemon(_):
+def run_daemon(args):
+    if args.sendfile:
+        PeerTCPClient.USE_SENDFILE = True
+    if args.max_dirty_data is not None:
+        IOScheduler.MAX_PENDING_WRITE_BYTES = args.max_dirty_data * 2 ** 20
+
     with closing(asyncio.get_event_loop()) as loop:
         loop.run_until_complete(check_daemon_absence())
 
@@ -70,11 +83,51 @@ def show_handler(args):
     print(content_description, end='')
 
 
+async def create_handler(args):
+    announce_list = [tier.split(',') for tier in args.tracker]
+    filename = args.output
+    if filename is None:
+        filename = os.path.basename(os.path.abspath(args.path)) + '.torrent'
+
+    start_time = time.monotonic()
+    hashed_size = 0
+
+    def on_progress(size: int):
+        nonlocal hashed_size
+        hashed_size = size
+        elapsed = time.monotonic() - start_time
+        if elapsed:
+            print('\rHashed {} ({})'.format(humanize_size(size), humanize_speed(size / elapsed)).ljust(40),
+                  end='', file=sys.stderr, flush=True)
+
+    piece_length = args.piece_length * 2 ** 10 if args.piece_length is not None else None
+    hashing_pool = HashingPool(args.workers)
+    try:
+        dictionary = await create_torrent(args.path, announce_list, hashing_pool, piece_length=piece_length,
+                                          private=args.private, comment=args.comment, on_progress=on_progress)
+    finally:
+        hashing_pool.shutdown()
+    elapsed = time.monotonic() - start_time
+    print(file=sys.stderr)
+    save_torrent(dictionary, filename)
+
+    torrent_info = TorrentInfo.from_file(filename, download_dir=None)
+    content_description = formatters.join_lines(
+        formatters.format_title(torrent_info.download_info, True) +
+        ['Piece length: {}\n'.format(humanize_size(torrent_info.download_info.piece_length)),
+         'Hashing speed: {} ({:.1f} s)\n'.format(humanize_speed(hashed_size / max(elapsed, 1e-3)), elapsed)] +
+        formatters.format_content(torrent_info))
+    print(content_description, end='')
+    print('Saved to "{}"'.format(filename))
+
+
 PATH_SPLIT_RE = re.compile(r'/|{}'.format(re.escape(os.path.sep)))
 
 
 async def add_handler(args):
-    torrents = [TorrentInfo.from_file(filename, download_dir=args.download_dir) for filename in args.filenames]
+    torrents = [TorrentInfo.from_file(filename, download_dir=args.download_dir, storage_mode=args.storage,
+                                      preallocation=args.preallocate)
+                for filename in args.filenames]
 
     if args.include:
         paths = args.include
@@ -97,7 +150,7 @@ async def add_handler(args):
 
     async with ControlClient() as client:
         for info in torrents:
-            await client.execute(partial(ControlManager.add, torrent_info=info))
+            await client.execute(partial(ControlManager.add, torrent_info=info, verify=args.verify))
 
 
 async def control_action_handler(args):
@@ -110,15 +163,36 @@ async def control_action_handler(args):
             await client.execute(partial(action, info_hash=info.download_info.info_hash))
 
 
-def status_server_handler(manager: ControlManager) -> List[TorrentState]:
+async def verify_handler(args):
+    torrents = [TorrentInfo.from_file(filename, download_dir=None) for filename in args.filenames]
+
+    async with ControlClient() as client:
+        for info in torrents:
+            progress = await client.execute(partial(ControlManager.verify, info_hash=info.download_info.info_hash))
+            print(formatters.join_lines(formatters.format_title(info.download_info, False) +
+                                        formatters.format_recheck_result(progress)))
+
+
+async def move_handler(args):
+    torrents = [TorrentInfo.from_file(filename, download_dir=None) for filename in args.filenames]
+    speed_limit = args.speed_limit * 2 ** 20 if args.speed_limit else None
+
+    async with ControlClient() as client:
+        for info in torrents:
+            await client.execute(partial(ControlManager.move, info_hash=info.download_info.info_hash,
+                                         download_dir=os.path.abspath(args.download_dir), speed_limit=speed_limit))
+
+
+def status_server_handler(manager: ControlManager) -> Tuple[List[TorrentState], HashingState, IOSchedulerState]:
     torrents = manager.get_torrents()
     torrents.sort(key=lambda info: info.download_info.suggested_name)
-    return [TorrentState(torrent_info) for torrent_info in torrents]
+    return ([TorrentState(torrent_info) for torrent_info in torrents],
+            manager.get_hashing_state(), manager.get_io_scheduler_state())
 
 
 async def status_handler(args):
     async with ControlClient() as client:
-        torrent_states = await client.execute(status_server_handler)
+        torrent_states, hashing_state, io_scheduler_state = await client.execute(status_server_handler)
     if not torrent_states:
         print('No torrents added')
         return
@@ -126,6 +200,9 @@ async def status_handler(args):
     paragraphs = [formatters.join_lines(formatters.format_title(state, args.verbose) +
                                         formatters.format_status(state, args.verbose))
                   for state in torrent_states]
+    if args.verbose:
+        paragraphs.append(formatters.join_lines(formatters.format_hashing_state(hashing_state)))
+        paragraphs.append(formatters.join_lines(formatters.format_io_scheduler_state(io_scheduler_state)))
     print('\n'.join(paragraphs).rstrip())
 
 
@@ -156,6 +233,12 @@ def main():
                                        metavar='ACTION', dest='action')
 
     subparser = subparsers.add_parser('start', help='Start the daemon')
+    subparser.add_argument('--sendfile', action='store_true',
+                           help='Upload blocks with sendfile() directly from files (reduces CPU usage when seeding)')
+    subparser.add_argument('--max-dirty-data', type=int, metavar='MIB',
+                           help='Stop requesting blocks while this amount of downloaded data (in MiB) '
+                                'waits to be written to disk (default: {})'.format(
+                                    IOScheduler.MAX_PENDING_WRITE_BYTES // 2 ** 20))
     subparser.set_defaults(func=run_daemon)
 
     subparser = subparsers.add_parser('stop', help='Stop the daemon')
@@ -166,16 +249,42 @@ def main():
     subparser.add_argument('filename', help='Torrent file name')
     subparser.set_defaults(func=show_handler)
 
+    subparser = subparsers.add_parser('create', help="Create a torrent file from a file or a directory "
+                                                     "(you don't need to start the daemon for that)")
+    subparser.add_argument('path', help='File or directory to share')
+    subparser.add_argument('-t', '--tracker', action='append', required=True, metavar='URLS',
+                           help='Announce URL (each option adds a tier, several URLs of one tier '
+                                'are separated with commas)')
+    subparser.add_argument('-o', '--output',
+                           help='Torrent file name (default: NAME.torrent in the current directory)')
+    subparser.add_argument('--piece-length', type=int, metavar='KIB',
+                           help='Piece length in KiB, a power of two (default: chosen by the content size)')
+    subparser.add_argument('--private', action='store_true',
+                           help='Forbid getting peers not from the trackers')
+    subparser.add_argument('--comment',
+                           help='Comment stored in the torrent file')
+    subparser.add_argument('--workers', type=int,
+                           help='Number of hashing threads (default: number of CPUs)')
+    subparser.set_defaults(func=partial(run_in_event_loop, create_handler))
+
     subparser = subparsers.add_parser('add', help='Add torrent from file')
     subparser.add_argument('filenames', nargs='+',
                            help='Torrent file names')
     subparser.add_argument('-d', '--download-dir', default=DEFAULT_DOWNLOAD_DIR,
                            help='Download directory')
+    subparser.add_argument('--storage', choices=sorted(STORAGE_MODES), default='files',
+                           help='How to access downloaded files ("mmap" suits large single-file torrents, '
+                                '"memory" and "null" don\'t touch the disk and are meant for benchmarks)')
+    subparser.add_argument('--preallocate', choices=PREALLOCATION_MODES, default='sparse',
+                           help='How to allocate disk space for downloaded files in background '
+                                '("fallocate" and "full" reduce fragmentation)')
     group = subparser.add_mutually_exclusive_group()
     group.add_argument('--include', action='append',
                        help='Download only files and directories specified in "--include" options')
     group.add_argument('--exclude', action='append',
                        help='Download all files and directories except those that specified in "--exclude" options')
+    subparser.add_argument('--verify', action='store_true',
+                           help='Check data that already exists in the download directory before starting')
     subparser.set_defaults(func=partial(run_in_event_loop, add_handler))
 
     control_commands = ['pause', 'resume', 'remove']
@@ -185,6 +294,22 @@ def main():
                                help='Torrent file names')
         subparser.set_defaults(func=partial(run_in_event_loop, control_action_handler))
 
+    subparser = subparsers.add_parser('verify', help='Check downloaded data of a torrent and download '
+                                                     'missing or corrupted pieces again')
+    subparser.add_argument('filenames', nargs='+',
+                           help='Torrent file names')
+    subparser.set_defaults(func=partial(run_in_event_loop, verify_handler))
+
+    subparser = subparsers.add_parser('move', help='Move downloaded files of a torrent to another directory '
+                                                   '(a complete torrent keeps seeding while its files are copied)')
+    subparser.add_argument('filenames', nargs='+',
+                           help='Torrent file names')
+    subparser.add_argument('-d', '--download-dir', required=True,
+                           help='New download directory')
+    subparser.add_argument('--speed-limit', type=int, metavar='MIB', default=Relocator.DEFAULT_SPEED_LIMIT // 2 ** 20,
+                           help='Copying speed limit in MiB/s, 0 means no limit (default: %(default)s)')
+    subparser.set_defaults(func=partial(run_in_event_loop, move_handler))
+
     subparser = subparsers.add_parser('status', help='Show status of all torrents')
     subparser.add_argument('-v', '--verbose', action='store_true',
                            help='Increase output verbosity')
@@ -1 +1,3 @@
 from torrent_client.algorithms.torrent_manager import *
+from torrent_client.algorithms.rechecker import *
+from torrent_client.algorithms.relocator import *
@@ -1,18 +1,19 @@
 import asyncio
-import hashlib
 import logging
 import random
 import time
 from collections import deque, OrderedDict
 from math import ceil
-from typing import List, Optional, Tuple, Iterator
+from typing import Dict, List, Optional, Iterator
+
+from bitarray import bitarray
 
 from torrent_client.algorithms.announcer import Announcer
 from torrent_client.algorithms.peer_manager import PeerData, PeerManager
-from torrent_client.file_structure import FileStructure
 from torrent_client.models import BlockRequestFuture, Peer, TorrentInfo, TorrentState
 from torrent_client.network import EventType
-from torrent_client.utils import floor_to, import_signals
+from torrent_client.storage import BaseStorage
+from torrent_client.utils import floor_to, humanize_size, import_signals
 
 
 QObject, pyqtSignal = import_signals()
@@ -31,7 +32,7 @@ class Downloader(QObject):
         progress = pyqtSignal()
 
     def __init__(self, torrent_info: TorrentInfo, our_peer_id: bytes,
-                 logger: logging.Logger, file_structure: FileStructure,
+                 logger: logging.Logger, file_structure: BaseStorage,
                  peer_manager: PeerManager, announcer: Announcer):
         super().__init__()
 
@@ -48,7 +49,12 @@ class Downloader(QObject):
 
         self._executors_processed_requests = []  # type: List[List[BlockRequestFuture]]
 
-        self._non_started_pieces = None   # type: List[int]
+        self._validation_workers = []  # type: List[asyncio.Task]
+        self._validation_queue = asyncio.Queue()
+        self._validating_piece_count = 0
+        self._validation_error_counts = {}  # type: Dict[int, int]
+
+        self._non_started_pieces = None   # type: bitarray
         self._download_start_time = None  # type: float
 
         self._piece_block_queue = OrderedDict()
@@ -56,16 +62,12 @@ class Downloader(QObject):
         self._endgame_mode = False
         self._tasks_waiting_for_more_peers = 0
         self._request_deque_relevant = asyncio.Event()
+        self._requesting_suspended = False
 
         self._last_piece_finish_signal_time = None  # type: Optional[float]
 
     REQUEST_LENGTH = 2 ** 14
 
-    def _get_piece_position(self, index: int) -> Tuple[int, int]:
-        piece_offset = index * self._download_info.piece_length
-        cur_piece_length = self._download_info.get_real_piece_length(index)
-        return piece_offset, cur_piece_length
-
     FLAG_TRANSMISSION_TIMEOUT = 0.5
 
     def _send_cancels(self, request: BlockRequestFuture):
@@ -78,6 +80,9 @@ class Downloader(QObject):
             if peer in peer_data:
                 peer_data[peer].client.send_request(request, cancel=True)
 
+    def _get_piece_owners(self, piece_index: int) -> List[Peer]:
+        return [peer for peer, data in self._peer_manager.peer_data.items() if data.client.piece_owned[piece_index]]
+
     def _start_downloading_piece(self, piece_index: int):
         piece_info = self._download_info.pieces[piece_index]
 
@@ -93,14 +98,16 @@ class Downloader(QObject):
             request_deque.append(request)
         self._piece_block_queue[piece_index] = request_deque
 
-        self._download_info.interesting_pieces.add(piece_index)
         peer_data = self._peer_manager.peer_data
-        for peer in piece_info.owners:
-            peer_data[peer].client.am_interested = True
+        interesting_pieces = self._download_info.interesting_pieces
+        if piece_index not in interesting_pieces:  # A piece that failed validation stays interesting
+            interesting_pieces.add(piece_index)
+            for peer in self._get_piece_owners(piece_index):
+                peer_data[peer].client.add_interesting_piece()
 
         concurrent_peers_count = sum(1 for peer, data in peer_data.items() if data.queue_size)
         self._logger.debug('piece %s started (owned by %s alive peers, concurrency: %s peers)',
-                           piece_index, len(piece_info.owners), concurrent_peers_count)
+                           piece_index, self._download_info.piece_availability[piece_index], concurrent_peers_count)
 
     PIECE_FINISH_SIGNAL_MIN_INTERVAL = 1
 
@@ -112,13 +119,8 @@ class Downloader(QObject):
 
         self._download_info.interesting_pieces.remove(piece_index)
         peer_data = self._peer_manager.peer_data
-        for peer in piece_info.owners:
-            client = peer_data[peer].client
-            for index in self._download_info.interesting_pieces:
-                if client.piece_owned[index]:
-                    break
-            else:
-                client.am_interested = False
+        for peer in self._get_piece_owners(piece_index):
+            peer_data[peer].client.remove_interesting_piece()
 
         for data in peer_data.values():
             data.client.send_have(piece_index)
@@ -142,10 +144,9 @@ class Downloader(QObject):
 
         assert piece_info.are_all_blocks_downloaded()
 
-        piece_offset, cur_piece_length = self._get_piece_position(piece_index)
-        data = await self._file_structure.read(piece_offset, cur_piece_length)
-        actual_digest = hashlib.sha1(data).digest()
+        actual_digest = await self._file_structure.hash_piece(piece_index)
         if actual_digest == piece_info.piece_hash:
+            await self._file_structure.flush_piece(piece_index)
             self._finish_downloading_piece(piece_index)
             return
 
@@ -154,12 +155,64 @@ class Downloader(QObject):
             self._download_info.increase_distrust(peer)
             if self._download_info.is_banned(peer):
                 self._logger.info('Host %s banned', peer.host)
-                peer_data[peer].client_task.cancel()
+                data = peer_data.get(peer)
+                if data is not None:  # The peer may have already disconnected
+                    data.client_task.cancel()
+
+        self._redownload_piece(piece_index)
+        self._logger.debug('piece %s not valid, redownloading', piece_index)
 
-        piece_info.reset_content()
+    def _redownload_piece(self, piece_index: int):
+        self._file_structure.discard_piece(piece_index)
+        self._download_info.pieces[piece_index].reset_content()
         self._start_downloading_piece(piece_index)
 
-        self._logger.debug('piece %s not valid, redownloading', piece_index)
+    VALIDATION_WORKER_COUNT = 2
+    MAX_VALIDATION_ERRORS = 3
+
+    def _handle_validation_error(self, piece_index: int, err: Exception):
+        """Retries validation of the piece after an I/O error. If the errors repeat, the piece is downloaded again
+        (without blaming its sources, since the data may be fine)."""
+
+        error_count = self._validation_error_counts.get(piece_index, 0) + 1
+        if error_count < Downloader.MAX_VALIDATION_ERRORS:
+            self._logger.warning('failed to validate piece %s, retrying: %r', piece_index, err)
+            self._validation_error_counts[piece_index] = error_count
+            self._enqueue_validation(piece_index)
+            return
+
+        self._logger.warning('failed to validate piece %s, redownloading: %r', piece_index, err)
+        self._validation_error_counts.pop(piece_index, None)
+        self._redownload_piece(piece_index)
+
+    def _enqueue_validation(self, piece_index: int):
+        self._download_info.pieces[piece_index].validating = True
+        self._validating_piece_count += 1
+        self._validation_queue.put_nowait(piece_index)
+
+    async def _execute_validations(self):
+        while True:
+            piece_index = await self._validation_queue.get()
+            error = None
+            try:
+                await self._validate_piece(piece_index)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                # The worker must survive, otherwise the queued pieces will never be validated
+                error = err
+            finally:
+                self._download_info.pieces[piece_index].validating = False
+                self._validating_piece_count -= 1
+
+            if error is None:
+                self._validation_error_counts.pop(piece_index, None)
+            else:
+                self._handle_validation_error(piece_index, error)
+
+            # Executors waiting for more requests may need to redownload the piece or to finish
+            self._request_deque_relevant.set()
+            self._request_deque_relevant.clear()
 
     _INF = float('inf')
 
@@ -179,7 +232,6 @@ class Downloader(QObject):
     def _request_piece_blocks(self, max_pending_count: int, piece_index: int) -> Iterator[BlockRequestFuture]:
         if not max_pending_count:
             return
-        piece_info = self._download_info.pieces[piece_index]
         peer_data = self._peer_manager.peer_data
 
         request_deque = self._piece_block_queue[piece_index]
@@ -195,8 +247,8 @@ class Downloader(QObject):
                 continue
 
             if performer is None or not performer_data.is_free():
-                available_peers = {peer for peer in piece_info.owners
-                                   if peer_data[peer].is_available()}
+                available_peers = {peer for peer, data in peer_data.items()
+                                   if data.client.piece_owned[piece_index] and data.is_available()}
                 if not available_peers:
                     return
                 performer = max(available_peers, key=self.get_peer_download_rate)
@@ -216,19 +268,19 @@ class Downloader(QObject):
 
     def _select_new_piece(self, *, force: bool) -> Optional[int]:
         is_appropriate = PeerData.is_free if force else PeerData.is_available
-        appropriate_peers = {peer for peer, data in self._peer_manager.peer_data.items() if is_appropriate(data)}
-        if not appropriate_peers:
+        appropriate_peers_data = [data for data in self._peer_manager.peer_data.values() if is_appropriate(data)]
+        if not appropriate_peers_data:
             return None
 
-        pieces = self._download_info.pieces
-        available_pieces = [index for index in self._non_started_pieces
-                            if appropriate_peers & pieces[index].owners]
-        if not available_pieces:
+        owned_pieces = bitarray(self._download_info.piece_count)
+        owned_pieces.setall(False)
+        for data in appropriate_peers_data:
+            owned_pieces |= data.client.piece_owned
+        rarest_pieces = self._download_info.piece_availability.select_rarest(
+            owned_pieces & self._non_started_pieces, Downloader.RAREST_PIECE_COUNT_TO_SELECT)
+        if not rarest_pieces:
             return None
-
-        available_pieces.sort(key=lambda index: len(pieces[index].owners))
-        piece_count_to_select = min(len(available_pieces), Downloader.RAREST_PIECE_COUNT_TO_SELECT)
-        return available_pieces[random.randint(0, piece_count_to_select - 1)]
+        return random.choice(rarest_pieces)
 
     _typical_piece_length = 2 ** 20
     _requests_per_piece = ceil(_typical_piece_length / REQUEST_LENGTH)
@@ -253,7 +305,7 @@ class Downloader(QObject):
             piece_stock_small = (piece_stock < Downloader.DESIRED_PIECE_STOCK)
             new_piece_index = self._select_new_piece(force=piece_stock_small)
             if new_piece_index is not None:
-                self._non_started_pieces.remove(new_piece_index)
+                self._non_started_pieces[new_piece_index] = False
                 self._start_downloading_piece(new_piece_index)
 
                 result += list(self._request_piece_blocks(max_pending_count - pending_count, new_piece_index))
@@ -264,7 +316,7 @@ class Downloader(QObject):
                 del self._piece_block_queue[piece_index]
 
         if not result:
-            if not self._piece_block_queue and not self._non_started_pieces:
+            if not self._piece_block_queue and not self._non_started_pieces.any():
                 raise NoRequestsError('No more undistributed requests')
             raise NotEnoughPeersError('No peers to perform a request')
         return result
@@ -299,9 +351,8 @@ class Downloader(QObject):
         self._tasks_waiting_for_more_peers -= 1
 
     def _get_non_finished_pieces(self) -> List[int]:
-        pieces = self._download_info.pieces
-        return [i for i in range(self._download_info.piece_count)
-                if pieces[i].selected and not pieces[i].downloaded]
+        return [index for index, remaining in enumerate(self._download_info.pieces.get_remaining_pieces())
+                if remaining]
 
     async def _wait_more_requests(self):
         if not self._endgame_mode:
@@ -311,6 +362,21 @@ class Downloader(QObject):
 
         await self._request_deque_relevant.wait()
 
+    def _is_requesting_suspended(self) -> bool:
+        """Suspends requesting new blocks while the disks are behind the network and resumes it when they catch up."""
+
+        file_structure = self._file_structure
+        if not self._requesting_suspended and file_structure.is_write_backlog_full():
+            self._requesting_suspended = True
+            write_latency = file_structure.write_latency
+            self._logger.debug('suspending requests: %s waits to be written to disk (write latency %.0f ms)',
+                               humanize_size(file_structure.pending_write_bytes),
+                               write_latency * 1000 if write_latency is not None else 0)
+        elif self._requesting_suspended and file_structure.is_write_backlog_drained():
+            self._requesting_suspended = False
+            self._logger.debug('resuming requests')
+        return self._requesting_suspended
+
     REQUEST_TIMEOUT = 6
     REQUEST_TIMEOUT_ENDGAME = 1
 
@@ -318,7 +384,11 @@ class Downloader(QObject):
         while True:
             try:
                 max_pending_count = PeerData.DOWNLOAD_REQUEST_QUEUE_SIZE - len(processed_requests)
-                if max_pending_count > 0:
+                if self._is_requesting_suspended():
+                    if not processed_requests:
+                        await self._file_structure.wait_write_backlog_drained()
+                        continue
+                elif max_pending_count > 0:
                     processed_requests += self._request_blocks(max_pending_count)
             except NotEnoughPeersError:
                 if not processed_requests:
@@ -326,7 +396,7 @@ class Downloader(QObject):
                     continue
             except NoRequestsError:
                 if not processed_requests:
-                    if not any(self._executors_processed_requests):
+                    if not any(self._executors_processed_requests) and not self._validating_piece_count:
                         self._request_deque_relevant.set()
                         return
                     await self._wait_more_requests()
@@ -348,9 +418,7 @@ class Downloader(QObject):
 
                     piece_info = pieces[request.piece_index]
                     if not piece_info.validating and not piece_info.downloaded and not piece_info.blocks_expected:
-                        piece_info.validating = True
-                        await self._validate_piece(request.piece_index)
-                        piece_info.validating = False
+                        self._enqueue_validation(request.piece_index)
                 processed_requests.clear()
                 processed_requests += list(requests_pending)
             else:
@@ -373,20 +441,21 @@ class Downloader(QObject):
                 self._request_deque_relevant.clear()
 
     async def run(self):
-        self._non_started_pieces = self._get_non_finished_pieces()
+        self._non_started_pieces = self._download_info.pieces.get_remaining_pieces()
         self._download_start_time = time.time()
-        if not self._non_started_pieces:
+        if not self._non_started_pieces.any():
             self._download_info.complete = True
             return
 
-        random.shuffle(self._non_started_pieces)
-
+        for _ in range(Downloader.VALIDATION_WORKER_COUNT):
+            self._validation_workers.append(asyncio.ensure_future(self._execute_validations()))
         for _ in range(Downloader.DOWNLOAD_PEER_COUNT):
             processed_requests = []
             self._executors_processed_requests.append(processed_requests)
             self._request_executors.append(asyncio.ensure_future(self._execute_block_requests(processed_requests)))
 
         await asyncio.wait(self._request_executors)
+        await self._stop_validation_workers()
 
         self._download_info.complete = True
         await self._announcer.try_to_announce(EventType.completed)
@@ -399,8 +468,16 @@ class Downloader(QObject):
         #     if data.client.is_seed():
         #         data.client_task.cancel()
 
+    async def _stop_validation_workers(self):
+        for task in self._validation_workers:
+            task.cancel()
+        if self._validation_workers:
+            await asyncio.wait(self._validation_workers)
+        self._validation_workers.clear()
+
     async def stop(self):
         for task in self._request_executors:
             task.cancel()
         if self._request_executors:
             await asyncio.wait(self._request_executors)
+        await self._stop_validation_workers()
@@ -3,12 +3,14 @@ import logging
 import time
 from typing import Dict, Optional, Sequence
 
-from torrent_client.file_structure import FileStructure
 from torrent_client.models import Peer, TorrentInfo
 from torrent_client.network import PeerTCPClient
+from torrent_client.storage import BaseStorage
 
 
 class PeerData:
+    __slots__ = ('_client', '_client_task', '_connected_time', 'hanged_time', 'queue_size')
+
     DOWNLOAD_REQUEST_QUEUE_SIZE = 150
 
     def __init__(self, client: PeerTCPClient, client_task: asyncio.Task, connected_time: float):
@@ -39,7 +41,7 @@ class PeerData:
 
 class PeerManager:
     def __init__(self, torrent_info: TorrentInfo, our_peer_id: bytes,
-                 logger: logging.Logger, file_structure: FileStructure):
+                 logger: logging.Logger, file_structure: BaseStorage):
         # self._torrent_info = torrent_info
         self._download_info = torrent_info.download_info
         self._statistics = self._download_info.session_statistics
@@ -81,9 +83,7 @@ class PeerManager:
                 self._statistics.peer_count -= 1
                 del self._peer_data[peer]
 
-                for info in self._download_info.pieces:
-                    if peer in info.owners:
-                        info.owners.remove(peer)
+                self._download_info.piece_availability.subtract(client.piece_owned)
                 if peer in self._statistics.peer_last_download:
                     del self._statistics.peer_last_download[peer]
                 if peer in self._statistics.peer_last_upload:
@@ -0,0 +1,66 @@
+import logging
+
+from torrent_client.file_structure import create_file_structure
+from torrent_client.hashing import HashingPool
+from torrent_client.io_scheduler import IOScheduler
+from torrent_client.models import RecheckProgress, TorrentInfo
+
+
+__all__ = ['Rechecker']
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Rechecker:
+    """Verifies data of a stopped torrent, so pieces already present on disk aren't downloaded again
+    and corrupted pieces are downloaded anew."""
+
+    def __init__(self, torrent_info: TorrentInfo, hashing_pool: HashingPool, io_scheduler: IOScheduler):
+        self._torrent_info = torrent_info
+        self._download_info = torrent_info.download_info
+        self._hashing_pool = hashing_pool
+        self._io_scheduler = io_scheduler
+
+        self._progress = None  # type: RecheckProgress
+
+    def _on_piece_checked(self, piece_index: int, is_valid: bool):
+        download_info = self._download_info
+        piece_info = download_info.pieces[piece_index]
+
+        progress = self._progress
+        progress.checked_size += piece_info.length
+        progress.checked_piece_count += 1
+        if is_valid:
+            progress.valid_piece_count += 1
+            if not piece_info.downloaded:
+                piece_info.mark_as_downloaded()
+                download_info.downloaded_piece_count += 1
+        elif piece_info.has_downloaded_blocks():
+            if piece_info.downloaded:
+                download_info.downloaded_piece_count -= 1
+            piece_info.reset_content()
+
+    async def run(self) -> RecheckProgress:
+        torrent_info = self._torrent_info
+        download_info = self._download_info
+        download_info.reset_run_state()  # Drops hash objects of partially downloaded pieces
+
+        self._progress = RecheckProgress(download_info.total_size, download_info.piece_count)
+        download_info.recheck_progress = self._progress
+        file_structure = create_file_structure(torrent_info.storage_mode, torrent_info.download_dir, download_info,
+                                               self._hashing_pool, self._io_scheduler,
+                                               preallocation=torrent_info.preallocation)
+        try:
+            await file_structure.recheck(range(download_info.piece_count), self._on_piece_checked)
+        finally:
+            await file_structure.close()
+            self._progress.finish()
+            download_info.recheck_progress = None
+            download_info.complete = not download_info.pieces.get_remaining_pieces().any()
+
+        progress = self._progress
+        logger.info('"%s" checked: %s/%s pieces are valid (%.1f s)', download_info.suggested_name,
+                    progress.valid_piece_count, progress.piece_count, progress.elapsed_time)
+        return progress
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import suppress
+from typing import List, Optional, Tuple
+
+from torrent_client.file_structure import create_file_structure, get_file_path
+from torrent_client.hashing import HashingPool
+from torrent_client.io_scheduler import IOClass, IOScheduler
+from torrent_client.models import TorrentInfo
+from torrent_client.utils import humanize_size, humanize_speed
+
+
+__all__ = ['Relocator']
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Relocator:
+    """Copies files of a torrent to another download directory and removes the original files later.
+
+    The copy is made in background chunks with a bandwidth cap, so the torrent keeps seeding from the old location
+    and uploads aren't starved of disk I/O. The copy is verified with piece hashes before anyone switches to it.
+    The torrent must not be written to during the copy (i.e. it must be either paused or complete).
+    """
+
+    CHUNK_SIZE = 2 ** 22  # = 4 MiB
+    TRUNCATE_STEP = 2 ** 24  # = 16 MiB
+    DEFAULT_SPEED_LIMIT = 2 ** 26  # = 64 MiB/s
+
+    def __init__(self, torrent_info: TorrentInfo, download_dir: str, hashing_pool: HashingPool,
+                 io_scheduler: IOScheduler, *, speed_limit: Optional[int]=DEFAULT_SPEED_LIMIT):
+        self._torrent_info = torrent_info
+        self._download_info = torrent_info.download_info
+        self._download_dir = download_dir
+        self._hashing_pool = hashing_pool
+        self._io_scheduler = io_scheduler
+        self._speed_limit = speed_limit
+
+        self._copied_size = 0
+
+    def _get_copied_files(self) -> List[Tuple[str, str, int]]:
+        """Returns sources, destinations and lengths of the files that exist in the old location."""
+
+        result = []
+        for file in self._download_info.files:
+            source = get_file_path(self._torrent_info.download_dir, self._download_info, file)
+            destination = get_file_path(self._download_dir, self._download_info, file)
+            if not os.path.isfile(source):
+                continue  # Files without selected pieces may be never created
+            if os.path.lexists(destination):
+                raise ValueError('File "{}" already exists'.format(destination))
+            result.append((source, destination, os.path.getsize(source)))
+        return result
+
+    @staticmethod
+    def _create_destination(destination: str, length: int):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, 'xb') as f:
+            f.truncate(length)
+
+    @staticmethod
+    def _copy_range(source: str, destination: str, position: int, length: int):
+        with open(source, 'rb', buffering=0) as src, open(destination, 'r+b', buffering=0) as dst:
+            data = os.pread(src.fileno(), length, position)
+            if len(data) != length:
+                raise OSError('File "{}" was truncated while copying'.format(source))
+            view = memoryview(data)
+            while view:
+                bytes_written = os.pwrite(dst.fileno(), view, position)
+                view = view[bytes_written:]
+                position += bytes_written
+
+    @staticmethod
+    def _sync_file(destination: str):
+        with open(destination, 'rb') as f:
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _remove_files(paths: List[str], root: str):
+        """Removes the files and then their parent directories up to `root` (inclusively) if they become empty."""
+
+        directories = set()
+        for path in paths:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            directory = os.path.dirname(path)
+            while len(directory) >= len(root):
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+        for directory in sorted(directories, key=len, reverse=True):
+            with suppress(OSError):
+                os.rmdir(directory)
+
+    @staticmethod
+    def _shrink_file(path: str, length: int) -> int:
+        """Cuts off the tail of the file and returns its new length."""
+
+        try:
+            with open(path, 'r+b') as f:
+                length = max(0, min(length, os.fstat(f.fileno()).st_size) - Relocator.TRUNCATE_STEP)
+                f.truncate(length)
+        except FileNotFoundError:
+            return 0
+        return length
+
+    def _get_root(self, download_dir: str) -> str:
+        return os.path.join(download_dir, self._download_info.suggested_name)
+
+    async def _run_job(self, func, *args):
+        return await self._io_scheduler.run(self, IOClass.background, lambda: func(*args))
+
+    async def _throttle(self, start_time: float):
+        if self._speed_limit is None:
+            return
+        delay = start_time + self._copied_size / self._speed_limit - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _copy_files(self, files: List[Tuple[str, str, int]]):
+        start_time = time.monotonic()
+        for source, destination, length in files:
+            await self._run_job(Relocator._create_destination, destination, length)
+            for position in range(0, length, Relocator.CHUNK_SIZE):
+                chunk_length = min(Relocator.CHUNK_SIZE, length - position)
+                await self._run_job(Relocator._copy_range, source, destination, position, chunk_length)
+                self._copied_size += chunk_length
+                await self._throttle(start_time)
+            await self._run_job(Relocator._sync_file, destination)
+
+    async def _verify_copy(self):
+        torrent_info = self._torrent_info
+        download_info = self._download_info
+        invalid_pieces = []
+
+        def on_piece_checked(piece_index: int, is_valid: bool):
+            if not is_valid:
+                invalid_pieces.append(piece_index)
+
+        file_structure = create_file_structure(torrent_info.storage_mode, self._download_dir, download_info,
+                                               self._hashing_pool, self._io_scheduler,
+                                               preallocation=torrent_info.preallocation)
+        try:
+            await file_structure.recheck([index for index, downloaded in enumerate(download_info.pieces.downloaded)
+                                          if downloaded], on_piece_checked)
+        finally:
+            await file_structure.close()
+        if invalid_pieces:
+            raise RuntimeError('The copy is corrupted ({} pieces failed the check)'.format(len(invalid_pieces)))
+
+    async def copy(self):
+        """Makes and verifies a copy of the files. If something goes wrong, the partial copy is removed."""
+
+        start_time = time.monotonic()
+        files = await self._run_job(self._get_copied_files)
+        try:
+            await self._copy_files(files)
+            await self._verify_copy()
+        except BaseException:
+            # Done right away, because the task may be cancelled during the daemon shutdown
+            Relocator._remove_files([destination for _, destination, _ in files], self._get_root(self._download_dir))
+            raise
+
+        elapsed = time.monotonic() - start_time
+        logger.info('"%s" copied to "%s": %s in %.1f s (%s)', self._download_info.suggested_name, self._download_dir,
+                    humanize_size(self._copied_size), elapsed, humanize_speed(self._copied_size / max(elapsed, 1e-3)))
+
+    async def remove_sources(self, old_download_dir: str):
+        paths = [get_file_path(old_download_dir, self._download_info, file) for file in self._download_info.files]
+        try:
+            # Freeing extents of a large file may take seconds, so the files are shrunk step by step
+            # to let other background operations run in between
+            for path, file in zip(paths, self._download_info.files):
+                length = file.length
+                while length:
+                    length = await self._run_job(Relocator._shrink_file, path, length)
+            await self._run_job(Relocator._remove_files, paths, self._get_root(old_download_dir))
+        except OSError as err:
+            logger.warning('Failed to remove old files of "%s": %r', self._download_info.suggested_name, err)
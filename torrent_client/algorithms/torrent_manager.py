@@ -1,14 +1,17 @@
 import asyncio
 import logging
 import random
-from typing import List, Optional
+import time
+from typing import Iterable, List, Optional
 
 from torrent_client.algorithms.announcer import Announcer
 from torrent_client.algorithms.downloader import Downloader
 from torrent_client.algorithms.peer_manager import PeerManager
 from torrent_client.algorithms.speed_measurer import SpeedMeasurer
 from torrent_client.algorithms.uploader import Uploader
-from torrent_client.file_structure import FileStructure
+from torrent_client.file_structure import create_file_structure
+from torrent_client.hashing import HashingPool
+from torrent_client.io_scheduler import IOScheduler
 from torrent_client.models import Peer, TorrentInfo, DownloadInfo
 from torrent_client.network import EventType, PeerTCPClient
 from torrent_client.utils import import_signals
@@ -27,7 +30,8 @@ class TorrentManager(QObject):
     LOGGER_LEVEL = logging.DEBUG
     SHORT_NAME_LEN = 19
 
-    def __init__(self, torrent_info: TorrentInfo, our_peer_id: bytes, server_port: Optional[int]):
+    def __init__(self, torrent_info: TorrentInfo, our_peer_id: bytes, server_port: Optional[int],
+                 hashing_pool: HashingPool, io_scheduler: IOScheduler):
         super().__init__()
 
         self._torrent_info = torrent_info
@@ -43,7 +47,10 @@ class TorrentManager(QObject):
 
         self._executors = []  # type: List[asyncio.Task]
 
-        self._file_structure = FileStructure(torrent_info.download_dir, torrent_info.download_info)
+        self._file_structure = create_file_structure(torrent_info.storage_mode,
+                                                     torrent_info.download_dir, torrent_info.download_info,
+                                                     hashing_pool, io_scheduler,
+                                                     preallocation=torrent_info.preallocation)
 
         self._peer_manager = PeerManager(torrent_info, our_peer_id, self._logger, self._file_structure)
         self._announcer = Announcer(torrent_info, our_peer_id, server_port, self._logger, self._peer_manager)
@@ -61,7 +68,22 @@ class TorrentManager(QObject):
         for tier in self._torrent_info.announce_list:
             random.shuffle(tier)
 
+    async def _preallocate(self):
+        start_time = time.time()
+        try:
+            await self._file_structure.preallocate()
+        except OSError as e:
+            # The download can proceed anyway (unless the disk is actually full)
+            self._logger.warning('preallocation failed: %r', e)
+            return
+        if self._torrent_info.preallocation != 'sparse':
+            self._logger.info('preallocation (%s) finished in %.1f s',
+                              self._torrent_info.preallocation, time.time() - start_time)
+
     async def run(self):
+        await self._file_structure.create_empty_files()
+        self._executors.append(asyncio.ensure_future(self._preallocate()))
+
         self._shuffle_announce_tiers()
         while not await self._announcer.try_to_announce(EventType.started):
             await asyncio.sleep(TorrentManager.ANNOUNCE_FAILED_SLEEP_TIME)
@@ -80,6 +102,16 @@ class TorrentManager(QObject):
     def accept_client(self, peer: Peer, client: PeerTCPClient):
         self._peer_manager.accept_client(peer, client)
 
+    def relocate(self, download_dir: str):
+        self._file_structure.relocate(download_dir)
+
+    async def wait_old_files_released(self):
+        await self._file_structure.wait_old_files_released()
+
+    @property
+    def unflushed_pieces(self) -> Iterable[int]:
+        return self._file_structure.unflushed_pieces
+
     async def stop(self):
         await self._downloader.stop()
         await self._peer_manager.stop()
@@ -89,3 +121,5 @@ class TorrentManager(QObject):
             task.cancel()
         if executors:
             await asyncio.wait(executors)
+
+        await self._file_structure.close()
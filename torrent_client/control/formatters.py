@@ -1,7 +1,9 @@
 from math import floor
 from typing import Iterable, List, Union
 
-from torrent_client.models import DownloadInfo, TorrentInfo, TorrentState
+from torrent_client.hashing import HashingState
+from torrent_client.io_scheduler import IOSchedulerState
+from torrent_client.models import DownloadInfo, RecheckProgress, TorrentInfo, TorrentState
 from torrent_client.utils import humanize_size, humanize_speed, floor_to, humanize_time
 
 
@@ -49,20 +51,32 @@ def format_status(state: TorrentState, long_format: bool) -> List[str]:
             state.selected_file_count, state.total_file_count, state.selected_piece_count, state.total_piece_count))
         lines.append('Directory: {}\n'.format(state.download_dir))
 
-        if state.paused:
+        if state.checking_progress is not None:
+            general_status = 'Checking\n'
+        elif state.paused:
             general_status = 'Paused\n'
         elif state.complete:
             general_status = 'Uploading\n'
         else:
             general_status = 'Downloading\t'
         lines.append('State: ' + general_status)
-        if not state.paused and not state.complete:
+        if state.checking_progress is None and not state.paused and not state.complete:
             eta_seconds = state.eta_seconds
             lines.append('ETA: {}\n'.format(humanize_time(eta_seconds) if eta_seconds is not None else 'unknown'))
 
         lines.append('Download from: {}/{} peers\t'.format(state.downloading_peer_count, state.total_peer_count))
         lines.append('Upload to: {}/{} peers\n'.format(state.uploading_peer_count, state.total_peer_count))
 
+        cache_requests = state.upload_cache_hits + state.upload_cache_misses
+        if cache_requests:
+            lines.append('Upload cache: {} hits, {} misses ({:.1f}% hit rate)\n'.format(
+                state.upload_cache_hits, state.upload_cache_misses, state.upload_cache_hits / cache_requests * 100))
+
+    if state.checking_progress is not None:
+        lines.append('Checked: {:.1f}%\t'.format(floor_to(state.checking_progress * 100, 1)))
+        lines.append('Checking speed: {}\n'.format(
+            humanize_speed(state.checking_speed) if state.checking_speed is not None else 'unknown'))
+
     lines.append('Download speed: {}\t'.format(
         humanize_speed(state.download_speed) if state.download_speed is not None else 'unknown'))
     lines.append('Upload speed: {}\n'.format(
@@ -76,3 +90,44 @@ def format_status(state: TorrentState, long_format: bool) -> List[str]:
     lines.append('Progress: {:5.1f}% [{}]\n'.format(floor_to(progress * 100, 1), progress_bar))
 
     return lines
+
+
+def format_recheck_result(progress: RecheckProgress) -> List[str]:
+    return [
+        'Valid: {}/{} pieces\n'.format(progress.valid_piece_count, progress.piece_count),
+        'Checked: {} in {}\n'.format(humanize_size(progress.checked_size), humanize_time(progress.elapsed_time)),
+        'Checking speed: {}\n'.format(humanize_speed(progress.speed) if progress.speed is not None else 'unknown'),
+    ]
+
+
+def format_hashing_state(state: HashingState) -> List[str]:
+    return [
+        'Hashing: {} running, {} queued jobs ({} workers)\n'.format(
+            state.running_job_count, state.queued_job_count, state.worker_count),
+        'Hashed: {}\t'.format(humanize_size(state.hashed_bytes)),
+        'Hashing speed: {}\n'.format(
+            humanize_speed(state.hashing_speed) if state.hashing_speed is not None else 'unknown'),
+    ]
+
+
+def format_latency_bound(latency: float) -> str:
+    if latency == float('inf'):
+        return 'longer'
+    return '< {:.0f} ms'.format(latency * 1000)
+
+
+def format_io_scheduler_state(state: IOSchedulerState) -> List[str]:
+    lines = ['Disk I/O ({} workers):\n'.format(state.worker_count)]
+    for io_class, class_state in state.classes.items():
+        line = INDENT + '{}: {} running, {} queued, {} done'.format(
+            io_class.name.replace('_', ' ').capitalize(),
+            class_state.running_count, class_state.queued_count, class_state.completed_count)
+        if class_state.completed_count:
+            line += ', latency: median {}, 99% {}'.format(format_latency_bound(class_state.median_latency),
+                                                          format_latency_bound(class_state.p99_latency))
+        lines.append(line + '\n')
+    lines.append('Pending writes: {} (limit {})\t'.format(humanize_size(state.pending_write_bytes),
+                                                          humanize_size(state.max_pending_write_bytes)))
+    lines.append('Write latency: {}\n'.format(
+        '{:.0f} ms'.format(state.write_latency * 1000) if state.write_latency is not None else 'unknown'))
+    return lines
@@ -3,10 +3,15 @@ import copy
 import logging
 import os
 import pickle
+from contextlib import suppress
 from typing import Dict, List, Optional
 
-from torrent_client.algorithms import TorrentManager
-from torrent_client.models import generate_peer_id, TorrentInfo, TorrentState
+from torrent_client.algorithms import Rechecker, Relocator, TorrentManager
+from torrent_client.fast_resume import FastResumeRecord, get_file_fingerprints
+from torrent_client.file_structure import STORAGE_MODES
+from torrent_client.hashing import HashingPool, HashingState
+from torrent_client.io_scheduler import IOClass, IOScheduler, IOSchedulerState
+from torrent_client.models import generate_peer_id, RecheckProgress, TorrentInfo, TorrentState
 from torrent_client.network import PeerTCPServer
 from torrent_client.utils import import_signals
 
@@ -18,6 +23,7 @@ __all__ = ['ControlManager']
 
 
 state_filename = os.path.expanduser('~/.torrent_gui_state')
+fast_resume_dirname = os.path.expanduser('~/.torrent_gui_resume')
 
 
 logger = logging.getLogger(__name__)
@@ -40,8 +46,12 @@ class ControlManager(QObject):
         self._torrent_managers = {}  # type: Dict[bytes, TorrentManager]
 
         self._server = PeerTCPServer(self._our_peer_id, self._torrent_managers)
+        self._hashing_pool = HashingPool()
+        self._io_scheduler = IOScheduler()
 
         self._torrent_manager_executors = {}  # type: Dict[bytes, asyncio.Task]
+        self._recheck_executors = {}          # type: Dict[bytes, asyncio.Task]
+        self._move_executors = {}             # type: Dict[bytes, asyncio.Task]
         self._state_updating_executor = None  # type: Optional[asyncio.Task]
 
         self.last_torrent_dir = None   # type: Optional[str]
@@ -50,24 +60,135 @@ class ControlManager(QObject):
     def get_torrents(self) -> List[TorrentInfo]:
         return list(self._torrents.values())
 
+    def get_hashing_state(self) -> HashingState:
+        return HashingState(self._hashing_pool)
+
+    def get_io_scheduler_state(self) -> IOSchedulerState:
+        return IOSchedulerState(self._io_scheduler)
+
     async def start(self):
         await self._server.start()
 
     def _start_torrent_manager(self, torrent_info: TorrentInfo):
         info_hash = torrent_info.download_info.info_hash
 
-        manager = TorrentManager(torrent_info, self._our_peer_id, self._server.port)
+        manager = TorrentManager(torrent_info, self._our_peer_id, self._server.port, self._hashing_pool,
+                                 self._io_scheduler)
         if pyqtSignal:
             manager.state_changed.connect(lambda: self.torrent_changed.emit(TorrentState(torrent_info)))
         self._torrent_managers[info_hash] = manager
         self._torrent_manager_executors[info_hash] = asyncio.ensure_future(manager.run())
 
-    def add(self, torrent_info: TorrentInfo):
+    @staticmethod
+    def _get_fast_resume_filename(info_hash: bytes) -> str:
+        return os.path.join(fast_resume_dirname, info_hash.hex() + '.resume')
+
+    async def _save_fast_resume(self, torrent_info: TorrentInfo):
+        """Saves the download state of a stopped torrent along with fingerprints of its files."""
+
+        if not STORAGE_MODES[torrent_info.storage_mode].PERSISTENT:
+            return
+        download_info = torrent_info.download_info
+        record = FastResumeRecord.from_download_info(download_info, [])
+        filename = self._get_fast_resume_filename(download_info.info_hash)
+
+        def save():
+            record.fingerprints = get_file_fingerprints(torrent_info.download_dir, download_info)
+            record.save(filename)
+
+        try:
+            await self._io_scheduler.run(self, IOClass.background, save)
+        except OSError as err:
+            logger.warning('Failed to save fast resume record of "%s": %r', download_info.suggested_name, err)
+
+    def _load_fast_resume(self, torrent_info: TorrentInfo) -> bool:
+        """Restores the download state of a torrent from its fast resume record.
+        Returns False if the data on disk can't be trusted and should be rechecked."""
+
+        if not STORAGE_MODES[torrent_info.storage_mode].PERSISTENT:
+            return True
+        download_info = torrent_info.download_info
+        try:
+            record = FastResumeRecord.load(self._get_fast_resume_filename(download_info.info_hash))
+            if record is None:
+                return True  # The torrent was saved by an older version, the state is trusted as before
+            fingerprints = get_file_fingerprints(torrent_info.download_dir, download_info)
+        except (OSError, ValueError) as err:
+            logger.warning('Failed to load fast resume record of "%s": %r', download_info.suggested_name, err)
+            return False
+
+        if not record.matches(download_info, fingerprints):
+            logger.info('files of "%s" were changed while it was stopped', download_info.suggested_name)
+            return False
+        record.apply(download_info)
+        return True
+
+    async def _execute_recheck(self, torrent_info: TorrentInfo, resume: bool) -> RecheckProgress:
+        info_hash = torrent_info.download_info.info_hash
+
+        cancelled = False
+        try:
+            progress = await Rechecker(torrent_info, self._hashing_pool, self._io_scheduler).run()
+            await self._save_fast_resume(torrent_info)
+            return progress
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            del self._recheck_executors[info_hash]
+            if resume and not cancelled:
+                self._start_torrent_manager(torrent_info)
+            if pyqtSignal:
+                self.torrent_changed.emit(TorrentState(torrent_info))
+
+    def _start_recheck(self, torrent_info: TorrentInfo, resume: bool) -> asyncio.Task:
+        info_hash = torrent_info.download_info.info_hash
+
+        task = asyncio.ensure_future(self._execute_recheck(torrent_info, resume))
+        self._recheck_executors[info_hash] = task
+        return task
+
+    def _check_idle(self, info_hash: bytes):
+        if info_hash in self._recheck_executors:
+            raise ValueError('The torrent is being checked')
+        if info_hash in self._move_executors:
+            raise ValueError('The torrent is being moved')
+
+    async def _execute_move(self, torrent_info: TorrentInfo, download_dir: str, speed_limit: Optional[int]):
+        info_hash = torrent_info.download_info.info_hash
+
+        try:
+            relocator = Relocator(torrent_info, download_dir, self._hashing_pool, self._io_scheduler,
+                                  speed_limit=speed_limit)
+            await relocator.copy()
+
+            # The torrent switches to the new files at once, it kept seeding from the old ones until now
+            old_download_dir = torrent_info.download_dir
+            torrent_info.download_dir = download_dir
+            manager = self._torrent_managers.get(info_hash)
+            if manager is not None:
+                manager.relocate(download_dir)
+            await self._save_fast_resume(torrent_info)
+
+            if manager is not None:
+                # Uploads started before the switch may still read the old files, and shrinking a file
+                # that is still mapped to memory leads to SIGBUS
+                await manager.wait_old_files_released()
+            await relocator.remove_sources(old_download_dir)
+        finally:
+            del self._move_executors[info_hash]
+            if pyqtSignal:
+                self.torrent_changed.emit(TorrentState(torrent_info))
+
+    def add(self, torrent_info: TorrentInfo, *, verify: bool=False):
         info_hash = torrent_info.download_info.info_hash
         if info_hash in self._torrents:
             raise ValueError('This torrent is already added')
 
-        if not torrent_info.paused:
+        if verify:
+            # The torrent will be started after the check
+            self._start_recheck(torrent_info, not torrent_info.paused)
+        elif not torrent_info.paused:
             self._start_torrent_manager(torrent_info)
         self._torrents[info_hash] = torrent_info
 
@@ -77,6 +198,7 @@ class ControlManager(QObject):
     def resume(self, info_hash: bytes):
         if info_hash not in self._torrents:
             raise ValueError('Torrent not found')
+        self._check_idle(info_hash)
         torrent_info = self._torrents[info_hash]
         if not torrent_info.paused:
             raise ValueError('The torrent is already running')
@@ -104,11 +226,14 @@ class ControlManager(QObject):
     async def remove(self, info_hash: bytes):
         if info_hash not in self._torrents:
             raise ValueError('Torrent not found')
+        self._check_idle(info_hash)
         torrent_info = self._torrents[info_hash]
 
         del self._torrents[info_hash]
         if not torrent_info.paused:
             await self._stop_torrent_manager(info_hash)
+        with suppress(FileNotFoundError):
+            os.remove(self._get_fast_resume_filename(info_hash))
 
         if pyqtSignal:
             self.torrent_removed.emit(info_hash)
@@ -116,23 +241,75 @@ class ControlManager(QObject):
     async def pause(self, info_hash: bytes):
         if info_hash not in self._torrents:
             raise ValueError('Torrent not found')
+        self._check_idle(info_hash)
         torrent_info = self._torrents[info_hash]
         if torrent_info.paused:
             raise ValueError('The torrent is already paused')
 
         await self._stop_torrent_manager(info_hash)
+        await self._save_fast_resume(torrent_info)
 
         torrent_info.paused = True
 
         if pyqtSignal:
             self.torrent_changed.emit(TorrentState(torrent_info))
 
+    async def verify(self, info_hash: bytes) -> RecheckProgress:
+        """Checks data of the torrent stored on disk. A running torrent is stopped for the check."""
+
+        if info_hash not in self._torrents:
+            raise ValueError('Torrent not found')
+        self._check_idle(info_hash)
+        torrent_info = self._torrents[info_hash]
+
+        if not torrent_info.paused:
+            await self._stop_torrent_manager(info_hash)
+        task = self._start_recheck(torrent_info, not torrent_info.paused)
+        if pyqtSignal:
+            self.torrent_changed.emit(TorrentState(torrent_info))
+
+        # The check goes on even if the client that requested it disconnects
+        return await asyncio.shield(task)
+
+    async def move(self, info_hash: bytes, download_dir: str, *,
+                   speed_limit: Optional[int]=Relocator.DEFAULT_SPEED_LIMIT):
+        """Moves files of the torrent to another download directory. A running torrent keeps seeding
+        from the old location until the copy is verified. `speed_limit` is given in bytes/s."""
+
+        if info_hash not in self._torrents:
+            raise ValueError('Torrent not found')
+        self._check_idle(info_hash)
+        torrent_info = self._torrents[info_hash]
+        if not torrent_info.paused and not torrent_info.download_info.complete:
+            raise ValueError('Only paused or complete torrents can be moved')
+        download_dir = os.path.abspath(download_dir)
+        if download_dir == os.path.abspath(torrent_info.download_dir):
+            raise ValueError('The torrent is already in this directory')
+
+        if not STORAGE_MODES[torrent_info.storage_mode].PERSISTENT:
+            torrent_info.download_dir = download_dir  # There is nothing to copy
+            return
+
+        task = asyncio.ensure_future(self._execute_move(torrent_info, download_dir, speed_limit))
+        self._move_executors[info_hash] = task
+
+        # The move goes on even if the client that requested it disconnects
+        await asyncio.shield(task)
+
     def _dump_state(self):
         torrent_list = []
-        for manager, torrent_info in self._torrents.items():
+        for info_hash, torrent_info in self._torrents.items():
             torrent_info = copy.copy(torrent_info)
-            torrent_info.download_info = copy.copy(torrent_info.download_info)
-            torrent_info.download_info.reset_run_state()
+            download_info = torrent_info.download_info = copy.copy(torrent_info.download_info)
+            download_info.reset_run_state()
+
+            manager = self._torrent_managers.get(info_hash)
+            if manager is not None:
+                # Blocks of these pieces are only in memory and would be lost if the daemon is killed,
+                # so they must be downloaded again after restart
+                for piece_index in manager.unflushed_pieces:
+                    download_info.pieces[piece_index].reset_content()
+
             torrent_list.append(torrent_info)
 
         try:
@@ -161,13 +338,16 @@ class ControlManager(QObject):
             self.last_torrent_dir, self.last_download_dir, torrent_list = pickle.load(f)
 
         for torrent_info in torrent_list:
-            self.add(torrent_info)
+            # The torrent is checked if its files were modified while the daemon wasn't running
+            self.add(torrent_info, verify=not self._load_fast_resume(torrent_info))
         logger.info('state recovered (%s torrents)', len(torrent_list))
 
     async def stop(self):
         await self._server.stop()
 
-        tasks = list(self._torrent_manager_executors.values())
+        rechecked_torrents = set(self._recheck_executors.keys())
+        tasks = (list(self._torrent_manager_executors.values()) + list(self._recheck_executors.values()) +
+                 list(self._move_executors.values()))
         if self._state_updating_executor is not None:
             tasks.append(self._state_updating_executor)
 
@@ -179,5 +359,13 @@ class ControlManager(QObject):
         if self._torrent_managers:
             await asyncio.wait([manager.stop() for manager in self._torrent_managers.values()])
 
+        # Torrents whose recheck was interrupted are checked again on the next start
+        for info_hash, torrent_info in self._torrents.items():
+            if info_hash not in rechecked_torrents:
+                await self._save_fast_resume(torrent_info)
+
+        self._hashing_pool.shutdown()
+        self._io_scheduler.shutdown()
+
         if self._state_updating_executor is not None:  # Only if we have loaded starting state
             self._dump_state()
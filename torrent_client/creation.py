@@ -0,0 +1,175 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, List, Optional, Tuple
+
+import bencodepy
+
+from torrent_client.hashing import HashingPool, sha1_digest
+
+
+__all__ = ['choose_piece_length', 'create_torrent', 'save_torrent']
+
+
+MIN_PIECE_LENGTH = 2 ** 18  # = 256 KiB
+MAX_PIECE_LENGTH = 2 ** 24  # = 16 MiB
+MAX_PIECE_COUNT = 2000
+
+READ_CHUNK_SIZE = 2 ** 23  # = 8 MiB, size of sequential reads performed by the workers
+QUEUED_CHUNKS_PER_WORKER = 2
+
+
+SourceFile = Tuple[str, int]  # Real path and length
+
+
+def choose_piece_length(total_size: int) -> int:
+    """Chooses the smallest piece length (a power of two) that keeps the piece count reasonable,
+    so the info dictionary stays small and peers don't exchange too many HAVE messages."""
+
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and total_size > piece_length * MAX_PIECE_COUNT:
+        piece_length *= 2
+    return piece_length
+
+
+def collect_files(path: str) -> List[Tuple[List[str], SourceFile]]:
+    """Returns regular files of the directory (in the order they will be stored in the torrent)
+    along with their paths relative to it."""
+
+    result = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            real_path = os.path.join(dirpath, name)
+            if not os.path.isfile(real_path):
+                continue
+            relative_path = os.path.relpath(real_path, path).split(os.sep)
+            result.append((relative_path, (real_path, os.path.getsize(real_path))))
+    return result
+
+
+_worker_buffers = threading.local()  # Reused by each worker thread to avoid page faults on every chunk
+
+
+def _hash_range(files: List[SourceFile], begin: int, end: int, piece_length: int) -> bytes:
+    """Reads the range of the concatenated files (it must start at a piece boundary)
+    and returns digests of its pieces."""
+
+    buffer = getattr(_worker_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < end - begin:
+        buffer = _worker_buffers.buffer = bytearray(end - begin)
+    view = memoryview(buffer)[:end - begin]
+    pos = 0
+    file_offset = 0
+    for real_path, length in files:
+        file_begin = max(begin, file_offset)
+        file_end = min(end, file_offset + length)
+        if file_begin < file_end:
+            with open(real_path, 'rb', buffering=0) as f:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                f.seek(file_begin - file_offset)
+                while pos < file_end - begin:
+                    read_length = f.readinto(view[pos:file_end - begin])
+                    if not read_length:
+                        raise ValueError('File "{}" was truncated while hashing'.format(real_path))
+                    pos += read_length
+        file_offset += length
+        if file_offset >= end:
+            break
+
+    return b''.join(sha1_digest(view[i:i + piece_length]) for i in range(0, len(view), piece_length))
+
+
+async def hash_files(files: List[SourceFile], piece_length: int, hashing_pool: HashingPool, *,
+                     on_progress: Callable[[int], None]=None) -> bytes:
+    """Computes the "pieces" string of the files. Large ranges of the files are read sequentially
+    and hashed in parallel by the workers of the pool (file reads and `hashlib` release the GIL)."""
+
+    total_size = sum(length for _, length in files)
+    chunk_size = max(1, READ_CHUNK_SIZE // piece_length) * piece_length
+    ranges = deque((begin, min(begin + chunk_size, total_size)) for begin in range(0, total_size, chunk_size))
+    max_queued_jobs = hashing_pool.worker_count * QUEUED_CHUNKS_PER_WORKER
+
+    owner = object()  # The jobs are queued separately from the jobs of other callers
+    jobs = deque()
+    digests = []
+    hashed_size = 0
+    try:
+        while ranges or jobs:
+            while ranges and len(jobs) < max_queued_jobs:
+                begin, end = ranges.popleft()
+                jobs.append((end - begin, asyncio.ensure_future(
+                    hashing_pool.run(owner, _hash_range, files, begin, end, piece_length, size=end - begin))))
+
+            size, job = jobs.popleft()
+            digests.append(await job)
+            hashed_size += size
+            if on_progress is not None:
+                on_progress(hashed_size)
+    finally:
+        for _, job in jobs:
+            job.cancel()
+    return b''.join(digests)
+
+
+def _canonical_dict(dictionary: dict) -> OrderedDict:
+    """BEP 3 requires dictionary keys to be sorted, but bencodepy encodes them in the iteration order."""
+
+    return OrderedDict(sorted(dictionary.items()))
+
+
+async def create_torrent(path: str, announce_list: List[List[str]], hashing_pool: HashingPool, *,
+                         piece_length: int=None, private: bool=False, comment: Optional[str]=None,
+                         on_progress: Callable[[int], None]=None) -> OrderedDict:
+    """Creates a metainfo dictionary for the file or directory. The result can be written with `save_torrent`
+    or loaded with `TorrentInfo.from_dict`."""
+
+    if not announce_list or not all(announce_list):
+        raise ValueError('At least one announce URL is required')
+
+    path = os.path.normpath(path)
+    single_file_mode = os.path.isfile(path)
+    if single_file_mode:
+        files = [([], (path, os.path.getsize(path)))]
+    elif os.path.isdir(path):
+        files = collect_files(path)
+    else:
+        raise ValueError('File or directory "{}" not found'.format(path))
+
+    total_size = sum(length for _, (_, length) in files)
+    if not total_size:
+        raise ValueError("Can't create a torrent without any data")
+    if piece_length is None:
+        piece_length = choose_piece_length(total_size)
+    elif piece_length <= 0 or piece_length & (piece_length - 1):
+        raise ValueError('Piece length must be a power of two')
+
+    info = {}
+    info[b'name'] = os.path.basename(os.path.abspath(path)).encode()
+    info[b'piece length'] = piece_length
+    info[b'pieces'] = await hash_files([source for _, source in files], piece_length, hashing_pool,
+                                       on_progress=on_progress)
+    if single_file_mode:
+        info[b'length'] = total_size
+    else:
+        info[b'files'] = [_canonical_dict({b'length': length, b'path': [elem.encode() for elem in relative_path]})
+                          for relative_path, (_, length) in files]
+    if private:
+        info[b'private'] = 1
+
+    dictionary = {}
+    dictionary[b'announce'] = announce_list[0][0].encode()
+    dictionary[b'announce-list'] = [[url.encode() for url in tier] for tier in announce_list]
+    if comment is not None:
+        dictionary[b'comment'] = comment.encode()
+    dictionary[b'creation date'] = int(time.time())
+    dictionary[b'info'] = _canonical_dict(info)
+    return _canonical_dict(dictionary)
+
+
+def save_torrent(dictionary: OrderedDict, filename: str):
+    with open(filename, 'wb') as f:
+        f.write(bencodepy.encode(dictionary))
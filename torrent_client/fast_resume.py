@@ -0,0 +1,167 @@
+import os
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from bitarray import bitarray
+
+from torrent_client.file_structure import get_file_path
+from torrent_client.models import DownloadInfo
+
+
+__all__ = ['FastResumeRecord', 'FastResumeError', 'get_file_fingerprints']
+
+
+class FastResumeError(ValueError):
+    pass
+
+
+FileFingerprint = Tuple[int, int]  # (size, mtime_ns), or (-1, 0) for a missing file
+
+MISSING_FILE_FINGERPRINT = (-1, 0)
+
+
+def get_file_fingerprints(download_dir: str, download_info: DownloadInfo) -> List[FileFingerprint]:
+    result = []
+    for file in download_info.files:
+        try:
+            stat = os.stat(get_file_path(download_dir, download_info, file))
+        except FileNotFoundError:
+            result.append(MISSING_FILE_FINGERPRINT)
+            continue
+        result.append((stat.st_size, stat.st_mtime_ns))
+    return result
+
+
+class FastResumeRecord:
+    """Compact binary record of the download state of a torrent.
+
+    Besides the bitfield of downloaded pieces and bitmaps of downloaded blocks of partial pieces, the record contains
+    sizes and modification times of the torrent files at the moment when the torrent was stopped. If they still
+    match when the torrent is loaded, nobody has written to the files since then, so the state can be trusted
+    without a recheck.
+    """
+
+    MAGIC = b'TCFR'
+    VERSION = 1
+
+    _HEADER = struct.Struct('!4sB20sII')  # Magic, version, info hash, piece count, file count
+    _COUNT = struct.Struct('!I')
+    _PARTIAL_PIECE = struct.Struct('!II')  # Piece index, bitmap length in bits
+    _FINGERPRINT = struct.Struct('!qq')
+    _CHECKSUM = struct.Struct('!I')
+
+    def __init__(self, info_hash: bytes, downloaded_pieces: bitarray, partial_pieces: Dict[int, bitarray],
+                 fingerprints: List[FileFingerprint]):
+        self.info_hash = info_hash
+        self.downloaded_pieces = downloaded_pieces
+        self.partial_pieces = partial_pieces
+        self.fingerprints = fingerprints
+
+    @classmethod
+    def from_download_info(cls, download_info: DownloadInfo, fingerprints: List[FileFingerprint]):
+        pieces = download_info.pieces
+        downloaded_pieces = bitarray(pieces.downloaded)
+        partial_pieces = {}
+        for index in pieces.partial_piece_indexes:
+            blocks = pieces[index].downloaded_blocks
+            if blocks is not None and blocks.any():
+                partial_pieces[index] = bitarray(blocks)
+        return cls(download_info.info_hash, downloaded_pieces, partial_pieces, fingerprints)
+
+    def matches(self, download_info: DownloadInfo, fingerprints: List[FileFingerprint]) -> bool:
+        if self.info_hash != download_info.info_hash or len(self.downloaded_pieces) != download_info.piece_count:
+            return False
+        for index, blocks in self.partial_pieces.items():
+            piece_length = download_info.pieces[index].length
+            if len(blocks) != (piece_length + DownloadInfo.MARKED_BLOCK_SIZE - 1) // DownloadInfo.MARKED_BLOCK_SIZE:
+                return False
+        return self.fingerprints == fingerprints
+
+    def apply(self, download_info: DownloadInfo):
+        pieces = download_info.pieces
+        pieces.reset_content(self.downloaded_pieces)
+        for index, blocks in self.partial_pieces.items():
+            if not self.downloaded_pieces[index]:
+                pieces[index].restore_downloaded_blocks(blocks)
+        download_info.downloaded_piece_count = self.downloaded_pieces.count()
+        download_info.complete = not pieces.get_remaining_pieces().any()
+
+    def to_bytes(self) -> bytes:
+        parts = [FastResumeRecord._HEADER.pack(FastResumeRecord.MAGIC, FastResumeRecord.VERSION, self.info_hash,
+                                               len(self.downloaded_pieces), len(self.fingerprints)),
+                 self.downloaded_pieces.tobytes(),
+                 FastResumeRecord._COUNT.pack(len(self.partial_pieces))]
+        for index, blocks in sorted(self.partial_pieces.items()):
+            parts.append(FastResumeRecord._PARTIAL_PIECE.pack(index, len(blocks)))
+            parts.append(blocks.tobytes())
+        for fingerprint in self.fingerprints:
+            parts.append(FastResumeRecord._FINGERPRINT.pack(*fingerprint))
+
+        data = b''.join(parts)
+        return data + FastResumeRecord._CHECKSUM.pack(zlib.crc32(data))
+
+    @staticmethod
+    def _read_bits(data: memoryview, pos: int, length: int) -> Tuple[bitarray, int]:
+        end = pos + (length + 7) // 8
+        if end > len(data):
+            raise FastResumeError('Unexpected end of the record')
+        arr = bitarray()
+        arr.frombytes(bytes(data[pos:end]))
+        return arr[:length], end
+
+    @staticmethod
+    def _unpack(fmt: struct.Struct, data: memoryview, pos: int) -> Tuple[tuple, int]:
+        if pos + fmt.size > len(data):
+            raise FastResumeError('Unexpected end of the record')
+        return fmt.unpack_from(data, pos), pos + fmt.size
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        checksum_size = FastResumeRecord._CHECKSUM.size
+        if len(data) < checksum_size or \
+                FastResumeRecord._CHECKSUM.unpack(data[-checksum_size:])[0] != zlib.crc32(data[:-checksum_size]):
+            raise FastResumeError('The record is corrupted')
+        data = memoryview(data)[:-checksum_size]
+
+        (magic, version, info_hash, piece_count, file_count), pos = cls._unpack(FastResumeRecord._HEADER, data, 0)
+        if magic != FastResumeRecord.MAGIC or version != FastResumeRecord.VERSION:
+            raise FastResumeError('Unknown record format')
+        downloaded_pieces, pos = cls._read_bits(data, pos, piece_count)
+
+        (partial_count,), pos = cls._unpack(FastResumeRecord._COUNT, data, pos)
+        partial_pieces = {}
+        for _ in range(partial_count):
+            (index, length), pos = cls._unpack(FastResumeRecord._PARTIAL_PIECE, data, pos)
+            if index >= piece_count:
+                raise FastResumeError('Invalid piece index')
+            partial_pieces[index], pos = cls._read_bits(data, pos, length)
+
+        fingerprints = []
+        for _ in range(file_count):
+            fingerprint, pos = cls._unpack(FastResumeRecord._FINGERPRINT, data, pos)
+            fingerprints.append(fingerprint)
+        if pos != len(data):
+            raise FastResumeError('Unexpected data at the end of the record')
+
+        return cls(bytes(info_hash), downloaded_pieces, partial_pieces, fingerprints)
+
+    def save(self, filename: str):
+        """Writes the record atomically, so a crash can't leave a truncated record behind."""
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(self.to_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename: str) -> Optional['FastResumeRecord']:
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return cls.from_bytes(data)
@@ -1,58 +1,374 @@
 import asyncio
 import functools
+import hashlib
+import mmap
 import os
+import threading
+import weakref
 from bisect import bisect_right
-from contextlib import closing
-from typing import Iterable, BinaryIO, Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
-from torrent_client.models import DownloadInfo
+from torrent_client.hashing import HashingPool
+from torrent_client.io_scheduler import IOClass, IOScheduler
+from torrent_client.models import DownloadInfo, FileInfo
+from torrent_client.storage import BaseStorage
+from torrent_client.utils import BufferPool, MemoryBudget
 
 
-def delegate_to_executor(func):
-    @functools.wraps(func)
-    async def wrapper(self: 'FileStructure', *args, acquire_lock=True, **kwargs):
-        if acquire_lock:
-            await self.lock.acquire()
+def delegate_to_executor(default_io_class: IOClass):
+    """Makes the method run in the I/O scheduler as an operation of the given class
+    (the class can be overridden by the `io_class` keyword argument)."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self: 'FileStructure', *args, io_class: IOClass=default_io_class, **kwargs):
+            return await self._io_scheduler.run(self, io_class, functools.partial(func, self, *args, **kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+class PieceLocks:
+    """Asyncio locks of separate pieces.
+
+    Locks are created on demand and dropped when nobody holds or waits for them. Pieces of a range are always
+    locked in ascending order, so operations with overlapping ranges can't deadlock.
+    """
+
+    def __init__(self):
+        self._locks = {}  # type: Dict[int, asyncio.Lock]
+        self._users = {}  # type: Dict[int, int]
+
+    def _drop_user(self, piece_index: int):
+        self._users[piece_index] -= 1
+        if not self._users[piece_index]:
+            del self._users[piece_index]
+            del self._locks[piece_index]
+
+    async def acquire(self, piece_indexes: range):
+        acquired = []
         try:
-            return await self._loop.run_in_executor(None, functools.partial(func, self, *args, **kwargs))
-        finally:
-            if acquire_lock:
-                self.lock.release()
+            for index in piece_indexes:
+                lock = self._locks.get(index)
+                if lock is None:
+                    lock = self._locks[index] = asyncio.Lock()
+                    self._users[index] = 0
+                self._users[index] += 1
+                try:
+                    await lock.acquire()
+                except BaseException:
+                    self._drop_user(index)
+                    raise
+                acquired.append(index)
+        except BaseException:
+            self.release(acquired)
+            raise
+
+    def release(self, piece_indexes: Iterable[int]):
+        for index in piece_indexes:
+            self._locks[index].release()
+            self._drop_user(index)
+
+    def hold(self, piece_indexes: range) -> 'HeldPieces':
+        return HeldPieces(self, piece_indexes)
+
+
+class HeldPieces:
+    def __init__(self, locks: PieceLocks, piece_indexes: range):
+        self._locks = locks
+        self._piece_indexes = piece_indexes
+
+    async def __aenter__(self):
+        await self._locks.acquire(self._piece_indexes)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._locks.release(self._piece_indexes)
+
+
+class FileHandle:
+    def __init__(self, fd: int):
+        self._fd = fd
+        self._seek_lock = threading.Lock()  # Used only on platforms without os.pread() and os.pwrite()
+
+        self.users = 0
+        self.closing = False
+        self.closed = False
+
+    @property
+    def fd(self) -> int:
+        return self._fd
+
+    def pread(self, length: int, position: int) -> bytes:
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd, length, position)
+        with self._seek_lock:
+            os.lseek(self._fd, position, os.SEEK_SET)
+            return os.read(self._fd, length)
+
+    def preadv(self, buffer: memoryview, position: int) -> int:
+        if hasattr(os, 'preadv'):
+            return os.preadv(self._fd, [buffer], position)
+        data = self.pread(len(buffer), position)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def pwrite(self, data: memoryview, position: int) -> int:
+        if hasattr(os, 'pwrite'):
+            return os.pwrite(self._fd, data, position)
+        with self._seek_lock:
+            os.lseek(self._fd, position, os.SEEK_SET)
+            return os.write(self._fd, data)
+
+    def close(self):
+        os.close(self._fd)
+        self.closed = True
+
+
+class FileHandleCache:
+    """Daemon-wide LRU cache of file descriptors opened by FileStructure instances.
+
+    Descriptors are used from executor threads, so the cache is guarded by a threading lock. A descriptor in use
+    is never closed: eviction skips it, and closing of its owner is postponed until the last user releases it.
+    """
+
+    MAX_OPEN_FILES = 512
+    MAX_OPEN_FILES_PER_OWNER = 64
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handles = {}  # type: Dict[object, OrderedDict]
+        self._open_count = 0
+        # Executor jobs of a closed owner may still be running, they must not open descriptors nobody will close
+        self._closed_owners = weakref.WeakSet()
+
+    @staticmethod
+    def _evict_idle(handles: OrderedDict) -> bool:
+        for key, handle in handles.items():
+            if not handle.users:
+                del handles[key]
+                handle.close()
+                return True
+        return False
+
+    def _reserve_place(self, owner_handles: OrderedDict):
+        if len(owner_handles) >= FileHandleCache.MAX_OPEN_FILES_PER_OWNER:
+            if FileHandleCache._evict_idle(owner_handles):
+                self._open_count -= 1
+        if self._open_count >= FileHandleCache.MAX_OPEN_FILES:
+            for handles in [owner_handles] + list(self._handles.values()):
+                if FileHandleCache._evict_idle(handles):
+                    self._open_count -= 1
+                    break
+        # If all descriptors are in use, we temporarily exceed the limits instead of blocking
+
+    def _check_not_closed(self, owner: object):
+        if owner in self._closed_owners:
+            raise ValueError('I/O operation on a closed file structure')
+
+    def _take_cached(self, owner: object, key: int) -> Optional[FileHandle]:
+        owner_handles = self._handles.get(owner)
+        handle = owner_handles.get(key) if owner_handles is not None else None
+        if handle is not None:
+            owner_handles.move_to_end(key)
+            handle.users += 1
+        return handle
+
+    def acquire(self, owner: object, key: int, open_fd: Callable[[int], int]) -> FileHandle:
+        """Returns a cached descriptor or calls `open_fd(key)` to open a new one.
+
+        The file is opened without holding the lock (opening may create directories and the file itself),
+        so the event loop never waits for it in `acquire_cached` or `release`.
+        """
+
+        with self._lock:
+            self._check_not_closed(owner)
+            handle = self._take_cached(owner, key)
+        if handle is not None:
+            return handle
+
+        fd = open_fd(key)
+        with self._lock:
+            handle = self._take_cached(owner, key)
+            if handle is None and owner not in self._closed_owners:
+                owner_handles = self._handles.setdefault(owner, OrderedDict())
+                self._reserve_place(owner_handles)
+
+                handle = FileHandle(fd)
+                handle.users += 1
+                owner_handles[key] = handle
+                self._open_count += 1
+                return handle
+        os.close(fd)  # Another thread has opened the same file in the meantime, or the owner has been closed
+        if handle is None:
+            raise ValueError('I/O operation on a closed file structure')
+        return handle
+
+    def acquire_cached(self, owner: object, key: int) -> Optional[FileHandle]:
+        """Returns a cached descriptor or None if it's not open. Never touches the file system,
+        so it can be called from the event loop thread."""
+
+        with self._lock:
+            return self._take_cached(owner, key)
+
+    def release(self, handle: FileHandle):
+        with self._lock:
+            handle.users -= 1
+            if not handle.users and handle.closing:
+                handle.close()
+
+    def close_owner(self, owner: object, *, final: bool=False) -> List[FileHandle]:
+        """Closes descriptors of the owner and returns the ones that will be closed when their users release them.
+        If `final` is set, the owner can't open descriptors anymore (`acquire` raises ValueError)."""
+
+        with self._lock:
+            if final:
+                self._closed_owners.add(owner)
+            owner_handles = self._handles.pop(owner, None)
+            if owner_handles is None:
+                return []
+            self._open_count -= len(owner_handles)
+
+            busy_handles = []
+            for handle in owner_handles.values():
+                if handle.users:
+                    handle.closing = True
+                    busy_handles.append(handle)
+                else:
+                    handle.close()
+            return busy_handles
+
+
+file_handles = FileHandleCache()
+
+
+# Blocks of pieces being downloaded are assembled in memory until the piece is validated.
+# When the budget is exhausted, blocks of new pieces are written to disk directly.
+piece_buffer_budget = MemoryBudget(2 ** 28)  # = 256 MiB
+
+
+class PieceCache:
+    """Daemon-wide LRU cache of whole pieces read for uploading.
+
+    Peers usually request blocks of a piece one after another, so the whole piece is read on the first request
+    and the next requests (from all peers of the torrent) are served from memory. The cache is supposed to be used
+    from the event loop thread only.
+    """
+
+    def __init__(self, limit: int):
+        self._budget = MemoryBudget(limit)
+        self._pieces = OrderedDict()  # type: Dict[Tuple[object, int], bytes]
+
+    @property
+    def limit(self) -> int:
+        return self._budget.limit
+
+    @property
+    def used(self) -> int:
+        return self._budget.used
+
+    def get(self, owner: object, piece_index: int) -> Optional[bytes]:
+        key = (owner, piece_index)
+        data = self._pieces.get(key)
+        if data is not None:
+            self._pieces.move_to_end(key)
+        return data
+
+    def put(self, owner: object, piece_index: int, data: bytes):
+        if len(data) > self._budget.limit:
+            return
+        self.discard(owner, piece_index)
+        while not self._budget.try_reserve(len(data)):
+            _, evicted = self._pieces.popitem(last=False)
+            self._budget.release(len(evicted))
+        self._pieces[owner, piece_index] = data
+
+    def discard(self, owner: object, piece_index: int):
+        data = self._pieces.pop((owner, piece_index), None)
+        if data is not None:
+            self._budget.release(len(data))
+
+    def discard_owner(self, owner: object):
+        for key in [key for key in self._pieces if key[0] is owner]:
+            self._budget.release(len(self._pieces.pop(key)))
 
-    return wrapper
 
+upload_cache = PieceCache(2 ** 26)  # = 64 MiB
+
+
+# Pieces are read for hashing in chunks, so memory used by all validations doesn't depend on the piece length
+HASH_CHUNK_SIZE = 2 ** 20
+
+# Validation and recheck read into separate pools, so a recheck of a large torrent can't hold
+# all buffers while downloaded pieces wait to be validated
+hash_buffers = BufferPool(HASH_CHUNK_SIZE, 16)  # = 16 MiB in total
+recheck_buffers = BufferPool(HASH_CHUNK_SIZE, HashingPool.WORKER_COUNT + 1)
+
+
+PREALLOCATION_MODES = ['sparse', 'fallocate', 'full']
+
+
+def get_file_path(download_dir: str, download_info: DownloadInfo, file: FileInfo) -> str:
+    return os.path.join(download_dir, download_info.suggested_name, *file.path)
+
+
+class FileStructure(BaseStorage):
+    PERSISTENT = True
+    USE_UPLOAD_CACHE = True
+    # Whether `_read_range` returns views of the storage, so data can be hashed without reading it into buffers
+    ZERO_COPY_READS = False
+
+    MAX_PENDING_WRITE_BYTES = 2 ** 25  # = 32 MiB
+
+    def __init__(self, download_dir: str, download_info: DownloadInfo, hashing_pool: HashingPool,
+                 io_scheduler: IOScheduler, *, preallocation: str='sparse'):
+        if preallocation not in PREALLOCATION_MODES:
+            raise ValueError('Unknown preallocation mode "{}"'.format(preallocation))
 
-class FileStructure:
-    def __init__(self, download_dir: str, download_info: DownloadInfo):
         self._download_info = download_info
+        self._hashing_pool = hashing_pool
+        self._io_scheduler = io_scheduler
+        self._preallocation = preallocation
 
-        self._loop = asyncio.get_event_loop()
-        self._lock = asyncio.Lock()
+        self._piece_locks = PieceLocks()
+        self._piece_buffers = {}  # type: Dict[int, bytearray]
+        self._upload_reads = {}   # type: Dict[int, asyncio.Task]
+        self._pending_write_bytes = 0
         self._paths = []
+        self._old_handles = []  # type: List[FileHandle]  # Descriptors of files used before relocation
+        self._allocated_files = set()  # type: Set[int]  # Files whose space is reserved with posix_fallocate()
         self._offsets = []
         offset = 0
 
+        # Files are created on first access in executor threads, so adding a torrent with lots of files
+        # doesn't block the event loop, and files that contain no selected pieces aren't created at all
         for file in download_info.files:
-            path = os.path.join(download_dir, download_info.suggested_name, *file.path)
-            directory = os.path.dirname(path)
-            if not os.path.isdir(directory):
-                os.makedirs(os.path.normpath(directory))
-            if not os.path.isfile(path):
-                with open(path, 'w') as f:
-                    f.truncate(file.length)
-
-            self._paths.append(path)
+            self._paths.append(get_file_path(download_dir, download_info, file))
             self._offsets.append(offset)
             offset += file.length
 
         self._offsets.append(offset)  # Fake entry for convenience
 
-    @property
-    def lock(self) -> asyncio.Lock:
-        return self._lock
+    def lock_piece(self, piece_index: int) -> HeldPieces:
+        """Returns an asynchronous context manager that holds a lock of the piece.
+
+        Reads and writes take locks of the pieces they touch, so operations with different pieces are performed
+        concurrently, while e.g. piece validation can't interleave with writing to the same piece.
+        """
+
+        return self._piece_locks.hold(range(piece_index, piece_index + 1))
+
+    def _get_piece_range(self, offset: int, length: int) -> range:
+        piece_length = self._download_info.piece_length
+        return range(offset // piece_length, (offset + max(length, 1) - 1) // piece_length + 1)
+
+    def _lock_range(self, offset: int, length: int) -> HeldPieces:
+        return self._piece_locks.hold(self._get_piece_range(offset, length))
 
-    def _iter_files(self, offset: int, data_length: int, mode: str) -> Iterable[Tuple[BinaryIO, int, int]]:
-        if offset < 0 or offset + data_length > self._download_info.total_size:
+    def _iter_files(self, offset: int, data_length: int) -> Iterable[Tuple[int, int, int]]:
+        if offset < 0 or offset + data_length > self._offsets[-1]:
             raise IndexError('Data position out of range')
 
         # Find rightmost file which start offset less than or equal to `offset`
@@ -64,25 +380,764 @@ class FileStructure:
             file_pos = offset - file_start_offset
             bytes_to_operate = min(file_end_offset - offset, data_length)
 
-            with open(self._paths[index], mode) as f:
-                yield f, file_pos, bytes_to_operate
+            if bytes_to_operate:
+                yield index, file_pos, bytes_to_operate
 
             offset += bytes_to_operate
             data_length -= bytes_to_operate
             index += 1
 
-    @delegate_to_executor
-    def read(self, offset: int, length: int):
+    _OPEN_FLAGS = os.O_RDWR | getattr(os, 'O_BINARY', 0)
+
+    def _open_fd(self, index: int) -> int:
+        path = self._paths[index]
+        try:
+            return os.open(path, FileStructure._OPEN_FLAGS)
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, FileStructure._OPEN_FLAGS | os.O_CREAT)
+        try:
+            os.ftruncate(fd, self._offsets[index + 1] - self._offsets[index])
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+
+    def _acquire_file(self, index: int) -> FileHandle:
+        return file_handles.acquire(self, index, self._open_fd)
+
+    def _get_needed_files(self) -> List[int]:
+        """Returns indexes of non-empty files that contain selected pieces."""
+
+        piece_length = self._download_info.piece_length
+        selected_pieces = self._download_info.pieces.selected
         result = []
-        for f, file_pos, bytes_to_operate in self._iter_files(offset, length, 'rb'):
-            f.seek(file_pos)
-            result.append(f.read(bytes_to_operate))
-        return b''.join(result)
+        for index in range(len(self._paths)):
+            begin = self._offsets[index]
+            end = self._offsets[index + 1]
+            if begin < end and selected_pieces[begin // piece_length:(end - 1) // piece_length + 1].any():
+                result.append(index)
+        return result
+
+    @delegate_to_executor(IOClass.background)
+    def _allocate_file(self, index: int):
+        with self._open_file(index) as handle:
+            os.posix_fallocate(handle.fd, 0, self._offsets[index + 1] - self._offsets[index])
+        self._allocated_files.add(index)
+
+    _ZERO_CHUNK = bytes(2 ** 20)
+
+    @delegate_to_executor(IOClass.background)
+    def _fill_holes(self, offset: int, length: int):
+        for index, file_pos, bytes_to_operate in self._iter_files(offset, length):
+            end = file_pos + bytes_to_operate
+            with self._open_file(index) as handle:
+                while file_pos < end:
+                    try:
+                        data_begin = min(os.lseek(handle.fd, file_pos, os.SEEK_DATA), end)
+                    except OSError:  # ENXIO means that there is no data after this position
+                        data_begin = end
+                    while file_pos < data_begin:
+                        file_pos += handle.pwrite(
+                            memoryview(FileStructure._ZERO_CHUNK)[:data_begin - file_pos], file_pos)
+                    if file_pos < end:
+                        file_pos = os.lseek(handle.fd, file_pos, os.SEEK_HOLE)
+
+    async def preallocate(self):
+        """Allocates disk space for files with selected pieces, so they don't get fragmented by writes
+        in random order. The files are still created sparse, so this can be performed while downloading.
+
+        "fallocate" mode reserves space with posix_fallocate(). "full" mode writes zeros to holes of the files
+        (doing so piece by piece, so downloaded data is never overwritten). It's also used where
+        posix_fallocate() is unavailable.
+        """
+
+        if self._preallocation == 'sparse':
+            return
+        if self._preallocation == 'fallocate' and hasattr(os, 'posix_fallocate'):
+            for index in self._get_needed_files():
+                await self._allocate_file(index)
+            return
+
+        if not hasattr(os, 'SEEK_HOLE'):
+            return  # We can't distinguish holes from downloaded data
+        pieces = self._download_info.pieces
+        for piece_index, remaining in enumerate(pieces.get_remaining_pieces()):
+            if remaining:
+                async with self.lock_piece(piece_index):
+                    await self._fill_holes(self._get_piece_offset(piece_index), pieces.get_piece_length(piece_index))
+
+    @delegate_to_executor(IOClass.background)
+    def create_empty_files(self):
+        """Creates selected files of zero length (they contain no pieces, so they're never written)."""
 
-    @delegate_to_executor
-    def write(self, offset: int, data: memoryview):
-        for f, file_pos, bytes_to_operate in self._iter_files(offset, len(data), 'r+b'):
-            f.seek(file_pos)
-            f.write(data[:bytes_to_operate])
+        for index, file in enumerate(self._download_info.files):
+            if not file.length and file.selected:
+                os.close(self._open_fd(index))
 
+    @contextmanager
+    def _open_file(self, index: int) -> Iterator[FileHandle]:
+        handle = self._acquire_file(index)
+        try:
+            yield handle
+        finally:
+            file_handles.release(handle)
+
+    def _read_file(self, index: int, file_pos: int, length: int) -> bytes:
+        result = []
+        with self._open_file(index) as handle:
+            while length:
+                data = handle.pread(length, file_pos)
+                if not data:
+                    break  # The file was truncated by someone else
+                result.append(data)
+                file_pos += len(data)
+                length -= len(data)
+        return result[0] if len(result) == 1 else b''.join(result)
+
+    def _read_file_into(self, index: int, file_pos: int, buffer: memoryview):
+        with self._open_file(index) as handle:
+            while buffer:
+                bytes_read = handle.preadv(buffer, file_pos)
+                if not bytes_read:
+                    break  # The file was truncated by someone else, the rest of the buffer stays zeroed
+                buffer = buffer[bytes_read:]
+                file_pos += bytes_read
+
+    def _write_file(self, index: int, file_pos: int, data: memoryview):
+        with self._open_file(index) as handle:
+            while data:
+                bytes_written = handle.pwrite(data, file_pos)
+                data = data[bytes_written:]
+                file_pos += bytes_written
+
+    @delegate_to_executor(IOClass.upload_read)
+    def _read_range(self, offset: int, length: int) -> Union[bytes, bytearray, memoryview]:
+        portions = list(self._iter_files(offset, length))
+        if len(portions) == 1:
+            # The only portion is returned as is, so memory-mapped structures can avoid copying
+            return self._read_file(*portions[0])
+
+        # Portions from several files are read directly into their places in one buffer instead of being joined
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+        for index, file_pos, bytes_to_operate in portions:
+            self._read_file_into(index, file_pos, view[:bytes_to_operate])
+            view = view[bytes_to_operate:]
+        return buffer
+
+    def _advise_will_need(self, index: int, file_pos: int, length: int):
+        with self._open_file(index) as handle:
+            os.posix_fadvise(handle.fd, file_pos, length, os.POSIX_FADV_WILLNEED)
+
+    def _advise_range(self, offset: int, length: int):
+        if hasattr(os, 'posix_fadvise'):
+            # Let the kernel read the rest of the range in the background while we're hashing this part
+            for index, file_pos, bytes_to_operate in self._iter_files(offset, length):
+                self._advise_will_need(index, file_pos, bytes_to_operate)
+
+    @delegate_to_executor(IOClass.recheck)
+    def _advise_range_will_need(self, offset: int, length: int):
+        self._advise_range(offset, length)
+
+    @delegate_to_executor(IOClass.validation_read)
+    def _read_range_into(self, offset: int, buffer: memoryview, will_need_length: int=0):
+        if will_need_length:
+            self._advise_range(offset, will_need_length)
+
+        for index, file_pos, bytes_to_operate in self._iter_files(offset, len(buffer)):
+            self._read_file_into(index, file_pos, buffer[:bytes_to_operate])
+            buffer = buffer[bytes_to_operate:]
+
+    @delegate_to_executor(IOClass.download_write)
+    def _write_range(self, offset: int, data: memoryview):
+        data = memoryview(data)
+        for index, file_pos, bytes_to_operate in self._iter_files(offset, len(data)):
+            self._write_file(index, file_pos, data[:bytes_to_operate])
             data = data[bytes_to_operate:]
+
+    async def read(self, offset: int, length: int, *, acquire_lock=True,
+                   io_class: IOClass=IOClass.upload_read) -> Union[bytes, bytearray, memoryview]:
+        if not acquire_lock:
+            return await self._read_range(offset, length, io_class=io_class)
+        async with self._lock_range(offset, length):
+            return await self._read_range(offset, length, io_class=io_class)
+
+    async def write(self, offset: int, data: memoryview, *, acquire_lock=True):
+        for piece_index in self._get_piece_range(offset, len(data)):
+            upload_cache.discard(self, piece_index)
+
+        # The data is accounted until it's written, including time spent waiting for piece locks and workers
+        size = len(data)
+        self._pending_write_bytes += size
+        self._io_scheduler.add_pending_write(size)
+        try:
+            if not acquire_lock:
+                await self._write_range(offset, data)
+                return
+            async with self._lock_range(offset, len(data)):
+                await self._write_range(offset, data)
+        finally:
+            self._pending_write_bytes -= size
+            self._io_scheduler.finish_pending_write(size)
+
+    @property
+    def pending_write_bytes(self) -> int:
+        return self._pending_write_bytes
+
+    @property
+    def write_latency(self) -> Optional[float]:
+        return self._io_scheduler.write_latency
+
+    def is_write_backlog_full(self) -> bool:
+        """Checks whether too much downloaded data of this torrent or of all torrents waits to be written."""
+
+        return (self._pending_write_bytes >= FileStructure.MAX_PENDING_WRITE_BYTES or
+                self._io_scheduler.is_write_backlog_full())
+
+    def is_write_backlog_drained(self) -> bool:
+        """Checks whether both backlogs are drained to half of their limits. Requesting should be resumed only then,
+        so it isn't resumed and suspended again on every written block."""
+
+        return (self._pending_write_bytes <= FileStructure.MAX_PENDING_WRITE_BYTES // 2 and
+                self._io_scheduler.is_write_backlog_drained())
+
+    async def wait_write_backlog_drained(self):
+        while not self.is_write_backlog_drained():
+            await self._io_scheduler.wait_write_progress()
+
+    def pin_file_range(self, offset: int, length: int) -> Optional[Tuple[FileHandle, int]]:
+        """Returns a descriptor of the file containing the whole range and the range position in this file
+        (or None if the range spans several files). The descriptor stays open until it's passed to `unpin_file`.
+
+        This is called from the event loop, so only already open descriptors are used. If the file isn't open,
+        None is returned, the caller falls back to a read through the I/O scheduler, and that opens the file.
+        """
+
+        portions = list(self._iter_files(offset, length))
+        if len(portions) != 1:
+            return None
+        index, file_pos, _ = portions[0]
+        handle = file_handles.acquire_cached(self, index)
+        if handle is None:
+            return None
+        return handle, file_pos
+
+    @staticmethod
+    def unpin_file(handle: FileHandle):
+        file_handles.release(handle)
+
+    def _get_piece_offset(self, piece_index: int) -> int:
+        return piece_index * self._download_info.piece_length
+
+    async def _read_piece_for_upload(self, piece_index: int) -> bytes:
+        data = await self.read(self._get_piece_offset(piece_index), self._download_info.pieces[piece_index].length)
+        upload_cache.put(self, piece_index, data)
+        return data
+
+    async def read_block(self, piece_index: int, block_begin: int, length: int) -> Union[bytes, memoryview]:
+        """Reads a block to upload it. The whole piece is read ahead and cached if the storage benefits from it."""
+
+        piece_info = self._download_info.pieces[piece_index]
+        if not self.USE_UPLOAD_CACHE or piece_info.length > upload_cache.limit:
+            return await self.read(self._get_piece_offset(piece_index) + block_begin, length)
+
+        statistics = self._download_info.session_statistics
+        data = upload_cache.get(self, piece_index)
+        if data is not None:
+            statistics.upload_cache_hits += 1
+        else:
+            task = self._upload_reads.get(piece_index)
+            if task is not None:
+                statistics.upload_cache_hits += 1  # Another peer has already started reading the piece
+            else:
+                statistics.upload_cache_misses += 1
+                task = asyncio.ensure_future(self._read_piece_for_upload(piece_index))
+                self._upload_reads[piece_index] = task
+                task.add_done_callback(lambda _: self._upload_reads.pop(piece_index, None))
+            # A peer that disconnects while waiting shouldn't cancel the read for other peers
+            data = await asyncio.shield(task)
+        return memoryview(data)[block_begin:block_begin + length]
+
+    async def write_block(self, piece_index: int, block_begin: int, data: memoryview, *, acquire_lock=True):
+        piece_info = self._download_info.pieces[piece_index]
+
+        hashed_length = piece_info.hashed_length
+        if block_begin < hashed_length:
+            # The hashed data can't be changed, otherwise the piece would be validated with wrong contents
+            data = data[hashed_length - block_begin:]
+            block_begin = hashed_length
+            if not data:
+                return
+
+        buffer = self._piece_buffers.get(piece_index)
+        if buffer is None:
+            # If some blocks were written to disk before (e.g. during the previous run),
+            # the rest of the piece should be written there too
+            if not piece_info.has_downloaded_blocks() and piece_buffer_budget.try_reserve(piece_info.length):
+                buffer = bytearray(piece_info.length)
+                self._piece_buffers[piece_index] = buffer
+
+        if buffer is not None:
+            buffer[block_begin:block_begin + len(data)] = data
+        else:
+            await self.write(self._get_piece_offset(piece_index) + block_begin, data, acquire_lock=acquire_lock)
+
+        # Only the arriving block is hashed on the event loop. If it fills a gap, the blocks after it are hashed
+        # by `hash_piece` in the hashing pool, because they can make up almost the whole piece.
+        piece_info.update_hash(block_begin, data)
+
+    async def hash_piece(self, piece_index: int) -> bytes:
+        piece_info = self._download_info.pieces[piece_index]
+
+        async with self.lock_piece(piece_index):
+            # Blocks that arrived out of order haven't been hashed yet
+            piece_buffer = self._piece_buffers.get(piece_index)
+            if piece_buffer is not None:
+                # Even though the data is in memory, large pieces are hashed by parts, so pieces of other torrents
+                # don't wait for the hashing pool too long
+                view = memoryview(piece_buffer)
+                chunk_size = HASH_CHUNK_SIZE
+                for chunk_begin in range(piece_info.hashed_length, piece_info.length, chunk_size):
+                    chunk = view[chunk_begin:chunk_begin + chunk_size]
+                    await self._hashing_pool.run(self, piece_info.update_hash, chunk_begin, chunk, size=len(chunk))
+            elif piece_info.hashed_length < piece_info.length:
+                await self._hash_from_disk(piece_info.update_hash, self._get_piece_offset(piece_index),
+                                           piece_info.hashed_length, piece_info.length)
+
+            return piece_info.hash_digest()
+
+    async def _hash_from_disk(self, update_hash: Callable[[int, memoryview], None], base_offset: int,
+                              begin: int, end: int, *, io_class: IOClass=IOClass.validation_read,
+                              read_ahead: bool=False):
+        """Feeds data located at [base_offset + begin, base_offset + end) to `update_hash(position, data)`
+        by chunks read into a buffer from `hash_buffers` (or `recheck_buffers` for a recheck)."""
+
+        if self.ZERO_COPY_READS:
+            await self._hash_views(update_hash, base_offset, begin, end, io_class=io_class, read_ahead=read_ahead)
+            return
+
+        buffers = recheck_buffers if io_class == IOClass.recheck else hash_buffers
+        buffer = await buffers.acquire()
+        try:
+            chunk_size = len(buffer)
+            for chunk_begin in range(begin, end, chunk_size):
+                chunk = memoryview(buffer)[:min(chunk_size, end - chunk_begin)]
+                will_need_length = end - chunk_begin if read_ahead and chunk_begin == begin else 0
+                await self._read_range_into(base_offset + chunk_begin, chunk, will_need_length, io_class=io_class)
+                await self._hashing_pool.run(self, update_hash, chunk_begin, chunk, size=len(chunk))
+        except BaseException:
+            buffers.release(None)  # An executor thread may still use the buffer
+            raise
+        buffers.release(buffer)
+
+    async def _hash_views(self, update_hash: Callable[[int, memoryview], None], base_offset: int,
+                          begin: int, end: int, *, io_class: IOClass, read_ahead: bool):
+        """Hashes the data by chunks returned by `_read_range`. Used by structures that return views of their
+        storage instead of copies, so no buffers are needed."""
+
+        if read_ahead and end - begin > HASH_CHUNK_SIZE:
+            await self._advise_range_will_need(base_offset + begin, end - begin, io_class=io_class)
+        for chunk_begin in range(begin, end, HASH_CHUNK_SIZE):
+            chunk = await self._read_range(base_offset + chunk_begin, min(HASH_CHUNK_SIZE, end - chunk_begin),
+                                           io_class=io_class)
+            await self._hashing_pool.run(self, update_hash, chunk_begin, chunk, size=len(chunk))
+            if isinstance(chunk, memoryview):
+                # Don't keep the mapping alive until the garbage collector gets to the view
+                chunk.release()
+
+    @delegate_to_executor(IOClass.recheck)
+    def _get_missing_files(self) -> Set[int]:
+        return {index for index, path in enumerate(self._paths)
+                if self._offsets[index + 1] > self._offsets[index] and not os.path.isfile(path)}
+
+    async def _check_piece(self, piece_index: int, missing_files: Set[int]) -> bool:
+        piece_info = self._download_info.pieces[piece_index]
+        offset = self._get_piece_offset(piece_index)
+        if any(index in missing_files for index, _, _ in self._iter_files(offset, piece_info.length)):
+            return False  # Don't create missing files just to read zeros from them
+
+        hasher = hashlib.sha1()
+        async with self.lock_piece(piece_index):
+            await self._hash_from_disk(lambda _, data: hasher.update(data), offset, 0, piece_info.length,
+                                       io_class=IOClass.recheck, read_ahead=True)
+        return hasher.digest() == piece_info.piece_hash
+
+    RECHECK_CONCURRENCY = HashingPool.WORKER_COUNT + 1
+
+    async def recheck(self, piece_indexes: Iterable[int], on_piece_checked: Callable[[int, bool], None]):
+        """Hashes the pieces from disk and reports whether their data is valid.
+
+        Several pieces are processed simultaneously, so the hashing pool is busy while the next piece is being read.
+        Pieces are taken in the given order and the kernel is asked to read each one ahead entirely, so reading
+        stays sequential when the pieces are sorted.
+        """
+
+        missing_files = await self._get_missing_files()
+        piece_iterator = iter(piece_indexes)
+
+        async def execute_checks():
+            for piece_index in piece_iterator:
+                on_piece_checked(piece_index, await self._check_piece(piece_index, missing_files))
+
+        workers = [asyncio.ensure_future(execute_checks()) for _ in range(FileStructure.RECHECK_CONCURRENCY)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            await asyncio.wait(workers)
+            raise
+
+    def _release_piece_buffer(self, piece_index: int):
+        buffer = self._piece_buffers.pop(piece_index)
+        piece_buffer_budget.release(len(buffer))
+
+    async def flush_piece(self, piece_index: int):
+        buffer = self._piece_buffers.get(piece_index)
+        if buffer is None:
+            return
+
+        await self.write(self._get_piece_offset(piece_index), buffer)
+        self._release_piece_buffer(piece_index)
+
+    def discard_piece(self, piece_index: int):
+        if piece_index in self._piece_buffers:
+            self._release_piece_buffer(piece_index)
+
+    @property
+    def unflushed_pieces(self) -> Iterable[int]:
+        return self._piece_buffers.keys()
+
+    def relocate(self, download_dir: str):
+        """Switches the structure to complete copies of the files in another directory. The paths are replaced
+        at once, operations that already hold descriptors of the old files finish with them."""
+
+        self._paths = [get_file_path(download_dir, self._download_info, file) for file in self._download_info.files]
+        self._old_handles += file_handles.close_owner(self)
+        self._allocated_files = set()  # The copies may be sparse
+
+    OLD_FILES_POLL_INTERVAL = 0.1
+
+    def _are_old_files_released(self) -> bool:
+        self._old_handles = [handle for handle in self._old_handles if not handle.closed]
+        return not self._old_handles
+
+    async def wait_old_files_released(self):
+        # Descriptors are released in executor threads, so it's simpler to poll them
+        while not self._are_old_files_released():
+            await asyncio.sleep(FileStructure.OLD_FILES_POLL_INTERVAL)
+
+    async def close(self):
+        # Pieces that are not completely downloaded are saved too, because downloaded blocks are remembered
+        # in the download state and will not be requested again
+        try:
+            for piece_index in list(self._piece_buffers.keys()):
+                await self.flush_piece(piece_index)
+        finally:
+            for piece_index in list(self._piece_buffers.keys()):
+                self.discard_piece(piece_index)
+            upload_cache.discard_owner(self)
+            file_handles.close_owner(self, final=True)
+
+
+class MappedWindow:
+    def __init__(self, mapping: mmap.mmap, start: int):
+        self.mapping = mapping
+        self.start = start
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.mapping)
+
+    def covers(self, file_pos: int, length: int) -> bool:
+        return self.start <= file_pos and file_pos + length <= self.end
+
+    def get_view(self, file_pos: int, length: int) -> memoryview:
+        begin = file_pos - self.start
+        return memoryview(self.mapping)[begin:begin + length]
+
+
+class MappedWindowCache:
+    """Daemon-wide LRU cache of windows mapped by MappedFileStructure instances.
+
+    The total length of the windows is bounded, so address space and RSS used by memory-mapped torrents
+    don't grow with their number (which matters on 32-bit systems). A mapping still referenced by memoryviews
+    (e.g. a block being sent) can't be closed when its window is evicted, so it's retired and closed later.
+    The cache is used from executor threads, so it's guarded by a threading lock.
+    """
+
+    MAX_MAPPED_LENGTH = 2 ** 28  # = 256 MiB
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windows = OrderedDict()  # type: Dict[Tuple[object, int, int], MappedWindow]
+        self._mapped_length = 0
+        self._retired_mappings = []    # type: List[Tuple[object, mmap.mmap]]
+        self._closed_owners = weakref.WeakSet()
+
+    @property
+    def mapped_length(self) -> int:
+        return self._mapped_length
+
+    def _close_mapping(self, owner: object, mapping: mmap.mmap):
+        try:
+            mapping.close()
+        except BufferError:
+            self._retired_mappings.append((owner, mapping))
+
+    def _close_retired_mappings(self):
+        retired_mappings = self._retired_mappings
+        self._retired_mappings = []
+        for owner, mapping in retired_mappings:
+            self._close_mapping(owner, mapping)
+
+    def _remove_window(self, key: Tuple[object, int, int]):
+        window = self._windows.pop(key)
+        self._mapped_length -= len(window.mapping)
+        self._close_mapping(key[0], window.mapping)
+
+    def _get_cached_view(self, key: Tuple[object, int, int], file_pos: int, length: int) -> Optional[memoryview]:
+        window = self._windows.get(key)
+        if window is None or not window.covers(file_pos, length):
+            return None
+        self._windows.move_to_end(key)
+        # The view is taken under the lock, so the window can't be closed before it's used
+        return window.get_view(file_pos, length)
+
+    def get_view(self, owner: object, index: int, start: int, file_pos: int, length: int,
+                 map_window: Callable[[], mmap.mmap]) -> memoryview:
+        """Returns a view of [file_pos, file_pos + length) of the owner's file `index` from the window starting
+        at `start`. If the window isn't mapped, calls `map_window()` (without holding the lock) to map it."""
+
+        key = (owner, index, start)
+        with self._lock:
+            if owner in self._closed_owners:
+                raise ValueError('I/O operation on a closed file structure')
+            view = self._get_cached_view(key, file_pos, length)
+        if view is not None:
+            return view
+
+        mapping = map_window()
+        with self._lock:
+            view = self._get_cached_view(key, file_pos, length)
+            if view is None and owner not in self._closed_owners:
+                if key in self._windows:
+                    self._remove_window(key)  # The range doesn't fit into the window mapped before
+                self._close_retired_mappings()
+                while self._windows and self._mapped_length + len(mapping) > MappedWindowCache.MAX_MAPPED_LENGTH:
+                    self._remove_window(next(iter(self._windows)))
+
+                window = MappedWindow(mapping, start)
+                self._windows[key] = window
+                self._mapped_length += len(mapping)
+                return window.get_view(file_pos, length)
+        mapping.close()  # Another thread has mapped the window in the meantime, or the owner has been closed
+        if view is None:
+            raise ValueError('I/O operation on a closed file structure')
+        return view
+
+    def close_owner(self, owner: object, *, final: bool=False) -> List[mmap.mmap]:
+        """Closes windows of the owner and returns its mappings that will be closed when nobody references them.
+        If `final` is set, the owner can't map windows anymore (`get_view` raises ValueError)."""
+
+        with self._lock:
+            for key in [key for key in self._windows if key[0] is owner]:
+                self._remove_window(key)
+            owner_mappings = [mapping for mapping_owner, mapping in self._retired_mappings if mapping_owner is owner]
+            if final:
+                self._closed_owners.add(owner)
+                # Nobody waits for these mappings anymore, they're unmapped when the last memoryview is released
+                self._retired_mappings = [(mapping_owner, mapping) for mapping_owner, mapping in self._retired_mappings
+                                          if mapping_owner is not owner]
+            return owner_mappings
+
+    def close_released_mappings(self):
+        with self._lock:
+            self._close_retired_mappings()
+
+
+mapped_windows = MappedWindowCache()
+
+
+class MappedFileStructure(FileStructure):
+    """File structure that accesses files through memory-mapped windows.
+
+    Windows are mapped lazily and evicted in LRU order from the daemon-wide `mapped_windows` cache, so address
+    space and RSS consumption of all memory-mapped torrents are bounded by MappedWindowCache.MAX_MAPPED_LENGTH.
+    `read` returns memoryviews of the mappings instead of copies when the requested range lies within one file.
+
+    If the disk is full, writing to a mapped page of a hole leads to SIGBUS instead of an error. So data is written
+    through the mappings only to files whose space is reserved with posix_fallocate(), and with pwrite() otherwise.
+    "sparse" preallocation is replaced with "fallocate" where it's available.
+    """
+
+    WINDOW_SIZE = 2 ** 25  # = 32 MiB
+
+    # Blocks are read from the mapped windows without copying anyway
+    USE_UPLOAD_CACHE = False
+    ZERO_COPY_READS = True
+
+    def __init__(self, download_dir: str, download_info: DownloadInfo, hashing_pool: HashingPool,
+                 io_scheduler: IOScheduler, *, preallocation: str='sparse'):
+        if preallocation == 'sparse' and hasattr(os, 'posix_fallocate'):
+            preallocation = 'fallocate'
+        super().__init__(download_dir, download_info, hashing_pool, io_scheduler, preallocation=preallocation)
+
+        self._old_mappings = []  # type: List[mmap.mmap]
+
+    def _map_window(self, index: int, start: int, length: int) -> mmap.mmap:
+        file_length = self._offsets[index + 1] - self._offsets[index]
+        with self._open_file(index) as handle:
+            if os.fstat(handle.fd).st_size < file_length:
+                # Access to a mapped region beyond the end of file leads to SIGBUS
+                os.ftruncate(handle.fd, file_length)
+            return mmap.mmap(handle.fd, length, offset=start)
+
+    def _get_view(self, index: int, file_pos: int, length: int) -> memoryview:
+        start = file_pos - file_pos % MappedFileStructure.WINDOW_SIZE
+        if file_pos + length > start + MappedFileStructure.WINDOW_SIZE:
+            # The range crosses a window boundary, so we map a window starting right before it
+            start = file_pos - file_pos % mmap.ALLOCATIONGRANULARITY
+        file_length = self._offsets[index + 1] - self._offsets[index]
+        window_length = min(max(MappedFileStructure.WINDOW_SIZE, file_pos + length - start), file_length - start)
+
+        return mapped_windows.get_view(self, index, start, file_pos, length,
+                                       lambda: self._map_window(index, start, window_length))
+
+    def _read_file(self, index: int, file_pos: int, length: int) -> memoryview:
+        return self._get_view(index, file_pos, length)
+
+    def _read_file_into(self, index: int, file_pos: int, buffer: memoryview):
+        view = self._get_view(index, file_pos, len(buffer))
+        buffer[:] = view
+        view.release()
+
+    def _write_file(self, index: int, file_pos: int, data: memoryview):
+        if index not in self._allocated_files:
+            super()._write_file(index, file_pos, data)  # pwrite() reports ENOSPC as an error
+            return
+
+        view = self._get_view(index, file_pos, len(data))
+        view[:] = data
+        view.release()
+
+    def relocate(self, download_dir: str):
+        super().relocate(download_dir)
+        # Mappings still referenced by memoryviews (e.g. blocks being sent) are closed later. Accessing them
+        # after the old files are truncated would lead to SIGBUS.
+        self._old_mappings += mapped_windows.close_owner(self)
+
+    def _are_old_files_released(self) -> bool:
+        mapped_windows.close_released_mappings()
+        self._old_mappings = [mapping for mapping in self._old_mappings if not mapping.closed]
+        return super()._are_old_files_released() and not self._old_mappings
+
+    async def close(self):
+        await super().close()
+
+        mapped_windows.close_owner(self, final=True)
+
+
+class MemoryFileStructure(FileStructure):
+    """Storage that keeps the data in memory instead of files. Useful for benchmarks and swarm simulations
+    without disk noise. The data is lost when the torrent is stopped."""
+
+    PERSISTENT = False
+    # Blocks are read without copying anyway
+    USE_UPLOAD_CACHE = False
+    ZERO_COPY_READS = True
+
+    def __init__(self, download_dir: str, download_info: DownloadInfo, hashing_pool: HashingPool,
+                 io_scheduler: IOScheduler, *, preallocation: str='sparse'):
+        super().__init__(download_dir, download_info, hashing_pool, io_scheduler, preallocation=preallocation)
+
+        self._contents_lock = threading.Lock()
+        self._contents = {}  # type: Dict[int, bytearray]
+
+    def _get_contents(self, index: int) -> bytearray:
+        with self._contents_lock:
+            contents = self._contents.get(index)
+            if contents is None:
+                contents = bytearray(self._offsets[index + 1] - self._offsets[index])
+                self._contents[index] = contents
+            return contents
+
+    def _read_file(self, index: int, file_pos: int, length: int) -> memoryview:
+        return memoryview(self._get_contents(index))[file_pos:file_pos + length]
+
+    def _read_file_into(self, index: int, file_pos: int, buffer: memoryview):
+        buffer[:] = self._read_file(index, file_pos, len(buffer))
+
+    def _write_file(self, index: int, file_pos: int, data: memoryview):
+        self._get_contents(index)[file_pos:file_pos + len(data)] = data
+
+    async def create_empty_files(self):
+        pass
+
+    async def preallocate(self):
+        pass
+
+    def _advise_will_need(self, index: int, file_pos: int, length: int):
+        pass
+
+    def pin_file_range(self, offset: int, length: int) -> None:
+        return None
+
+    async def close(self):
+        await super().close()
+
+        with self._contents_lock:
+            self._contents.clear()
+
+
+class NullFileStructure(FileStructure):
+    """Storage that discards written blocks and reads zeros, for testing pure network throughput.
+
+    Pieces are considered valid without hashing, and uploaded data is garbage, so only peers
+    with this storage can be downloaded from.
+    """
+
+    PERSISTENT = False
+    USE_UPLOAD_CACHE = False
+
+    async def read_block(self, piece_index: int, block_begin: int, length: int) -> bytes:
+        return bytes(length)
+
+    async def write_block(self, piece_index: int, block_begin: int, data: memoryview, *, acquire_lock=True):
+        pass
+
+    async def hash_piece(self, piece_index: int) -> bytes:
+        return self._download_info.pieces[piece_index].piece_hash
+
+    async def recheck(self, piece_indexes: Iterable[int], on_piece_checked: Callable[[int, bool], None]):
+        for piece_index in piece_indexes:
+            on_piece_checked(piece_index, True)
+
+    async def create_empty_files(self):
+        pass
+
+    async def preallocate(self):
+        pass
+
+    def pin_file_range(self, offset: int, length: int) -> None:
+        return None
+
+
+STORAGE_MODES = {
+    'files': FileStructure,
+    'mmap': MappedFileStructure,
+    'memory': MemoryFileStructure,
+    'null': NullFileStructure,
+}
+
+
+def create_file_structure(storage_mode: str, download_dir: str, download_info: DownloadInfo,
+                          hashing_pool: HashingPool, io_scheduler: IOScheduler, *,
+                          preallocation: str='sparse') -> BaseStorage:
+    if storage_mode not in STORAGE_MODES:
+        raise ValueError('Unknown storage mode "{}"'.format(storage_mode))
+    return STORAGE_MODES[storage_mode](download_dir, download_info, hashing_pool, io_scheduler,
+                                       preallocation=preallocation)
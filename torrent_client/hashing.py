@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Optional
+
+
+__all__ = ['HashingPool', 'HashingState']
+
+
+def sha1_digest(data: bytes) -> bytes:
+    return hashlib.sha1(data).digest()
+
+
+class HashingJob:
+    def __init__(self, func: Callable, args: tuple, size: int, future: asyncio.Future):
+        self.func = func
+        self.args = args
+        self.size = size
+        self.future = future
+
+
+class HashingState:
+    """Snapshot of HashingPool statistics that can be sent via socket."""
+
+    def __init__(self, pool: 'HashingPool'):
+        self.worker_count = pool.worker_count
+        self.running_job_count = pool.running_job_count
+        self.queued_job_count = pool.queued_job_count
+        self.hashed_bytes = pool.hashed_bytes
+        self.hashing_speed = pool.hashing_speed
+
+
+class HashingPool:
+    """Daemon-wide pool of workers computing SHA-1 off the event loop thread.
+
+    Jobs are queued per owner (usually a torrent) and dispatched in round-robin order, so a torrent that hashes
+    a lot of data (e.g. during a recheck) doesn't delay validation of pieces of other torrents. `hashlib` releases
+    the GIL while hashing large buffers, so worker threads run in parallel.
+    """
+
+    WORKER_COUNT = os.cpu_count() or 1
+    MAX_QUEUED_JOBS = 256
+
+    def __init__(self, worker_count: Optional[int]=None):
+        self._worker_count = worker_count if worker_count is not None else HashingPool.WORKER_COUNT
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+
+        self._queues = OrderedDict()  # type: Dict[Any, Deque[HashingJob]]
+        self._queued_job_count = 0
+        self._running_job_count = 0
+        self._queue_slots = None  # type: Optional[asyncio.Semaphore]
+
+        self._hashed_bytes = 0
+        self._busy_time = 0.0
+
+    @property
+    def worker_count(self) -> int:
+        return self._worker_count
+
+    @property
+    def queued_job_count(self) -> int:
+        return self._queued_job_count
+
+    @property
+    def running_job_count(self) -> int:
+        return self._running_job_count
+
+    @property
+    def hashed_bytes(self) -> int:
+        return self._hashed_bytes
+
+    @property
+    def hashing_speed(self) -> Optional[float]:
+        """Average speed of one worker (bytes/s)."""
+
+        return self._hashed_bytes / self._busy_time if self._busy_time else None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self._worker_count)
+        return self._executor
+
+    def _finish_job(self, job: HashingJob, start_time: float, result_future: asyncio.Future):
+        self._running_job_count -= 1
+        self._busy_time += time.monotonic() - start_time
+        self._hashed_bytes += job.size
+
+        if not job.future.done():
+            exc = result_future.exception()
+            if exc is not None:
+                job.future.set_exception(exc)
+            else:
+                job.future.set_result(result_future.result())
+
+        self._dispatch_jobs()
+
+    def _dispatch_jobs(self):
+        loop = asyncio.get_event_loop()
+        while self._running_job_count < self._worker_count and self._queues:
+            owner, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            if queue:
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+            self._queued_job_count -= 1
+            self._queue_slots.release()
+
+            if job.future.done():  # The job was cancelled while it was waiting in the queue
+                continue
+
+            self._running_job_count += 1
+            result_future = loop.run_in_executor(self._get_executor(), job.func, *job.args)
+            result_future.add_done_callback(
+                lambda fut, job=job, start_time=time.monotonic(): self._finish_job(job, start_time, fut))
+
+    async def run(self, owner: Any, func: Callable, *args, size: int) -> Any:
+        """Executes a function that hashes `size` bytes in a worker thread."""
+
+        if self._queue_slots is None:
+            self._queue_slots = asyncio.Semaphore(HashingPool.MAX_QUEUED_JOBS)
+        await self._queue_slots.acquire()
+
+        job = HashingJob(func, args, size, asyncio.get_event_loop().create_future())
+        self._queues.setdefault(owner, deque()).append(job)
+        self._queued_job_count += 1
+        self._dispatch_jobs()
+
+        return await job.future
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,230 @@
+import asyncio
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Callable, Deque, Dict, Optional
+
+
+__all__ = ['IOClass', 'IOScheduler', 'IOSchedulerState']
+
+
+class IOClass(Enum):
+    """Classes of disk operations in the order of decreasing priority."""
+
+    download_write = 0
+    validation_read = 1
+    upload_read = 2
+    recheck = 3
+    background = 4  # Preallocation and other maintenance
+
+
+class LatencyHistogram:
+    """Histogram of operation latencies (including time spent in the queue) with exponential buckets."""
+
+    BUCKET_BOUNDS = [0.001 * 2 ** i for i in range(12)]  # From 1 ms to ~2 s, the last bucket is unbounded
+
+    def __init__(self):
+        self.counts = [0] * (len(LatencyHistogram.BUCKET_BOUNDS) + 1)
+        self.total_count = 0
+        self.total_time = 0.0
+
+    def add(self, latency: float):
+        self.counts[bisect_left(LatencyHistogram.BUCKET_BOUNDS, latency)] += 1
+        self.total_count += 1
+        self.total_time += latency
+
+    def get_percentile(self, fraction: float) -> Optional[float]:
+        """Returns an upper bound of the latency percentile (or infinity if it falls into the last bucket)."""
+
+        if not self.total_count:
+            return None
+        threshold = fraction * self.total_count
+        accumulated = 0
+        for bound, count in zip(LatencyHistogram.BUCKET_BOUNDS, self.counts):
+            accumulated += count
+            if accumulated >= threshold:
+                return bound
+        return float('inf')
+
+
+class IOJob:
+    def __init__(self, func: Callable, future: asyncio.Future):
+        self.func = func
+        self.future = future
+        self.submit_time = time.monotonic()
+
+
+class IOClassState:
+    def __init__(self, running_count: int, queued_count: int, histogram: LatencyHistogram):
+        self.running_count = running_count
+        self.queued_count = queued_count
+        self.completed_count = histogram.total_count
+        self.average_latency = histogram.total_time / histogram.total_count if histogram.total_count else None
+        self.median_latency = histogram.get_percentile(0.5)
+        self.p99_latency = histogram.get_percentile(0.99)
+        self.bucket_bounds = LatencyHistogram.BUCKET_BOUNDS
+        self.bucket_counts = list(histogram.counts)
+
+
+class IOSchedulerState:
+    """Snapshot of IOScheduler statistics that can be sent via socket."""
+
+    def __init__(self, scheduler: 'IOScheduler'):
+        self.worker_count = IOScheduler.WORKER_COUNT
+        self.pending_write_bytes = scheduler.pending_write_bytes
+        self.max_pending_write_bytes = IOScheduler.MAX_PENDING_WRITE_BYTES
+        self.write_latency = scheduler.write_latency
+        self.classes = OrderedDict((io_class, scheduler.get_class_state(io_class))
+                                   for io_class in IOClass)  # type: Dict[IOClass, IOClassState]
+
+
+class IOScheduler:
+    """Daemon-wide scheduler of disk operations of all file structures.
+
+    Operations are executed by a fixed number of worker threads. When a worker is free, it takes an operation
+    of the most important class that hasn't reached its concurrency limit, so e.g. a recheck can't occupy
+    all workers and delay writing of downloaded blocks. Each class is still guaranteed one worker: a class
+    that has queued operations but none running is served first, otherwise the more important classes
+    (whose limits sum to more than the number of workers) could starve it. Within a class, operations
+    of different owners (torrents) are taken in round-robin order.
+
+    The scheduler also accounts downloaded data that waits to be written to disk, so downloaders can stop
+    requesting blocks when the disks can't keep up with the network (see `FileStructure.write`).
+    """
+
+    WORKER_COUNT = 8
+    CLASS_LIMITS = {
+        IOClass.download_write: 4,
+        IOClass.validation_read: 2,
+        IOClass.upload_read: 4,
+        IOClass.recheck: 1,
+        IOClass.background: 1,
+    }
+
+    MAX_PENDING_WRITE_BYTES = 2 ** 27  # = 128 MiB
+    WRITE_LATENCY_SMOOTHING = 0.1
+
+    def __init__(self):
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+
+        self._queues = {io_class: OrderedDict() for io_class in IOClass}  # type: Dict[IOClass, Dict[Any, Deque[IOJob]]]
+        self._queued_counts = {io_class: 0 for io_class in IOClass}
+        self._running_counts = {io_class: 0 for io_class in IOClass}
+        self._running_total = 0
+
+        self._histograms = {io_class: LatencyHistogram() for io_class in IOClass}
+
+        self._pending_write_bytes = 0
+        self._write_latency = None  # type: Optional[float]
+        self._write_progress = None  # type: Optional[asyncio.Event]
+
+    def get_class_state(self, io_class: IOClass) -> IOClassState:
+        return IOClassState(self._running_counts[io_class], self._queued_counts[io_class],
+                            self._histograms[io_class])
+
+    @property
+    def pending_write_bytes(self) -> int:
+        return self._pending_write_bytes
+
+    @property
+    def write_latency(self) -> Optional[float]:
+        """Exponential moving average of download write latency (seconds)."""
+
+        return self._write_latency
+
+    def is_write_backlog_full(self) -> bool:
+        return self._pending_write_bytes >= IOScheduler.MAX_PENDING_WRITE_BYTES
+
+    def is_write_backlog_drained(self) -> bool:
+        return self._pending_write_bytes <= IOScheduler.MAX_PENDING_WRITE_BYTES // 2
+
+    def add_pending_write(self, size: int):
+        self._pending_write_bytes += size
+
+    def finish_pending_write(self, size: int):
+        self._pending_write_bytes -= size
+        if self._write_progress is not None:
+            self._write_progress.set()
+            self._write_progress.clear()
+
+    async def wait_write_progress(self):
+        """Waits until some pending write of any file structure is finished."""
+
+        if self._write_progress is None:
+            self._write_progress = asyncio.Event()
+        await self._write_progress.wait()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(IOScheduler.WORKER_COUNT)
+        return self._executor
+
+    def _finish_job(self, io_class: IOClass, job: IOJob, result_future: asyncio.Future):
+        self._running_counts[io_class] -= 1
+        self._running_total -= 1
+        latency = time.monotonic() - job.submit_time
+        self._histograms[io_class].add(latency)
+        if io_class == IOClass.download_write:
+            if self._write_latency is None:
+                self._write_latency = latency
+            else:
+                self._write_latency += IOScheduler.WRITE_LATENCY_SMOOTHING * (latency - self._write_latency)
+
+        if not job.future.done():
+            exc = result_future.exception()
+            if exc is not None:
+                job.future.set_exception(exc)
+            else:
+                job.future.set_result(result_future.result())
+
+        self._dispatch_jobs()
+
+    def _get_next_class(self) -> Optional[IOClass]:
+        for io_class in IOClass:
+            if self._queues[io_class] and not self._running_counts[io_class]:
+                return io_class
+        for io_class in IOClass:
+            queues = self._queues[io_class]
+            if queues and self._running_counts[io_class] < IOScheduler.CLASS_LIMITS[io_class]:
+                return io_class
+        return None
+
+    def _dispatch_jobs(self):
+        loop = asyncio.get_event_loop()
+        while self._running_total < IOScheduler.WORKER_COUNT:
+            io_class = self._get_next_class()
+            if io_class is None:
+                return
+
+            queues = self._queues[io_class]
+            owner, queue = next(iter(queues.items()))
+            job = queue.popleft()
+            if queue:
+                queues.move_to_end(owner)
+            else:
+                del queues[owner]
+            self._queued_counts[io_class] -= 1
+
+            if job.future.done():  # The job was cancelled while it was waiting in the queue
+                continue
+
+            self._running_counts[io_class] += 1
+            self._running_total += 1
+            result_future = loop.run_in_executor(self._get_executor(), job.func)
+            result_future.add_done_callback(
+                lambda fut, io_class=io_class, job=job: self._finish_job(io_class, job, fut))
+
+    async def run(self, owner: Any, io_class: IOClass, func: Callable[[], Any]) -> Any:
+        job = IOJob(func, asyncio.get_event_loop().create_future())
+        self._queues[io_class].setdefault(owner, deque()).append(job)
+        self._queued_counts[io_class] += 1
+        self._dispatch_jobs()
+
+        return await job.future
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -7,19 +7,35 @@ import struct
 import time
 from collections import OrderedDict
 from math import ceil
-from typing import List, Set, cast, Optional, Dict, Union, Any, Iterator
+from typing import List, Set, cast, Optional, Dict, Union, Any, Iterable, Iterator
 
 import bencodepy
 from bitarray import bitarray
 
-from torrent_client.utils import grouper
-
 
 def generate_peer_id():
     return bytes(random.randint(0, 255) for _ in range(20))
 
 
+def restore_slots(obj: object, state: Union[dict, tuple]):
+    """Restores a pickled object of a class with `__slots__`.
+
+    States saved by older versions are dictionaries of the instance `__dict__`. Fields that don't exist anymore
+    are ignored.
+    """
+
+    if isinstance(state, tuple):
+        _, state = state
+    for name, value in state.items():
+        try:
+            setattr(obj, name, value)
+        except AttributeError:
+            pass
+
+
 class Peer:
+    __slots__ = ('_host', '_port', 'peer_id', '_hash')
+
     def __init__(self, host: str, port: int, peer_id: bytes=None):
         # FIXME: Need we typecheck for the case of malicious data?
 
@@ -29,6 +45,10 @@ class Peer:
 
         self._hash = hash((host, port))  # Important for performance
 
+    def __setstate__(self, state: Union[dict, tuple]):
+        restore_slots(self, state)
+        self._hash = hash((self._host, self._port))  # String hashes are different in each process
+
     @property
     def host(self) -> str:
         return self._host
@@ -69,6 +89,8 @@ def get_utf8(dictionary: OrderedDict, key: bytes):
 
 
 class FileInfo:
+    __slots__ = ('_length', '_path', '_md5sum', 'offset', 'selected')
+
     def __init__(self, length: int, path: List[str], *, md5sum: str=None):
         self._length = length
         self._path = path
@@ -77,6 +99,8 @@ class FileInfo:
         self.offset = None
         self.selected = True
 
+    __setstate__ = restore_slots
+
     @property
     def length(self) -> int:
         return self._length
@@ -100,6 +124,8 @@ class FileInfo:
 
 
 class BlockRequest:
+    __slots__ = ('piece_index', 'block_begin', 'block_length')
+
     def __init__(self, piece_index: int, block_begin: int, block_length: int):
         self.piece_index = piece_index
         self.block_begin = block_begin
@@ -108,97 +134,189 @@ class BlockRequest:
     def __eq__(self, other):
         if not isinstance(other, BlockRequest):
             return False
-        return self.__dict__ == other.__dict__
+        return (self.piece_index == other.piece_index and self.block_begin == other.block_begin and
+                self.block_length == other.block_length)
 
     def __hash__(self):
         return hash((self.piece_index, self.block_begin, self.block_length))
 
 
-class BlockRequestFuture(asyncio.Future, BlockRequest):
+class BlockRequestFuture(asyncio.Future):
+    """A block request that is resolved with the peer that sent the block.
+
+    It has the same fields as `BlockRequest`, but can't derive from it: two bases with slots (`asyncio.Future`
+    is implemented in C) would have conflicting instance layouts.
+    """
+
+    __slots__ = ('piece_index', 'block_begin', 'block_length', 'prev_performers', 'performer')
+
     def __init__(self, piece_index: int, block_begin: int, block_length: int):
-        asyncio.Future.__init__(self)
-        BlockRequest.__init__(self, piece_index, block_begin, block_length)
+        super().__init__()
+
+        self.piece_index = piece_index
+        self.block_begin = block_begin
+        self.block_length = block_length
 
         self.prev_performers = set()
         self.performer = None
 
-    __eq__ = asyncio.Future.__eq__
-    __hash__ = asyncio.Future.__hash__
-
 
 SHA1_DIGEST_LEN = 20
 
 
-class PieceInfo:
-    def __init__(self, piece_hash: bytes, length: int):
-        self._piece_hash = piece_hash
-        self._length = length
+class _PartialPiece:
+    """Download state of a piece that is started but not downloaded yet."""
 
-        self.selected = True
-        self.owners = set()  # type: Set[Peer]
+    __slots__ = ('validating', 'sources', 'block_downloaded', 'blocks_expected', 'hasher', 'hashed_length')
 
+    def __init__(self):
         self.validating = False
+        self.sources = set()  # type: Set[Peer]
+        self.block_downloaded = None  # type: Optional[bitarray]
+        self.blocks_expected = set()  # type: Set[BlockRequestFuture]
+        self.hasher = None
+        self.hashed_length = 0
 
-        self._downloaded = None
-        self._sources = None
-        self._block_downloaded = None  # type: Optional[bitarray]
-        self._blocks_expected = None
-        self.reset_content()
+    __setstate__ = restore_slots
 
     def reset_content(self):
-        self._downloaded = False
-        self._sources = set()
+        self.sources = set()
+        self.block_downloaded = None
+        self.blocks_expected = set()
+        self.reset_hash()
 
-        self._block_downloaded = None
-        self._blocks_expected = set()
+    def reset_hash(self):
+        self.hasher = None
+        self.hashed_length = 0
 
     def reset_run_state(self):
-        self.owners = set()
-
         self.validating = False
 
-        self._blocks_expected = set()
+        self.blocks_expected = set()
+        # Hash objects can't be serialized, and the hashed data will be read from disk again
+        self.reset_hash()
+
+    def has_downloaded_blocks(self) -> bool:
+        return self.block_downloaded is not None and self.block_downloaded.any()
+
+
+class PieceInfo:
+    """View of a piece stored in a `PieceTable`.
+
+    Views are created on access and don't keep any state themselves, so the download state of a piece
+    is allocated only when somebody starts downloading it.
+    """
+
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table: 'PieceTable', index: int):
+        self._table = table
+        self._index = index
+
+    def __setstate__(self, state: Union[dict, tuple]):
+        # Older versions saved pieces as separate objects. Each of them is loaded as a table of one piece,
+        # and DownloadInfo.__setstate__ merges the tables.
+        if isinstance(state, tuple):
+            _, state = state
+        table = PieceTable(state['_piece_hash'], state['_length'], state['_length'])
+        table.selected[0] = state['selected']
+        if state['_downloaded']:
+            table.downloaded[0] = True
+        elif state.get('_block_downloaded') is not None:
+            partial = table._partial_pieces[0] = _PartialPiece()
+            partial.sources = state['_sources']
+            partial.block_downloaded = state['_block_downloaded']
+        self._table = table
+        self._index = 0
+
+    def _get_partial(self) -> Optional[_PartialPiece]:
+        return self._table._partial_pieces.get(self._index)
+
+    def _get_or_create_partial(self) -> _PartialPiece:
+        partial_pieces = self._table._partial_pieces
+        partial = partial_pieces.get(self._index)
+        if partial is None:
+            partial = partial_pieces[self._index] = _PartialPiece()
+        return partial
 
     @property
     def piece_hash(self) -> bytes:
-        return self._piece_hash
+        return self._table.get_piece_hash(self._index)
 
     @property
     def length(self) -> int:
-        return self._length
+        return self._table.get_piece_length(self._index)
+
+    @property
+    def selected(self) -> bool:
+        return bool(self._table.selected[self._index])
+
+    @selected.setter
+    def selected(self, value: bool):
+        self._table.selected[self._index] = value
+
+    @property
+    def validating(self) -> bool:
+        partial = self._get_partial()
+        return partial is not None and partial.validating
+
+    @validating.setter
+    def validating(self, value: bool):
+        if value:
+            self._get_or_create_partial().validating = True
+            return
+        partial = self._get_partial()
+        if partial is not None:
+            partial.validating = False
 
     @property
     def downloaded(self) -> bool:
-        return self._downloaded
+        return bool(self._table.downloaded[self._index])
 
     @property
-    def sources(self) -> Set[Peer]:
-        return self._sources
+    def sources(self) -> Optional[Set[Peer]]:
+        if self.downloaded:
+            return None
+        partial = self._get_partial()
+        return partial.sources if partial is not None else set()
 
     @property
     def blocks_expected(self) -> Optional[Set[BlockRequestFuture]]:
-        return self._blocks_expected
+        """Requests of the blocks that are being downloaded. Should be accessed only for pieces in progress:
+        the download state of the piece is allocated on the first access."""
+
+        if self.downloaded:
+            return None
+        return self._get_or_create_partial().blocks_expected
+
+    def reset_content(self):
+        self._table.downloaded[self._index] = False
+        partial = self._get_partial()
+        if partial is not None:
+            partial.reset_content()
 
     def mark_downloaded_blocks(self, source: Peer, request: BlockRequest):
-        if self._downloaded:
+        if self.downloaded:
             raise ValueError('The whole piece is already downloaded')
 
-        self._sources.add(source)
+        partial = self._get_or_create_partial()
+        partial.sources.add(source)
 
-        arr = self._block_downloaded
+        length = self.length
+        arr = partial.block_downloaded
         if arr is None:
-            arr = bitarray(ceil(self._length / DownloadInfo.MARKED_BLOCK_SIZE))
+            arr = bitarray(ceil(length / DownloadInfo.MARKED_BLOCK_SIZE))
             arr.setall(False)
-            self._block_downloaded = arr
+            partial.block_downloaded = arr
 
         mark_begin = ceil(request.block_begin / DownloadInfo.MARKED_BLOCK_SIZE)
-        if request.block_begin + request.block_length == self._length:
+        if request.block_begin + request.block_length == length:
             mark_end = len(arr)
         else:
             mark_end = (request.block_begin + request.block_length) // DownloadInfo.MARKED_BLOCK_SIZE
         arr[mark_begin:mark_end] = True
 
-        blocks_expected = cast(Set[BlockRequestFuture], self._blocks_expected)
+        blocks_expected = partial.blocks_expected
         downloaded_blocks = []
         for fut in blocks_expected:
             query_begin = fut.block_begin // DownloadInfo.MARKED_BLOCK_SIZE
@@ -209,19 +327,162 @@ class PieceInfo:
         for fut in downloaded_blocks:
             blocks_expected.remove(fut)
 
+    @property
+    def hashed_length(self) -> int:
+        partial = self._get_partial()
+        return partial.hashed_length if partial is not None else 0
+
+    def update_hash(self, data_begin: int, data: memoryview):
+        """Feeds the part of `data` that continues the hashed prefix of the piece to the SHA-1 object.
+        Data located after a gap in the hashed prefix is ignored.
+        """
+
+        partial = self._get_or_create_partial()
+        data_end = data_begin + len(data)
+        if data_begin > partial.hashed_length or data_end <= partial.hashed_length:
+            return
+
+        if partial.hasher is None:
+            partial.hasher = hashlib.sha1()
+        partial.hasher.update(data[partial.hashed_length - data_begin:])
+        partial.hashed_length = data_end
+
+    def hash_digest(self) -> bytes:
+        partial = self._get_partial()
+        if partial is None or partial.hashed_length != self.length:
+            raise ValueError('The piece is not hashed completely')
+        return partial.hasher.digest()
+
+    @property
+    def downloaded_blocks(self) -> Optional[bitarray]:
+        """Bitmap of downloaded parts of the piece (of DownloadInfo.MARKED_BLOCK_SIZE each), or None
+        if no blocks are downloaded or the whole piece is downloaded."""
+
+        partial = self._get_partial()
+        return partial.block_downloaded if partial is not None else None
+
+    def restore_downloaded_blocks(self, arr: bitarray):
+        if self.downloaded:
+            raise ValueError('The whole piece is already downloaded')
+        if len(arr) != ceil(self.length / DownloadInfo.MARKED_BLOCK_SIZE):
+            raise ValueError('Invalid bitmap length')
+
+        self._get_or_create_partial().block_downloaded = arr
+
+    def has_downloaded_blocks(self) -> bool:
+        if self.downloaded:
+            return True
+        partial = self._get_partial()
+        return partial is not None and partial.has_downloaded_blocks()
+
     def are_all_blocks_downloaded(self) -> bool:
-        return self._downloaded or (self._block_downloaded is not None and self._block_downloaded.all())
+        if self.downloaded:
+            return True
+        arr = self.downloaded_blocks
+        return arr is not None and arr.all()
 
     def mark_as_downloaded(self):
-        if self._downloaded:
+        if self.downloaded:
             raise ValueError('The piece is already downloaded')
 
-        self._downloaded = True
-
+        self._table.downloaded[self._index] = True
         # Delete data structures for this piece to save memory
-        self._sources = None
-        self._block_downloaded = None
-        self._blocks_expected = None
+        self._table._partial_pieces.pop(self._index, None)
+
+
+class PieceTable:
+    """Pieces of a torrent stored column-wise.
+
+    Piece hashes are kept in one bytes object and the flags in bitarrays, so a torrent with millions of pieces
+    doesn't need millions of objects. The download state is stored only for pieces that were started but
+    aren't downloaded yet. Indexing returns `PieceInfo` views.
+    """
+
+    def __init__(self, piece_hashes: bytes, piece_length: int, total_size: int):
+        if not piece_hashes or len(piece_hashes) % SHA1_DIGEST_LEN != 0:
+            raise ValueError('Invalid length of "pieces" string')
+
+        self._hashes = piece_hashes
+        self._piece_length = piece_length
+        self._piece_count = len(piece_hashes) // SHA1_DIGEST_LEN
+        self._last_piece_length = total_size - (self._piece_count - 1) * piece_length
+
+        self._selected = bitarray(self._piece_count)
+        self._selected.setall(True)
+        self._downloaded = bitarray(self._piece_count)
+        self._downloaded.setall(False)
+        self._partial_pieces = {}  # type: Dict[int, _PartialPiece]
+
+    @classmethod
+    def from_pieces(cls, pieces: List[PieceInfo], piece_length: int, total_size: int):
+        result = cls(b''.join(info.piece_hash for info in pieces), piece_length, total_size)
+        for index, info in enumerate(pieces):
+            result._selected[index] = info.selected
+            if info.downloaded:
+                result._downloaded[index] = True
+            elif info.downloaded_blocks is not None:
+                result[index].restore_downloaded_blocks(info.downloaded_blocks)
+                result[index].sources.update(info.sources)
+        return result
+
+    def __len__(self) -> int:
+        return self._piece_count
+
+    def __getitem__(self, index: int) -> PieceInfo:
+        if index < 0:
+            index += self._piece_count
+        if not 0 <= index < self._piece_count:
+            raise IndexError('Piece index out of range')
+        return PieceInfo(self, index)
+
+    def __iter__(self) -> Iterator[PieceInfo]:
+        return (PieceInfo(self, index) for index in range(self._piece_count))
+
+    def get_piece_hash(self, index: int) -> bytes:
+        return self._hashes[index * SHA1_DIGEST_LEN:(index + 1) * SHA1_DIGEST_LEN]
+
+    def get_piece_length(self, index: int) -> int:
+        return self._last_piece_length if index == self._piece_count - 1 else self._piece_length
+
+    @property
+    def selected(self) -> bitarray:
+        return self._selected
+
+    @property
+    def downloaded(self) -> bitarray:
+        return self._downloaded
+
+    @property
+    def partial_piece_indexes(self) -> Iterable[int]:
+        """Indexes of pieces that have a download state (i.e. started but not downloaded)."""
+
+        return self._partial_pieces.keys()
+
+    def get_remaining_pieces(self) -> bitarray:
+        """Returns a mask of selected pieces that aren't downloaded yet."""
+
+        return self._selected & ~self._downloaded
+
+    def reset_content(self, downloaded: bitarray):
+        """Replaces the flags of downloaded pieces and drops all partially downloaded blocks."""
+
+        self._downloaded[:] = downloaded
+        self._partial_pieces = {}
+
+    def copy_without_run_state(self) -> 'PieceTable':
+        """Returns an independent copy of the table. Partial pieces without downloaded blocks are dropped,
+        so this takes time proportional to the number of pieces in progress."""
+
+        result = copy.copy(self)
+        result._selected = bitarray(self._selected)
+        result._downloaded = bitarray(self._downloaded)
+        result._partial_pieces = {}
+        for index, partial in self._partial_pieces.items():
+            if partial.has_downloaded_blocks():
+                partial = copy.copy(partial)
+                partial.reset_run_state()
+                result._partial_pieces[index] = partial
+        return result
 
 
 class SessionStatistics:
@@ -234,6 +495,9 @@ class SessionStatistics:
         self.download_speed = None  # type: Optional[float]
         self.upload_speed = None    # type: Optional[float]
 
+        self.upload_cache_hits = 0
+        self.upload_cache_misses = 0
+
         if prev_session_stats is not None:
             self._total_downloaded = prev_session_stats.total_downloaded
             self._total_uploaded = prev_session_stats.total_uploaded
@@ -241,6 +505,12 @@ class SessionStatistics:
             self._total_downloaded = 0
             self._total_uploaded = 0
 
+    def __setstate__(self, state: dict):
+        # States saved by older versions don't contain the cache counters
+        self.upload_cache_hits = 0
+        self.upload_cache_misses = 0
+        self.__dict__.update(state)
+
     @property
     def peer_last_download(self) -> Dict[Peer, float]:
         return self._peer_last_download
@@ -291,6 +561,137 @@ class SessionStatistics:
         self._total_uploaded += size
 
 
+class RecheckProgress:
+    def __init__(self, total_size: int, piece_count: int):
+        self.total_size = total_size
+        self.piece_count = piece_count
+        self.checked_size = 0
+        self.checked_piece_count = 0
+        self.valid_piece_count = 0
+
+        self._start_time = time.monotonic()
+        self._finish_time = None  # type: Optional[float]
+
+    def finish(self):
+        self._finish_time = time.monotonic()
+
+    @property
+    def elapsed_time(self) -> float:
+        end_time = self._finish_time if self._finish_time is not None else time.monotonic()
+        return end_time - self._start_time
+
+    @property
+    def speed(self) -> Optional[float]:
+        elapsed_time = self.elapsed_time
+        return self.checked_size / elapsed_time if elapsed_time else None
+
+    @property
+    def progress(self) -> float:
+        return self.checked_size / self.total_size if self.total_size else 1
+
+
+class PieceAvailability:
+    """Numbers of connected peers that have each piece.
+
+    Counters are stored in bit planes: the k-th bitarray contains k-th bits of the counters of all pieces.
+    This way a bitfield of a connected or disconnected peer is added or subtracted with a few bulk bitwise
+    operations (one per plane) instead of a loop over pieces.
+    """
+
+    def __init__(self, piece_count: int):
+        self._piece_count = piece_count
+        self._planes = []  # type: List[bitarray]
+
+    def _make_unit(self, piece_index: int) -> bitarray:
+        arr = bitarray(self._piece_count)
+        arr.setall(False)
+        arr[piece_index] = True
+        return arr
+
+    def add(self, pieces: bitarray):
+        carry = bitarray(pieces)
+        for plane in self._planes:
+            if not carry.any():
+                return
+            next_carry = plane & carry
+            plane ^= carry
+            carry = next_carry
+        if carry.any():
+            self._planes.append(carry)
+
+    def subtract(self, pieces: bitarray):
+        borrow = bitarray(pieces)
+        for plane in self._planes:
+            if not borrow.any():
+                break
+            next_borrow = borrow & ~plane
+            plane ^= borrow
+            borrow = next_borrow
+        if borrow.any():
+            raise ValueError('Piece availability became negative')
+
+        while self._planes and not self._planes[-1].any():
+            self._planes.pop()
+
+    def add_piece(self, piece_index: int):
+        for plane in self._planes:
+            if not plane[piece_index]:
+                plane[piece_index] = True
+                return
+            plane[piece_index] = False
+        self._planes.append(self._make_unit(piece_index))
+
+    def __getitem__(self, piece_index: int) -> int:
+        result = 0
+        for bit, plane in enumerate(self._planes):
+            if plane[piece_index]:
+                result |= 1 << bit
+        return result
+
+    def _get_rarest(self, candidates: bitarray) -> bitarray:
+        """Returns a mask of the candidates with the minimal availability."""
+
+        result = candidates
+        for plane in reversed(self._planes):
+            # Going from the most significant bits, we keep the candidates with zero bits if there are any
+            lower = result & ~plane
+            if lower.any():
+                result = lower
+        return result
+
+    @staticmethod
+    def _take_from_random_position(arr: bitarray, count: int) -> List[int]:
+        start = random.randrange(len(arr))
+        result = []
+        for begin, end in ((start, len(arr)), (0, start)):
+            while len(result) < count:
+                try:
+                    index = arr.index(True, begin, end)
+                except ValueError:
+                    break
+                result.append(index)
+                begin = index + 1
+        return result
+
+    def select_rarest(self, candidates: bitarray, count: int) -> List[int]:
+        """Returns up to `count` least available pieces among the candidates (given as a mask).
+
+        The buckets of pieces with equal availability are found with one bulk operation per plane, so nothing
+        is sorted or rebuilt. Pieces within a bucket are taken starting from a random position, so different
+        clients don't download the same pieces first.
+        """
+
+        result = []
+        while len(result) < count and candidates.any():
+            rarest = self._get_rarest(candidates)
+            result += PieceAvailability._take_from_random_position(rarest, count - len(result))
+            candidates = candidates & ~rarest
+        return result
+
+    def __len__(self) -> int:
+        return self._piece_count
+
+
 FileTreeNode = Union[FileInfo, Dict[str, Any]]
 
 
@@ -298,7 +699,7 @@ class DownloadInfo:
     MARKED_BLOCK_SIZE = 2 ** 10
 
     def __init__(self, info_hash: bytes,
-                 piece_length: int, piece_hashes: List[bytes], suggested_name: str, files: List[FileInfo], *,
+                 piece_length: int, piece_hashes: bytes, suggested_name: str, files: List[FileInfo], *,
                  private: bool=False):
         self.info_hash = info_hash
         self.piece_length = piece_length
@@ -310,16 +711,12 @@ class DownloadInfo:
 
         self.private = private
 
-        assert piece_hashes
-        self._pieces = [PieceInfo(item, piece_length) for item in piece_hashes[:-1]]
-        last_piece_length = self.total_size - (len(piece_hashes) - 1) * self.piece_length
-        self._pieces.append(PieceInfo(piece_hashes[-1], last_piece_length))
-
-        piece_count = len(piece_hashes)
-        if ceil(self.total_size / piece_length) != piece_count:
+        self._pieces = PieceTable(piece_hashes, piece_length, self.total_size)
+        if ceil(self.total_size / piece_length) != len(self._pieces):
             raise ValueError('Invalid count of piece hashes')
 
         self._interesting_pieces = None
+        self._piece_availability = None
         self.downloaded_piece_count = 0
         self._complete = False
 
@@ -327,6 +724,17 @@ class DownloadInfo:
 
         self._session_statistics = SessionStatistics(None)
 
+        self.recheck_progress = None  # type: Optional[RecheckProgress]
+
+    def __setstate__(self, state: dict):
+        # States saved by older versions don't contain these fields
+        self.recheck_progress = None
+        self._piece_availability = None
+        self.__dict__.update(state)
+
+        if isinstance(self._pieces, list):
+            self._pieces = PieceTable.from_pieces(self._pieces, self.piece_length, self.total_size)
+
     @property
     def single_file_mode(self) -> bool:
         return len(self.files) == 1 and not self.files[0].path
@@ -371,8 +779,8 @@ class DownloadInfo:
             raise ValueError('Invalid mode "{}"'.format(mode))
         include_paths = (mode == 'whitelist')
 
-        for info in self.pieces:
-            info.selected = not include_paths
+        selected_pieces = self._pieces.selected
+        selected_pieces.setall(not include_paths)
         for info in self.files:
             info.selected = not include_paths
 
@@ -402,15 +810,16 @@ class DownloadInfo:
                 piece_begin = ceil(offset / self.piece_length)
                 piece_end = (offset + length) // self.piece_length
 
-            for index in range(piece_begin, piece_end):
-                self.pieces[index].selected = include_paths
+            if piece_begin < piece_end:
+                selected_pieces[piece_begin:piece_end] = include_paths
 
     def reset_run_state(self):
-        self._pieces = [copy.copy(info) for info in self._pieces]
-        for info in self._pieces:
-            info.reset_run_state()
+        # The table is copied, because the state of a running torrent is saved from a shallow copy of DownloadInfo
+        self._pieces = self._pieces.copy_without_run_state()
+        self.recheck_progress = None
 
         self._interesting_pieces = set()
+        self._piece_availability = PieceAvailability(self.piece_count)
 
     def reset_stats(self):
         self._session_statistics = SessionStatistics(self._session_statistics)
@@ -419,9 +828,9 @@ class DownloadInfo:
     def from_dict(cls, dictionary: OrderedDict):
         info_hash = hashlib.sha1(bencodepy.encode(dictionary)).digest()
 
-        if len(dictionary[b'pieces']) % SHA1_DIGEST_LEN != 0:
+        piece_hashes = dictionary[b'pieces']
+        if len(piece_hashes) % SHA1_DIGEST_LEN != 0:
             raise ValueError('Invalid length of "pieces" string')
-        piece_hashes = grouper(dictionary[b'pieces'], SHA1_DIGEST_LEN)
 
         if b'files' in dictionary:
             files = list(map(FileInfo.from_dict, dictionary[b'files']))
@@ -433,7 +842,7 @@ class DownloadInfo:
                    private=dictionary.get('private', False))
 
     @property
-    def pieces(self) -> List[PieceInfo]:
+    def pieces(self) -> PieceTable:
         return self._pieces
 
     @property
@@ -462,6 +871,13 @@ class DownloadInfo:
     def interesting_pieces(self) -> Set[int]:
         return self._interesting_pieces
 
+    @property
+    def piece_availability(self) -> PieceAvailability:
+        """Numbers of connected peers that have each piece (the bitfields of the peers are kept
+        in `PeerTCPClient.piece_owned`)."""
+
+        return self._piece_availability
+
     @property
     def complete(self) -> bool:
         return self._complete
@@ -469,7 +885,7 @@ class DownloadInfo:
     @complete.setter
     def complete(self, value: bool):
         if value:
-            assert all(info.downloaded or not info.selected for info in self._pieces)
+            assert not self._pieces.get_remaining_pieces().any()
         self._complete = value
 
     DISTRUST_RATE_TO_BAN = 5
@@ -487,19 +903,31 @@ class DownloadInfo:
 
 
 class TorrentInfo:
-    def __init__(self, download_info: DownloadInfo, announce_list: List[List[str]], *, download_dir: str):
+    def __init__(self, download_info: DownloadInfo, announce_list: List[List[str]], *, download_dir: str,
+                 storage_mode: str='files', preallocation: str='sparse'):
         # TODO: maybe implement optional fields
 
         self.download_info = download_info
         self._announce_list = announce_list
 
         self.download_dir = download_dir
+        self.storage_mode = storage_mode
+        self.preallocation = preallocation
 
         self.paused = False
 
+    def __setstate__(self, state: dict):
+        # States saved by older versions don't contain these fields
+        self.storage_mode = 'files'
+        self.preallocation = 'sparse'
+        self.__dict__.update(state)
+
     @classmethod
     def from_file(cls, filename: str, **kwargs):
-        dictionary = cast(OrderedDict, bencodepy.decode_from_file(filename))
+        return cls.from_dict(cast(OrderedDict, bencodepy.decode_from_file(filename)), **kwargs)
+
+    @classmethod
+    def from_dict(cls, dictionary: OrderedDict, **kwargs):
         download_info = DownloadInfo.from_dict(dictionary[b'info'])
 
         if b'announce-list' in dictionary:
@@ -530,7 +958,7 @@ class TorrentState:
         self.single_file_mode = download_info.single_file_mode
 
         self.total_piece_count = len(download_info.pieces)
-        self.selected_piece_count = sum(1 for info in download_info.pieces if info.selected)
+        self.selected_piece_count = download_info.pieces.selected.count()
 
         last_piece_info = download_info.pieces[-1]
         self.selected_size = self.selected_piece_count * download_info.piece_length
@@ -558,6 +986,17 @@ class TorrentState:
         self.total_uploaded = statistics.total_uploaded
         self.total_downloaded = statistics.total_downloaded
 
+        self.upload_cache_hits = statistics.upload_cache_hits
+        self.upload_cache_misses = statistics.upload_cache_misses
+
+        recheck_progress = download_info.recheck_progress
+        if recheck_progress is not None:
+            self.checking_progress = recheck_progress.progress  # type: Optional[float]
+            self.checking_speed = recheck_progress.speed        # type: Optional[float]
+        else:
+            self.checking_progress = None
+            self.checking_speed = None
+
     MIN_SPEED_TO_CALC_ETA = 100 * 2 ** 10  # = 100 KiB/s
 
     @property
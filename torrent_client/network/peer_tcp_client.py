@@ -1,14 +1,15 @@
 import asyncio
 import logging
+import os
 import struct
 from enum import Enum
 from math import ceil
-from typing import Optional, Tuple, List, cast, Sequence
+from typing import Optional, Tuple, List, cast
 
 from bitarray import bitarray
 
-from torrent_client.file_structure import FileStructure
 from torrent_client.models import SHA1_DIGEST_LEN, DownloadInfo, Peer, BlockRequest
+from torrent_client.storage import BaseStorage
 
 
 __all__ = ['PeerTCPClient']
@@ -42,11 +43,12 @@ class PeerTCPClient:
         self._logger.setLevel(PeerTCPClient.LOGGER_LEVEL)
 
         self._download_info = None   # type: DownloadInfo
-        self._file_structure = None  # type: FileStructure
+        self._file_structure = None  # type: BaseStorage
         self._piece_owned = None     # type: bitarray
 
         self._am_choking = True
         self._am_interested = False
+        self._interesting_piece_count = 0  # Pieces of the peer that are being downloaded by us
         self._peer_choking = True
         self._peer_interested = False
 
@@ -57,6 +59,9 @@ class PeerTCPClient:
         self._writer = None               # type: asyncio.StreamWriter
         self._connected = False
 
+        self._sendfile_available = True
+        self._deferred_messages = None    # type: Optional[List[bytes]]
+
     _handshake_message = b'BitTorrent protocol'
     HANDSHAKE_DATA = bytes([len(_handshake_message)]) + _handshake_message
     RESERVED_BYTES = b'\0' * 8
@@ -76,7 +81,7 @@ class PeerTCPClient:
         if response[:len(PeerTCPClient.HANDSHAKE_DATA)] != PeerTCPClient.HANDSHAKE_DATA:
             raise ValueError('Unknown protocol')
 
-    def _populate_info(self, download_info: DownloadInfo, file_structure: FileStructure):
+    def _populate_info(self, download_info: DownloadInfo, file_structure: BaseStorage):
         self._download_info = download_info
         self._file_structure = file_structure
         self._piece_owned = bitarray(download_info.piece_count)
@@ -98,7 +103,7 @@ class PeerTCPClient:
 
         return actual_info_hash
 
-    async def connect(self, download_info: DownloadInfo, file_structure: FileStructure):
+    async def connect(self, download_info: DownloadInfo, file_structure: BaseStorage):
         self._reader, self._writer = await asyncio.wait_for(
             asyncio.open_connection(self._peer.host, self._peer.port), PeerTCPClient.CONNECT_TIMEOUT)
 
@@ -121,7 +126,7 @@ class PeerTCPClient:
         await self._receive_protocol_data()
         return await self._receive_info()
 
-    def confirm_info_hash(self, download_info: DownloadInfo, file_structure: FileStructure):
+    def confirm_info_hash(self, download_info: DownloadInfo, file_structure: BaseStorage):
         self._populate_info(download_info, file_structure)
 
         self._send_bitfield()
@@ -151,17 +156,23 @@ class PeerTCPClient:
 
     _KEEP_ALIVE_MESSAGE = b'\0' * 4
 
+    def _write(self, data: bytes):
+        if self._deferred_messages is not None:
+            self._deferred_messages.append(bytes(data))
+        else:
+            self._writer.write(data)
+
     def _send_message(self, message_id: MessageType=None, *payload: List[bytes]):
         if message_id is None:  # keep-alive
-            self._writer.write(PeerTCPClient._KEEP_ALIVE_MESSAGE)
+            self._write(PeerTCPClient._KEEP_ALIVE_MESSAGE)
             return
 
         length = sum(len(portion) for portion in payload) + 1
         # self._logger.debug('outcoming message %s length=%s', message_id.name, length)
 
-        self._writer.write(struct.pack('!IB', length, message_id.value))
+        self._write(struct.pack('!IB', length, message_id.value))
         for portion in payload:
-            self._writer.write(portion)
+            self._write(portion)
 
     @property
     def am_choking(self):
@@ -189,6 +200,19 @@ class PeerTCPClient:
             self._am_interested = value
             self._send_message(MessageType.interested if value else MessageType.not_interested)
 
+    def add_interesting_piece(self):
+        """Called when we start downloading a piece that the peer has."""
+
+        self._interesting_piece_count += 1
+        self.am_interested = True
+
+    def remove_interesting_piece(self):
+        """Called when we finish downloading a piece that the peer has."""
+
+        self._interesting_piece_count -= 1
+        if not self._interesting_piece_count:
+            self.am_interested = False
+
     @property
     def peer_choking(self):
         return self._peer_choking
@@ -198,7 +222,7 @@ class PeerTCPClient:
         return self._peer_interested
 
     @property
-    def piece_owned(self) -> Sequence[bool]:
+    def piece_owned(self) -> bitarray:
         return self._piece_owned
 
     # def is_seed(self) -> bool:
@@ -231,10 +255,12 @@ class PeerTCPClient:
             self._peer_interested = False
 
     def _mark_as_owner(self, piece_index: int):
+        if self._piece_owned[piece_index]:
+            return
         self._piece_owned[piece_index] = True
-        self._download_info.pieces[piece_index].owners.add(self._peer)
+        self._download_info.piece_availability.add_piece(piece_index)
         if piece_index in self._download_info.interesting_pieces:
-            self.am_interested = True
+            self.add_interesting_piece()
 
     def _handle_haves(self, message_id: MessageType, payload: memoryview):
         if message_id == MessageType.have:
@@ -246,12 +272,17 @@ class PeerTCPClient:
 
             arr = bitarray(endian='big')
             arr.frombytes(payload.tobytes())
-            for i in range(piece_count):
-                if arr[i]:
-                    self._mark_as_owner(i)
-            for i in range(piece_count, len(arr)):
-                if arr[i]:
-                    raise ValueError('Spare bits in "bitfield" message must be zero')
+            if arr[piece_count:].any():
+                raise ValueError('Spare bits in "bitfield" message must be zero')
+            del arr[piece_count:]
+
+            new_pieces = arr & ~self._piece_owned
+            self._piece_owned |= new_pieces
+            self._download_info.piece_availability.add(new_pieces)
+            interesting_piece_count = sum(1 for index in self._download_info.interesting_pieces if new_pieces[index])
+            if interesting_piece_count:
+                self._interesting_piece_count += interesting_piece_count
+                self.am_interested = True
 
         # if self._download_info.complete and self.is_seed():
         #     raise SeedError('A seed is disconnected because a download is complete')
@@ -306,7 +337,7 @@ class PeerTCPClient:
         if not block_length:
             return
 
-        async with self._file_structure.lock:
+        async with self._file_structure.lock_piece(piece_index):
             # Manual lock acquiring guarantees that piece validation will not be performed between
             # condition checking and piece writing
             piece_info = self._download_info.pieces[piece_index]
@@ -316,8 +347,7 @@ class PeerTCPClient:
             self._downloaded += block_length
             self._download_info.session_statistics.add_downloaded(self._peer, block_length)
 
-            await self._file_structure.write(piece_index * self._download_info.piece_length + block_begin, block_data,
-                                             acquire_lock=False)
+            await self._file_structure.write_block(piece_index, block_begin, block_data, acquire_lock=False)
 
             piece_info.mark_downloaded_blocks(self._peer, request)
 
@@ -346,7 +376,7 @@ class PeerTCPClient:
 
     def _send_bitfield(self):
         if self._download_info.downloaded_piece_count:
-            arr = bitarray([info.downloaded for info in self._download_info.pieces], endian='big')
+            arr = bitarray(self._download_info.pieces.downloaded, endian='big')
             self._send_message(MessageType.bitfield, arr.tobytes())
 
     def send_have(self, piece_index: int):
@@ -355,17 +385,74 @@ class PeerTCPClient:
     def send_request(self, request: BlockRequest, cancel: bool=False):
         self._check_position_range(request)
         if not cancel:
-            assert self._peer in self._download_info.pieces[request.piece_index].owners
+            assert self._piece_owned[request.piece_index]
 
         self._send_message(MessageType.request if not cancel else MessageType.cancel,
                            struct.pack('!3I', request.piece_index, request.block_begin, request.block_length))
 
+    USE_SENDFILE = False
+
+    def _send_block_from_file(self, request: BlockRequest, offset: int, header: bytes) -> Optional[int]:
+        """Starts the piece message and sends as much of the block as the socket accepts without blocking
+        directly from the file. Returns the number of block bytes sent or None if nothing was sent at all."""
+
+        transport = self._writer.transport
+        if transport.get_write_buffer_size() or transport.get_extra_info('sslcontext') is not None:
+            return None
+        pinned = self._file_structure.pin_file_range(offset, request.block_length)
+        if pinned is None:
+            return None  # The block spans several files
+        handle, file_pos = pinned
+
+        try:
+            length = len(header) + request.block_length + 1
+            self._writer.write(struct.pack('!IB', length, MessageType.piece.value) + header)
+            if transport.get_write_buffer_size():
+                return 0  # The socket buffer is full, so the transport has kept a part of the header
+
+            socket = transport.get_extra_info('socket')
+            try:
+                return os.sendfile(socket.fileno(), handle.fd, file_pos, request.block_length)
+            except (BlockingIOError, InterruptedError):
+                return 0
+            except ConnectionError:
+                raise
+            except OSError as e:
+                # E.g. the file system doesn't support sendfile()
+                self._logger.debug('sendfile() failed: %r', e)
+                self._sendfile_available = False
+                return 0
+        finally:
+            self._file_structure.unpin_file(handle)
+
     async def _send_block(self, request: BlockRequest):
-        block = await self._file_structure.read(
-            request.piece_index * self._download_info.piece_length + request.block_begin, request.block_length)
+        offset = request.piece_index * self._download_info.piece_length + request.block_begin
+        header = struct.pack('!2I', request.piece_index, request.block_begin)
         # TODO: Maybe can handle cancels here
 
-        self._send_message(MessageType.piece, struct.pack('!2I', request.piece_index, request.block_begin), block)
+        bytes_sent = None
+        if PeerTCPClient.USE_SENDFILE and self._sendfile_available and hasattr(os, 'sendfile'):
+            bytes_sent = self._send_block_from_file(request, offset, header)
+        if bytes_sent is None:
+            block = await self._file_structure.read_block(request.piece_index, request.block_begin,
+                                                          request.block_length)
+            self._send_message(MessageType.piece, header, block)
+        elif bytes_sent < request.block_length:
+            # The rest of the block is sent as usual. Other messages can't be written in the middle of this one,
+            # so they're deferred until then.
+            self._deferred_messages = []
+            try:
+                self._writer.write(await self._file_structure.read_block(
+                    request.piece_index, request.block_begin + bytes_sent, request.block_length - bytes_sent))
+            except BaseException:
+                # The piece message is truncated, so anything written after it would break the framing
+                self._deferred_messages = None
+                self.close()
+                raise
+            deferred_messages = self._deferred_messages
+            self._deferred_messages = None
+            for data in deferred_messages:
+                self._writer.write(data)
 
         self._uploaded += request.block_length
         self._download_info.session_statistics.add_uploaded(self._peer, request.block_length)
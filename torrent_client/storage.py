@@ -0,0 +1,88 @@
+from typing import AsyncContextManager, Callable, Iterable, Optional, Tuple, Union
+
+
+__all__ = ['BaseStorage']
+
+
+class BaseStorage:
+    """Interface of torrent data storages used by the peer clients, the downloader and the torrent manager.
+
+    Offsets and lengths are given in terms of pieces, so storages are free to lay the data out in files,
+    memory or nowhere at all. Implementations are registered in `file_structure.STORAGE_MODES`.
+    """
+
+    PERSISTENT = False  # Whether the data outlives the storage object (and can be resumed after restart)
+
+    def lock_piece(self, piece_index: int) -> AsyncContextManager:
+        raise NotImplementedError
+
+    async def read_block(self, piece_index: int, block_begin: int, length: int) -> Union[bytes, memoryview]:
+        raise NotImplementedError
+
+    async def write_block(self, piece_index: int, block_begin: int, data: memoryview, *, acquire_lock=True):
+        raise NotImplementedError
+
+    async def hash_piece(self, piece_index: int) -> bytes:
+        """Returns SHA-1 digest of the piece data (the piece must be written completely)."""
+
+        raise NotImplementedError
+
+    async def recheck(self, piece_indexes: Iterable[int], on_piece_checked: Callable[[int, bool], None]):
+        """Verifies stored data of the pieces calling `on_piece_checked(piece_index, is_valid)` for each of them."""
+
+        raise NotImplementedError
+
+    async def flush_piece(self, piece_index: int):
+        """Makes sure the piece data is stored persistently (called when the piece is validated)."""
+
+    def discard_piece(self, piece_index: int):
+        """Drops intermediate data of the piece (called when the piece fails validation)."""
+
+    @property
+    def unflushed_pieces(self) -> Iterable[int]:
+        """Indexes of pieces whose downloaded blocks are kept only until `flush_piece` and aren't stored yet."""
+
+        return ()
+
+    async def create_empty_files(self):
+        pass
+
+    async def preallocate(self):
+        pass
+
+    def pin_file_range(self, offset: int, length: int) -> Optional[Tuple[object, int]]:
+        """Returns an open file containing the whole range and the range position in this file, or None
+        if the range can't be sent directly from a file (e.g. the storage doesn't use files at all).
+        It's called from the event loop thread, so it must not block on the file system."""
+
+        return None
+
+    @staticmethod
+    def unpin_file(handle: object):
+        pass
+
+    @property
+    def pending_write_bytes(self) -> int:
+        return 0
+
+    @property
+    def write_latency(self) -> Optional[float]:
+        return None
+
+    def is_write_backlog_full(self) -> bool:
+        return False
+
+    def is_write_backlog_drained(self) -> bool:
+        return True
+
+    async def wait_write_backlog_drained(self):
+        pass
+
+    def relocate(self, download_dir: str):
+        """Switches the storage to a copy of its data in another download directory."""
+
+    async def wait_old_files_released(self):
+        """Waits until operations started before `relocate` stop using the old files, so they can be removed."""
+
+    async def close(self):
+        pass
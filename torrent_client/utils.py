@@ -1,5 +1,6 @@
+import asyncio
 from math import floor, log
-from typing import List, TypeVar, Sequence
+from typing import List, Optional, TypeVar, Sequence
 
 
 T = TypeVar('T', Sequence, memoryview)
@@ -51,6 +52,63 @@ def floor_to(x: float, ndigits: int) -> float:
     return floor(x * scale) / scale
 
 
+class MemoryBudget:
+    """Accounting of memory that may be consumed by some kind of buffers in the whole daemon.
+    It is supposed to be used from the event loop thread only.
+    """
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._used = 0
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    def try_reserve(self, size: int) -> bool:
+        if self._used + size > self._limit:
+            return False
+        self._used += size
+        return True
+
+    def release(self, size: int):
+        self._used -= size
+
+
+class BufferPool:
+    """Reusable buffers of a fixed size. At most `count` buffers are in use at the same time, `acquire` waits
+    until someone releases one. It is supposed to be used from the event loop thread only.
+    """
+
+    def __init__(self, buffer_size: int, count: int):
+        self._buffer_size = buffer_size
+        self._count = count
+        self._free_buffers = []  # type: List[bytearray]
+        self._slots = None       # type: Optional[asyncio.Semaphore]
+
+    @property
+    def buffer_size(self) -> int:
+        return self._buffer_size
+
+    async def acquire(self) -> bytearray:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._count)
+        await self._slots.acquire()
+        return self._free_buffers.pop() if self._free_buffers else bytearray(self._buffer_size)
+
+    def release(self, buffer: Optional[bytearray]):
+        """Returns the buffer to the pool. None should be passed if the buffer can still be accessed
+        by someone else (e.g. by an executor thread after the awaiting task was cancelled)."""
+
+        if buffer is not None:
+            self._free_buffers.append(buffer)
+        self._slots.release()
+
+
 def import_signals():
     try:
         from PyQt5.QtCore import QObject, pyqtSignal